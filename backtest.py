@@ -0,0 +1,63 @@
+"""
+Runs the TradingAlgorithm of bot.py against a BacktestExchange instead of the live exchange, to try out LEVEL,
+OWN_WEIGHT, OTHER_INSIDE_WEIGHT, the volume curve etc. without waiting for the market.
+
+The feed is synthetic for now: SMALL_CHIPS and SMALL_CHIPS_NEW_COUNTRY following the same fair value.
+
+    python backtest.py [--hours 8] [--seed 1]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import time
+
+from optibook.backtester import BacktestExchange, synthetic_feed
+from optibook.common_types import Instrument
+
+import bot
+
+INSTRUMENTS = [Instrument("SMALL_CHIPS", 0.1), Instrument("SMALL_CHIPS_NEW_COUNTRY", 0.1)]
+CYCLE_SECONDS = 0.3
+
+
+def ready(exchange):
+    # what TradingAlgorithm needs to start without waiting
+    for instrument in INSTRUMENTS:
+        book = exchange.get_last_price_book(instrument.instrument_id)
+        if book is None or not book.bids or not book.asks:
+            return False
+    return len(exchange.get_merged_trade_tick_history([i.instrument_id for i in INSTRUMENTS])) >= 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=float, default=8.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between synthetic book updates")
+    args = parser.parse_args()
+
+    feed = synthetic_feed(INSTRUMENTS, duration=args.hours * 3600, interval=args.interval, seed=args.seed,
+                          shared_fair_value=True, taker_rate=1.0)
+    exchange = BacktestExchange(INSTRUMENTS, feed)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    start = time.perf_counter()
+    nr_cycles = 0
+    # the strategy prints as it goes
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        while not ready(exchange) and exchange.advance(CYCLE_SECONDS):
+            pass
+        algorithm = bot.TradingAlgorithm(exchange)
+        while exchange.advance(CYCLE_SECONDS):
+            algorithm.run()
+            nr_cycles += 1
+    elapsed = time.perf_counter() - start
+
+    nr_trades = sum(len(exchange.get_trade_history(i.instrument_id)) for i in INSTRUMENTS)
+    print(f"{nr_cycles} cycles ({nr_cycles * CYCLE_SECONDS / 3600:.1f}h) in {elapsed:.1f}s")
+    print(f"pnl: {exchange.get_pnl():.2f}, positions: {exchange.get_positions()}, last {nr_trades} trades kept")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Synthetic info feed, framed exactly like the raw info connection sends it.
+"""
+import random
+import time
+
+from optibook.idl import common_capnp, info_capnp
+
+PRICE_BOOK_RATIO = 0.8
+
+
+def _price_book(instrument_id, mid, nr_levels):
+    book = info_capnp.PriceBook.new_message(instrumentId=instrument_id)
+    bids = book.init('bids', nr_levels)
+    asks = book.init('asks', nr_levels)
+    for i in range(nr_levels):
+        bids[i].price = round(mid - 0.1 * (i + 1), 1)
+        bids[i].volume = 10 * (i + 1)
+        asks[i].price = round(mid + 0.1 * (i + 1), 1)
+        asks[i].volume = 10 * (i + 1)
+    return book
+
+
+def _trade_tick(instrument_id, price, trade_id, timestamp):
+    return common_capnp.TradeTick.new_message(
+        tradeId=trade_id,
+        timestamp=timestamp,
+        instrumentId=instrument_id,
+        price=price,
+        volume=random.randint(1, 20),
+        aggressorSide=random.choice(['bid', 'ask']),
+        buyer='buyer',
+        seller='seller',
+    )
+
+
+def _frame(msg_type, msg):
+    raw = common_capnp.RawMessage.new_message(type=msg_type)
+    raw.msg = msg
+    return raw.to_bytes()
+
+
+def make_feed_frames(nr_messages: int, nr_instruments: int = 20, nr_levels: int = 5, seed: int = 42,
+                     price_book_ratio: float = PRICE_BOOK_RATIO):
+    """
+    Returns a list of framed RawMessages, a mix of PriceBooks and TradeTicks on nr_instruments instruments.
+    """
+    random.seed(seed)
+    instrument_ids = [f'INSTRUMENT_{i}' for i in range(nr_instruments)]
+    mids = {instrument_id: 100.0 for instrument_id in instrument_ids}
+    timestamp = time.time_ns()
+    frames = []
+    for trade_id in range(nr_messages):
+        instrument_id = random.choice(instrument_ids)
+        mids[instrument_id] += random.choice([-0.1, 0, 0.1])
+        timestamp += random.randint(10_000, 1_000_000)
+        if random.random() < price_book_ratio:
+            frames.append(_frame(info_capnp.PriceBook.schema.node.id,
+                                 _price_book(instrument_id, mids[instrument_id], nr_levels)))
+        else:
+            frames.append(_frame(common_capnp.TradeTick.schema.node.id,
+                                 _trade_tick(instrument_id, round(mids[instrument_id], 1), trade_id, timestamp)))
+    return frames
+
+
+def make_feed_bytes(nr_messages: int, nr_instruments: int = 20, nr_levels: int = 5, seed: int = 42) -> bytes:
+    return b''.join(make_feed_frames(nr_messages, nr_instruments, nr_levels, seed))
+
+
+async def feed_info_client(client, frames) -> None:
+    """
+    Passes the frames to the message handling of an InfoClient, as if they had been received on its connection.
+    """
+    for frame in frames:
+        with common_capnp.RawMessage.from_bytes(frame) as msg:
+            await client._on_message(msg)
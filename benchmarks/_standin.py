@@ -0,0 +1,137 @@
+"""
+Minimal stand-in for the exchange's ExecPortal, used to benchmark the client side without a live exchange.
+For benchmarks that need real matching and an info feed, start_simulated_exchange runs the full SimulatedExchange.
+
+Every order is accepted. IOC orders are reported back as a full fill through the ExecFeed, a little while after the
+reply has been sent, so the feed latency of the client can be measured independently of the request/reply latency.
+"""
+import multiprocessing
+import socket
+import time
+
+FILL_DELAY_NS = 1_000_000
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _serve(port):
+    import capnp
+    from optibook.idl import exec_capnp
+
+    class StandInExec(exec_capnp.ExecPortal.Exec.Server):
+        def __init__(self, feed):
+            self._feed = feed
+            self._next_order_id = 1
+            self._next_trade_id = 1
+            self._pending = set()
+
+        def _send_fill(self, instrument_id, order_id, price, volume, side):
+            trade_id = self._next_trade_id
+            self._next_trade_id += 1
+
+            def send():
+                self._pending.discard(timer)
+                trade = {
+                    'tradeId': trade_id,
+                    'timestamp': time.time_ns(),
+                    'instrumentId': instrument_id,
+                    'orderId': order_id,
+                    'price': price,
+                    'volume': volume,
+                    'side': side,
+                }
+                # the replies are not interesting, but the requests are cancelled if their promises are dropped
+                self._pending.add(self._feed.onTrade(trade=trade))
+
+            timer = capnp.getTimer().after_delay(FILL_DELAY_NS).then(send)
+            self._pending.add(timer)
+
+        def insertOrder(self, instrumentId, price, volume, side, orderType, _context, **kwargs):
+            order_id = self._next_order_id
+            self._next_order_id += 1
+            if orderType == 'ioc':
+                self._send_fill(instrumentId, order_id, price, volume, side)
+            _context.results.orderId = order_id
+            _context.results.success = True
+
+        def amendOrder(self, instrumentId, orderId, volume, _context, **kwargs):
+            _context.results.success = True
+
+        def deleteOrder(self, instrumentId, orderId, _context, **kwargs):
+            _context.results.success = True
+
+        def deleteOrders(self, instrumentId, _context, **kwargs):
+            _context.results.success = True
+
+        def updateInstrumentParameters(self, instrumentId, parameters, _context, **kwargs):
+            _context.results.success = True
+
+    class StandInExecPortal(exec_capnp.ExecPortal.Server):
+        def login(self, username, password, callbackInterface, _context, **kwargs):
+            _context.results.exec = StandInExec(callbackInterface)
+            _context.results.positions.init('positions', 0)
+
+        def adminLogin(self, username, password, adminPassword, callbackInterface, _context, **kwargs):
+            self.login(username, password, callbackInterface, _context)
+
+    server = capnp.TwoPartyServer(f'127.0.0.1:{port}', bootstrap=StandInExecPortal())
+    server.run_forever()
+
+
+def _wait_for_port(process, port):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise Exception(f'Stand-in server did not start on port {port}')
+
+
+def start_standin_exec_server(port: int = None):
+    """
+    Starts the stand-in ExecPortal in a separate process and waits until it accepts connections.
+
+    Returns the process and the port it listens on. Terminate the process when done.
+    """
+    port = port or find_free_port()
+    process = multiprocessing.get_context('spawn').Process(target=_serve, args=(port,), daemon=True)
+    process.start()
+    _wait_for_port(process, port)
+    return process, port
+
+
+def _serve_simulated_exchange(instrument_ids, info_port, exec_port, kwargs):
+    import asyncio
+    import logging
+    from optibook.common_types import Instrument
+    from optibook.simulated_exchange import SimulatedExchange
+
+    logging.getLogger('client').setLevel('WARNING')
+    logging.getLogger('simulated_exchange').setLevel('WARNING')
+    instruments = [Instrument(instrument_id, 0.1) for instrument_id in instrument_ids]
+    exchange = SimulatedExchange(instruments, info_port=info_port, exec_port=exec_port, **kwargs)
+    asyncio.run(exchange.serve_forever())
+
+
+def start_simulated_exchange(instrument_ids=('BENCH',), **kwargs):
+    """
+    Starts a SimulatedExchange listing instrument_ids, with tick size 0.1, in a separate process. kwargs are passed on
+    to SimulatedExchange.
+
+    Returns the process, the info port and the exec port. Terminate the process when done.
+    """
+    info_port = find_free_port()
+    exec_port = find_free_port()
+    process = multiprocessing.get_context('spawn').Process(
+        target=_serve_simulated_exchange, args=(list(instrument_ids), info_port, exec_port, kwargs), daemon=True)
+    process.start()
+    _wait_for_port(process, info_port)
+    _wait_for_port(process, exec_port)
+    return process, info_port, exec_port
@@ -0,0 +1,104 @@
+"""
+Measures the memory retained per public trade tick and the time it takes to store one, for:
+
+- dict:     a deque of TradeTick objects without __slots__, as InfoClient used to keep them
+- slots:    a deque of the current, slotted TradeTick
+- columnar: InfoClient's TradeTickHistory
+
+Run from the repository root:
+
+    python -m benchmarks.common_types_memory [--ticks N]
+"""
+import argparse
+import logging
+import sys
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+from optibook.common_types import TradeTick
+from optibook.idl import common_capnp
+from optibook.trade_tick_history import TradeTickHistory
+
+from ._feed import make_feed_frames
+
+
+class DictTradeTick:
+    # the TradeTick as it was before __slots__ were added
+    def __init__(self, *, timestamp=None, instrument_id=None, price=None, volume=None, aggressor_side=None, buyer=None, seller=None, trade_id=None):
+        self.timestamp: datetime = datetime(1970, 1, 1) if not timestamp else timestamp
+        self.instrument_id: str = '' if not instrument_id else instrument_id
+        self.price: float = 0.0 if not price else price
+        self.volume: int = 0 if not volume else volume
+        self.aggressor_side: str = '' if not aggressor_side else aggressor_side
+        self.buyer: str = '' if not buyer else buyer
+        self.seller: str = '' if not seller else seller
+        self.trade_id: int = -1 if not trade_id else trade_id
+
+
+def _object_store(tick_type, intern):
+    history = deque()
+
+    def store(trade):
+        history.append(tick_type(
+            timestamp=datetime.fromtimestamp(trade.timestamp / 1000000000),
+            instrument_id=intern(trade.instrumentId),
+            price=trade.price,
+            volume=trade.volume,
+            aggressor_side=intern(str(trade.aggressorSide)),
+            buyer=intern(trade.buyer),
+            seller=intern(trade.seller),
+            trade_id=trade.tradeId,
+        ))
+    return history, store
+
+
+def _columnar_store(capacity):
+    history = TradeTickHistory('INSTRUMENT_0', capacity)
+
+    def store(trade):
+        history.append(trade.timestamp, trade.price, trade.volume, str(trade.aggressorSide), trade.tradeId,
+                       sys.intern(trade.buyer), sys.intern(trade.seller))
+    return history, store
+
+
+def _measure(make_store, trades):
+    history, store = make_store()
+    start = time.perf_counter()
+    for trade in trades:
+        store(trade)
+    duration = time.perf_counter() - start
+    del history, store
+
+    tracemalloc.start()
+    history, store = make_store()
+    for trade in trades:
+        store(trade)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return retained / len(trades), duration / len(trades)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ticks', type=int, default=50_000)
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    messages = [common_capnp.RawMessage.from_bytes(frame).__enter__()
+                for frame in make_feed_frames(args.ticks, nr_instruments=1, price_book_ratio=0.0)]
+    trades = [msg.msg.as_struct(common_capnp.TradeTick.schema) for msg in messages]
+
+    stores = [
+        ('dict', lambda: _object_store(DictTradeTick, lambda s: s)),
+        ('slots', lambda: _object_store(TradeTick, sys.intern)),
+        ('columnar', lambda: _columnar_store(args.ticks)),
+    ]
+    for name, make_store in stores:
+        bytes_per_tick, seconds_per_tick = _measure(make_store, trades)
+        print(f'{name:<9} {bytes_per_tick:6.0f} bytes per retained tick, {seconds_per_tick * 1e6:6.2f}us per tick')
+
+
+if __name__ == '__main__':
+    main()
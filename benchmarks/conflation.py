@@ -0,0 +1,85 @@
+"""
+Measures how long an InfoClient with a slow price book handler takes to work through a burst on the info feed, with
+and without conflate_price_books, and checks that both end with the same books and the same trade ticks.
+
+Run from the repository root:
+
+    python -m benchmarks.conflation [--messages N] [--instruments N] [--handler-us US]
+
+The whole burst is waiting in the socket before the client starts reading, as after a pause of the reader.
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from optibook.exchange_client import InfoClient
+from optibook.idl import info_capnp
+
+from ._feed import make_feed_bytes
+from .info_decode import _OpenWriter
+
+
+def _spin(duration: float) -> None:
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        pass
+
+
+async def _drain(data: bytes, nr_messages: int, conflate: bool, handler_duration: float):
+    client = InfoClient(max_nr_trade_history=nr_messages, conflate_price_books=conflate)
+    nr_books = 0
+
+    def on_book(book):
+        nonlocal nr_books
+        nr_books += 1
+        _spin(handler_duration)
+
+    client.add_message_handler(info_capnp.PriceBook, on_book)
+    client._reader = asyncio.StreamReader(limit=len(data) + 1)
+    client._reader.feed_data(data)
+    client._reader.feed_eof()
+    client._writer = _OpenWriter()
+
+    start = time.perf_counter()
+    try:
+        await client._read()
+    except asyncio.IncompleteReadError:
+        pass
+    return client, nr_books, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--instruments', type=int, default=20)
+    parser.add_argument('--handler-us', type=float, default=20.0, help='time spent per price book in the handler')
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    data = make_feed_bytes(args.messages, nr_instruments=args.instruments)
+
+    results = {}
+    for conflate in [False, True]:
+        client, nr_books, duration = asyncio.run(_drain(data, args.messages, conflate, args.handler_us / 1e6))
+        results[conflate] = client
+        name = 'conflated' if conflate else 'sequential'
+        print(f'{name:<12} {nr_books:8} books handled in {duration:.3f}s')
+        stats = client.get_conflation_stats()
+        if stats is not None:
+            print(f'{"":<12} {stats.nr_frames} frames, {stats.nr_conflated} conflated, '
+                  f'max queue depth {stats.max_queue_depth}')
+
+    sequential, conflated = results[False], results[True]
+    instrument_ids = sorted(sequential._last_price_book_by_instrument_id)
+    assert instrument_ids == sorted(conflated._last_price_book_by_instrument_id)
+    for instrument_id in instrument_ids:
+        assert sequential.get_last_price_book(instrument_id).bids == conflated.get_last_price_book(instrument_id).bids
+        assert sequential.get_last_price_book(instrument_id).asks == conflated.get_last_price_book(instrument_id).asks
+        assert [t.trade_id for t in sequential.get_trade_tick_history(instrument_id)] == \
+               [t.trade_id for t in conflated.get_trade_tick_history(instrument_id)]
+    print(f'same books and trade ticks for {len(instrument_ids)} instruments')
+
+
+if __name__ == '__main__':
+    main()
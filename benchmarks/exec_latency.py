@@ -0,0 +1,78 @@
+"""
+Compares the exec round-trip and feed latency of the 'poll' and 'event' pump modes against a local stand-in
+ExecPortal.
+
+Run from the repository root:
+
+    python -m benchmarks.exec_latency [--orders N]
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from optibook.base_client import ALL_PUMP_MODES
+from optibook.exchange_client import ExecClient, ORDER_TYPE_IOC, SIDE_BID
+
+from ._standin import start_standin_exec_server, FILL_DELAY_NS
+
+
+class TimedExecClient(ExecClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.feed_latencies_ns = []
+
+    class ExecSubscription(ExecClient.ExecSubscription):
+        def onTrade(self, trade, **kwargs):
+            self._exec.feed_latencies_ns.append(time.time_ns() - trade.timestamp)
+            super().onTrade(trade, **kwargs)
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def _measure(port, pump_mode, nr_orders):
+    client = TimedExecClient(host='127.0.0.1', port=port, username='bench', password='bench', pump_mode=pump_mode)
+    await client.connect()
+
+    round_trips_ns = []
+    for i in range(nr_orders):
+        start = time.perf_counter_ns()
+        await client.insert_order(instrument_id='BENCH', price=100.0, volume=1, side=SIDE_BID,
+                                  order_type=ORDER_TYPE_IOC)
+        round_trips_ns.append(time.perf_counter_ns() - start)
+        # wait for the fill before sending the next order, so it is not picked up while waiting for the next reply
+        while len(client.feed_latencies_ns) <= i:
+            await asyncio.sleep(FILL_DELAY_NS / 1e9)
+
+    await client.disconnect()
+    return round_trips_ns, client.feed_latencies_ns
+
+
+def _report(pump_mode, name, values_ns):
+    values_ms = [v / 1e6 for v in values_ns]
+    print(f'{pump_mode:>6} {name:<12} median={statistics.median(values_ms):8.3f}ms '
+          f'p99={_percentile(values_ms, 0.99):8.3f}ms max={max(values_ms):8.3f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=200)
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    process, port = start_standin_exec_server()
+    try:
+        for pump_mode in ALL_PUMP_MODES:
+            round_trips, feed_latencies = asyncio.run(_measure(port, pump_mode, args.orders))
+            _report(pump_mode, 'round-trip', round_trips)
+            _report(pump_mode, 'feed', feed_latencies)
+    finally:
+        process.terminate()
+
+
+if __name__ == '__main__':
+    main()
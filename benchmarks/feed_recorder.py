@@ -0,0 +1,79 @@
+"""
+Overhead of recording the info feed: messages per second through RawClient._read with and without a FeedRecorder,
+and how long the writer thread needs to get everything to disk afterwards.
+
+Run from the repository root:
+
+    python -m benchmarks.feed_recorder [--messages N] [--directory DIR]
+
+Without --directory the segments go to a temporary directory.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from optibook.feed_recorder import FeedRecorder, segment_numbers
+
+from ._feed import make_feed_bytes
+from .info_decode import CountingClient, _OpenWriter
+
+
+class RecordingClient(CountingClient):
+    def __init__(self, recorder):
+        super().__init__()
+        self._recorder = recorder
+
+
+async def _read_all(client, data):
+    client._reader = asyncio.StreamReader()
+    client._reader.feed_data(data)
+    client._reader.feed_eof()
+    client._writer = _OpenWriter()
+
+    start = time.perf_counter()
+    try:
+        await client._read()
+    except asyncio.IncompleteReadError:
+        pass
+    return client.nr_messages, time.perf_counter() - start
+
+
+def _run(name, data, recorder=None):
+    client = CountingClient() if recorder is None else RecordingClient(recorder)
+    nr_messages, duration = asyncio.run(_read_all(client, data))
+    print(f'{name:<12} {nr_messages} messages in {duration:.3f}s: {nr_messages / duration:12,.0f} msgs/s, '
+          f'{duration / nr_messages * 1e6:.2f}us/msg')
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--directory', help='where to write the recording')
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    data = make_feed_bytes(args.messages)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        directory = args.directory or tmp_dir
+        baseline = _run('plain', data)
+
+        recorder = FeedRecorder(directory)
+        recording = _run('recording', data, recorder)
+        start = time.perf_counter()
+        recorder.close()
+        drain = time.perf_counter() - start
+
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f'overhead on the read loop: {(recording - baseline) / args.messages * 1e6:.2f}us/msg '
+              f'({recording / baseline - 1:+.0%})')
+        print(f'writer thread finished {drain:.3f}s after the last message, {size / 1e6:.1f}MB in '
+              f'{len(segment_numbers(directory))} segment(s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Replay speed of a recorded info feed: all messages into an InfoClient, in eager and lazy price book mode, the records
+of a single instrument, and seeking to the middle of the recording.
+
+Run from the repository root:
+
+    python -m benchmarks.feed_replay [--messages N] [--directory DIR]
+
+Without --directory a recording of N synthetic messages is made in a temporary directory first.
+"""
+import argparse
+import tempfile
+import time
+
+from optibook.exchange_client import InfoClient
+from optibook.feed_recorder import FeedRecorder
+from optibook.feed_replay import FeedCapture
+
+from ._feed import make_feed_frames
+
+# between two synthetic messages
+_INTERVAL_NS = 1000000
+
+
+def _record(directory, nr_messages):
+    timestamp_ns = time.time_ns()
+    with FeedRecorder(directory, segment_size=32 * 1024 * 1024) as recorder:
+        for frame in make_feed_frames(nr_messages):
+            timestamp_ns += _INTERVAL_NS
+            recorder.record(frame, timestamp_ns)
+
+
+def _run(name, f):
+    start = time.perf_counter()
+    nr_messages = f()
+    duration = time.perf_counter() - start
+    print(f'{name:<28} {nr_messages:>8} messages in {duration:.3f}s: {nr_messages / duration:12,.0f} msgs/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--directory', help='an existing recording to replay')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        directory = args.directory
+        if directory is None:
+            directory = tmp_dir
+            _record(directory, args.messages)
+
+        capture = FeedCapture(directory)
+        instrument_id = min(capture.instrument_ids())
+        middle = (capture.first_timestamp + capture.last_timestamp) // 2
+        print(f'{len(capture.segments)} segment(s), {len(capture.instrument_ids())} instruments')
+
+        _run('frames only', lambda: sum(1 for _ in capture.frames()))
+        _run('replay', lambda: capture.replay(InfoClient()))
+        _run('replay, lazy price books', lambda: capture.replay(InfoClient(lazy_price_books=True)))
+        _run(f'replay {instrument_id}', lambda: capture.replay(InfoClient(), instrument_ids=[instrument_id]))
+        _run('replay second half', lambda: capture.replay(InfoClient(), start=middle))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Measures how long `import optibook` takes in a fresh interpreter, with python -X importtime, and checks it against
+a budget. Exits with status 1 when the budget is exceeded or a module that should only be imported on demand is
+imported, so it can guard against regressions.
+
+Run from the repository root:
+
+    python -m benchmarks.import_time [--module M] [--runs N] [--budget-ms MS] [--top N]
+
+Most of the time goes to capnp and asyncio, which are out of our hands. The budget is for what optibook adds on top:
+the self times of all modules that `import capnp` does not import, in the fastest of N runs.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import typing
+
+# only imported when they are actually needed, e.g. aiohttp for looking up the host of a user
+DEFERRED_MODULES = ['aiohttp', 'pathlib', 'pyarrow']
+
+
+def _import_times(module: str) -> typing.Dict[str, typing.Tuple[int, int]]:
+    """
+    Returns the self and cumulative import time in microseconds per module, for one import in a fresh interpreter.
+    """
+    # the bytecode caches have to be written, or every run measures compiling
+    env = {name: value for name, value in os.environ.items() if name != 'PYTHONDONTWRITEBYTECODE'}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True, env=env)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def _own_us(times: typing.Dict[str, typing.Tuple[int, int]], baseline: typing.Collection[str]) -> int:
+    # the self times of everything that importing capnp does not import as well
+    return sum(self_us for name, (self_us, _) in times.items() if name not in baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='optibook')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=50.0,
+                        help='the most the module may add on top of importing capnp')
+    parser.add_argument('--top', type=int, default=10, help='show the modules with the largest self time')
+    args = parser.parse_args()
+
+    # one import to get the bytecode caches written, so that the runs measure importing and not compiling
+    _import_times(args.module)
+    baseline = set(_import_times('capnp'))
+    runs = [_import_times(args.module) for _ in range(args.runs)]
+    times = min(runs, key=lambda times: _own_us(times, baseline))
+    own_us = _own_us(times, baseline)
+
+    print(f'import {args.module}: {times[args.module][1] / 1000:.1f}ms, of which {own_us / 1000:.1f}ms on top of '
+          f'capnp, budget {args.budget_ms:.1f}ms')
+    print('largest self times on top of capnp:')
+    own = [(name, self_us) for name, (self_us, _) in times.items() if name not in baseline]
+    for name, self_us in sorted(own, key=lambda item: -item[1])[:args.top]:
+        print(f'    {name:<40} {self_us / 1000:8.1f}ms')
+
+    failed = False
+    imported = [name for name in DEFERRED_MODULES if name in times]
+    if imported:
+        print(f'FAIL: imported modules that should be deferred: {", ".join(imported)}')
+        failed = True
+    if own_us / 1000 > args.budget_ms:
+        print(f'FAIL: over budget by {own_us / 1000 - args.budget_ms:.1f}ms')
+        failed = True
+    if failed:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
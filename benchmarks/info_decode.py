@@ -0,0 +1,109 @@
+"""
+Measures how many messages per second RawClient._read decodes, compared to the previous readexactly based
+implementation.
+
+Run from the repository root:
+
+    python -m benchmarks.info_decode [--messages N] [--input FILE]
+
+FILE holds raw feed bytes as received on the info connection. Without it a synthetic feed is used.
+"""
+import argparse
+import asyncio
+import logging
+import time
+import traceback
+
+from optibook.base_client import RawClient
+from optibook.idl import common_capnp
+
+from ._feed import make_feed_bytes
+
+
+class _OpenTransport:
+    def is_closing(self):
+        return False
+
+
+class _OpenWriter:
+    transport = _OpenTransport()
+
+
+class CountingClient(RawClient):
+    def __init__(self):
+        super().__init__(None, None)
+        self.nr_messages = 0
+
+    async def _on_message(self, msg):
+        self.nr_messages += 1
+
+
+class LegacyCountingClient(CountingClient):
+    async def _read(self):
+        # the implementation of RawClient._read before the buffered frame decoder
+        try:
+            while not self._writer.transport.is_closing():
+                nr_segments_b = await self._reader.readexactly(4)
+                nr_segments = int.from_bytes(nr_segments_b, byteorder='little') + 1
+                bytes_to_read = nr_segments * 4
+                if nr_segments % 2 == 0:
+                    bytes_to_read += 4
+                segment_sizes_b = await self._reader.readexactly(bytes_to_read)
+                total_size = 0
+
+                for i in range(nr_segments):
+                    segment_size = int.from_bytes(segment_sizes_b[i*4:(i+1)*4], byteorder='little')
+                    total_size += segment_size * 8
+                all_data = await self._reader.readexactly(total_size)
+                total_msg_buf = nr_segments_b + segment_sizes_b + all_data
+
+                with common_capnp.RawMessage.from_bytes(total_msg_buf) as msg:
+                    if msg.type == common_capnp.GenericReply.schema.node.id:
+                        await self._handle_message_reply(msg.msg.as_struct(common_capnp.GenericReply.schema))
+                    else:
+                        await self._on_message(msg)
+
+                    for f in self._extra_callbacks.values():
+                        f(msg)
+        except asyncio.exceptions.IncompleteReadError:
+            raise
+        except:
+            traceback.print_exc()
+            raise
+
+
+async def _decode_all(client_type, data):
+    client = client_type()
+    client._reader = asyncio.StreamReader()
+    client._reader.feed_data(data)
+    client._reader.feed_eof()
+    client._writer = _OpenWriter()
+
+    start = time.perf_counter()
+    try:
+        await client._read()
+    except asyncio.IncompleteReadError:
+        pass
+    return client.nr_messages, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--input', help='file with raw info feed bytes')
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    if args.input:
+        with open(args.input, 'rb') as f:
+            data = f.read()
+    else:
+        data = make_feed_bytes(args.messages)
+
+    for name, client_type in [('readexactly', LegacyCountingClient), ('buffered', CountingClient)]:
+        nr_messages, duration = asyncio.run(_decode_all(client_type, data))
+        print(f'{name:<12} {nr_messages} messages in {duration:.3f}s: {nr_messages / duration:12,.0f} msgs/s')
+
+
+if __name__ == '__main__':
+    main()
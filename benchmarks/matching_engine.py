@@ -0,0 +1,179 @@
+"""
+Throughput of the MatchingEngine for typical request mixes, in operations per second.
+
+    passive   inserts of limit orders that do not trade, spread over the levels around the mid
+    cancel    deletes of resting orders in random order
+    amend     volume-down amends of resting orders
+    match     IOC orders trading against a deep book, each taking out a few orders
+    match_quiet
+              match, with a listener that only wants book updates
+    mixed     a market-making mix: inserts, amends, deletes and aggressive orders, with a price book snapshot after
+              every request
+
+Run from the repository root:
+
+    python -m benchmarks.matching_engine [--operations N]
+"""
+import argparse
+import random
+import time
+
+from optibook.exchange_client import ORDER_TYPE_IOC, ORDER_TYPE_LIMIT, SIDE_ASK, SIDE_BID
+from optibook.matching_engine import MatchingEngine, MatchingEngineListener
+
+TICK_SIZE = 0.1
+MID_TICK = 1000
+NR_LEVELS = 50
+
+
+class CountingListener(MatchingEngineListener):
+    """
+    A listener that looks at every event, like the simulated exchange or a backtester would.
+    """
+    def __init__(self):
+        self.nr_events = 0
+
+    def on_order_update(self, owner, order):
+        self.nr_events += 1
+
+    def on_trade(self, owner, trade):
+        self.nr_events += 1
+
+    def on_trade_tick(self, trade_tick):
+        self.nr_events += 1
+
+
+def _price(tick):
+    return round(tick * TICK_SIZE, 10)
+
+
+def _passive_orders(rng, nr_orders):
+    orders = []
+    for _ in range(nr_orders):
+        side = rng.choice((SIDE_BID, SIDE_ASK))
+        offset = rng.randrange(1, NR_LEVELS)
+        orders.append((_price(MID_TICK - offset if side == SIDE_BID else MID_TICK + offset), rng.randint(1, 50), side))
+    return orders
+
+
+def _fill_book(engine, orders):
+    return [engine.insert_order('maker', 'BENCH', price, volume, side, ORDER_TYPE_LIMIT).order_id
+            for price, volume, side in orders]
+
+
+def _new_engine(listener=None):
+    engine = MatchingEngine(listener=listener or CountingListener())
+    engine.add_instrument('BENCH', TICK_SIZE)
+    return engine
+
+
+def bench_passive(rng, n):
+    engine = _new_engine()
+    orders = _passive_orders(rng, n)
+    start = time.perf_counter()
+    _fill_book(engine, orders)
+    return time.perf_counter() - start
+
+
+def bench_cancel(rng, n):
+    engine = _new_engine()
+    order_ids = _fill_book(engine, _passive_orders(rng, n))
+    rng.shuffle(order_ids)
+    start = time.perf_counter()
+    for order_id in order_ids:
+        engine.delete_order('maker', 'BENCH', order_id)
+    return time.perf_counter() - start
+
+
+def bench_amend(rng, n):
+    engine = _new_engine()
+    order_ids = _fill_book(engine, [(price, 100, side) for price, _, side in _passive_orders(rng, n)])
+    rng.shuffle(order_ids)
+    start = time.perf_counter()
+    for order_id in order_ids:
+        engine.amend_order('maker', 'BENCH', order_id, 50)
+    return time.perf_counter() - start
+
+
+def _bench_match(rng, n, listener):
+    engine = _new_engine(listener)
+    # plenty of small orders on every level, so that every IOC trades against a few of them
+    _fill_book(engine, [(price, 5, side) for price, _, side in _passive_orders(rng, 4 * n)])
+    aggressors = []
+    for _ in range(n):
+        side = rng.choice((SIDE_BID, SIDE_ASK))
+        aggressors.append((_price(MID_TICK + NR_LEVELS if side == SIDE_BID else MID_TICK - NR_LEVELS),
+                           rng.randint(5, 15), side))
+    start = time.perf_counter()
+    for price, volume, side in aggressors:
+        engine.insert_order('taker', 'BENCH', price, volume, side, ORDER_TYPE_IOC)
+    return time.perf_counter() - start
+
+
+def bench_match(rng, n):
+    return _bench_match(rng, n, CountingListener())
+
+
+def bench_match_quiet(rng, n):
+    # orders, trades and trade ticks that nobody listens to are not built
+    return _bench_match(rng, n, MatchingEngineListener())
+
+
+def bench_mixed(rng, n):
+    engine = _new_engine()
+    order_ids = _fill_book(engine, _passive_orders(rng, 1000))
+    requests = []
+    for price, volume, side in _passive_orders(rng, n):
+        kind = rng.random()
+        if kind < 0.4:
+            requests.append(('insert', price, volume, side))
+        elif kind < 0.6:
+            requests.append(('amend',))
+        elif kind < 0.9:
+            requests.append(('delete',))
+        else:
+            requests.append(('ioc', _price(MID_TICK + 3 if side == SIDE_BID else MID_TICK - 3), volume, side))
+
+    start = time.perf_counter()
+    for request in requests:
+        kind = request[0]
+        if kind == 'insert':
+            order_ids.append(engine.insert_order('maker', 'BENCH', request[1], request[2], request[3],
+                                                 ORDER_TYPE_LIMIT).order_id)
+        elif kind == 'amend':
+            if order_ids:
+                engine.amend_order('maker', 'BENCH', order_ids[rng.randrange(len(order_ids))], 1)
+        elif kind == 'delete':
+            if order_ids:
+                i = rng.randrange(len(order_ids))
+                order_ids[i], order_ids[-1] = order_ids[-1], order_ids[i]
+                engine.delete_order('maker', 'BENCH', order_ids.pop())
+        else:
+            engine.insert_order('taker', 'BENCH', request[1], request[2], request[3], ORDER_TYPE_IOC)
+        engine.get_price_book('BENCH')
+    return time.perf_counter() - start
+
+
+BENCHMARKS = {
+    'passive': bench_passive,
+    'cancel': bench_cancel,
+    'amend': bench_amend,
+    'match': bench_match,
+    'match_quiet': bench_match_quiet,
+    'mixed': bench_mixed,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--operations', type=int, default=100000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for name, bench in BENCHMARKS.items():
+        best = min(bench(random.Random(seed), args.operations) for seed in range(args.repeats))
+        print(f'{name:<12} {args.operations / best:12,.0f} ops/s')
+
+
+if __name__ == '__main__':
+    main()
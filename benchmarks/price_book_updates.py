@@ -0,0 +1,58 @@
+"""
+Measures the cost of handling price book updates in InfoClient, with eager and lazy PriceBook materialization.
+
+Books are read every --read-every updates, to mimic a strategy that only looks at the book periodically.
+
+Run from the repository root:
+
+    python -m benchmarks.price_book_updates [--messages N] [--instruments N] [--read-every N]
+"""
+import argparse
+import asyncio
+import logging
+import time
+import tracemalloc
+
+from optibook.exchange_client import InfoClient
+
+from ._feed import make_feed_frames, feed_info_client
+
+
+async def _run(lazy, frames, instrument_ids, read_every):
+    client = InfoClient(lazy_price_books=lazy)
+    start = time.perf_counter()
+    for i in range(0, len(frames), read_every):
+        await feed_info_client(client, frames[i:i + read_every])
+        for instrument_id in instrument_ids:
+            book = client.get_last_price_book(instrument_id)
+            if book and book.bids:
+                book.bids[0].price
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    client = InfoClient(lazy_price_books=lazy)
+    await feed_info_client(client, frames)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--instruments', type=int, default=40)
+    parser.add_argument('--read-every', type=int, default=1000)
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    frames = make_feed_frames(args.messages, nr_instruments=args.instruments, price_book_ratio=1.0)
+    instrument_ids = [f'INSTRUMENT_{i}' for i in range(args.instruments)]
+
+    for lazy in [False, True]:
+        duration, retained = asyncio.run(_run(lazy, frames, instrument_ids, args.read_every))
+        print(f'{"lazy" if lazy else "eager":<6} {duration / len(frames) * 1e6:7.2f}us per update, '
+              f'{retained / args.instruments:8.0f} bytes retained per instrument')
+
+
+if __name__ == '__main__':
+    main()
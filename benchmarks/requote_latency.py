@@ -0,0 +1,75 @@
+"""
+Measures how long it takes to place a ladder of orders from a strategy thread, one insert_order call per order
+versus a single insert_orders batch, against a local stand-in ExecPortal.
+
+Both go through SynchronousWrapper.run_on_loop like the Exchange methods do.
+
+Run from the repository root:
+
+    python -m benchmarks.requote_latency [--repeats N]
+"""
+import argparse
+import logging
+import statistics
+import threading
+import time
+
+from optibook.exchange_client import ExecClient, ORDER_TYPE_LIMIT, SIDE_ASK, SIDE_BID
+from optibook.synchronous_wrapper import SynchronousWrapper
+
+from ._standin import start_standin_exec_server
+
+LADDER_SIZES = [2, 8, 32]
+
+
+def _ladder(nr_orders):
+    return [
+        dict(instrument_id='BENCH', price=100.0 + (1 if i % 2 else -1) * (1 + i // 2) * 0.1, volume=1,
+             side=SIDE_ASK if i % 2 else SIDE_BID, order_type=ORDER_TYPE_LIMIT)
+        for i in range(nr_orders)
+    ]
+
+
+def _time_ms(f, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    process, port = start_standin_exec_server()
+    try:
+        client = ExecClient(host='127.0.0.1', port=port, username='bench', password='bench')
+        wrapper = SynchronousWrapper([client])
+        threading.Thread(target=wrapper.get_loop().run_forever, daemon=True).start()
+        wrapper.run_on_loop(client.connect())
+
+        for nr_orders in LADDER_SIZES:
+            orders = _ladder(nr_orders)
+
+            def one_by_one():
+                for order in orders:
+                    wrapper.run_on_loop(client.insert_order(**order))
+
+            def batched():
+                wrapper.run_on_loop(client.insert_orders(orders))
+
+            sequential_ms = _time_ms(one_by_one, args.repeats)
+            batched_ms = _time_ms(batched, args.repeats)
+            print(f'{nr_orders:3} orders: one by one {sequential_ms:7.3f}ms, batched {batched_ms:7.3f}ms')
+
+        wrapper.run_on_loop(client.disconnect())
+    finally:
+        process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+End-to-end benchmark against a local SimulatedExchange: the info feed throughput the client keeps up with, the
+latency from a trade happening on the exchange to its TradeTick being handled, and from there to the reply on an
+order sent in response (tick-to-order).
+
+Run from the repository root:
+
+    python -m benchmarks.tick_to_order [--duration SECONDS] [--taker-rate N]
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from optibook.exchange_client import InfoClient, ExecClient, ORDER_TYPE_IOC, SIDE_BID
+from optibook.idl import common_capnp
+
+from ._standin import start_simulated_exchange
+
+INSTRUMENT_IDS = ['BENCH_A', 'BENCH_B', 'BENCH_C', 'BENCH_D']
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def _report(name, values_ns):
+    values_ms = [v / 1e6 for v in values_ns]
+    print(f'{name:<14} n={len(values_ms):6} median={statistics.median(values_ms):8.3f}ms '
+          f'p99={_percentile(values_ms, 0.99):8.3f}ms max={max(values_ms):8.3f}ms')
+
+
+async def _measure(info_port, exec_port, duration, order_every):
+    info = InfoClient(host='127.0.0.1', port=info_port)
+    exec_client = ExecClient(host='127.0.0.1', port=exec_port, username='bench', password='bench')
+    await info.connect()
+    await exec_client.connect()
+
+    nr_messages = 0
+    feed_latencies_ns = []
+    tick_to_order_ns = []
+    pending = set()
+
+    def count(msg):
+        nonlocal nr_messages
+        nr_messages += 1
+
+    async def respond(traded_at_ns):
+        # an order that does not trade, only the round trip is of interest
+        await exec_client.insert_order(instrument_id=INSTRUMENT_IDS[0], price=0.1, volume=1, side=SIDE_BID,
+                                       order_type=ORDER_TYPE_IOC)
+        tick_to_order_ns.append(time.time_ns() - traded_at_ns)
+
+    def on_trade_tick(tick):
+        now = time.time_ns()
+        feed_latencies_ns.append(now - tick.timestamp)
+        if len(feed_latencies_ns) % order_every == 0:
+            task = asyncio.ensure_future(respond(tick.timestamp))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+    info.add_message_callback(count)
+    info.add_message_handler(common_capnp.TradeTick, on_trade_tick)
+
+    await asyncio.sleep(duration)
+    if pending:
+        await asyncio.wait(pending)
+    await exec_client.disconnect()
+    await info.disconnect()
+    return nr_messages, feed_latencies_ns, tick_to_order_ns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--taker-rate', type=float, default=500.0, help='taker orders per second per instrument')
+    parser.add_argument('--order-every', type=int, default=10, help='respond to every n-th trade tick with an order')
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    process, info_port, exec_port = start_simulated_exchange(INSTRUMENT_IDS, flow_interval=0.01,
+                                                             taker_rate=args.taker_rate, seed=42)
+    try:
+        nr_messages, feed_latencies, tick_to_order = asyncio.run(
+            _measure(info_port, exec_port, args.duration, args.order_every))
+    finally:
+        process.terminate()
+
+    print(f'info feed: {nr_messages / args.duration:,.0f} messages/s')
+    _report('tick feed', feed_latencies)
+    _report('tick-to-order', tick_to_order)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,11 @@ import logging
 from math import sqrt
 import statistics
 import time
-from optibook import ORDER_TYPE_LIMIT, SIDE_ASK, SIDE_BID
-from optibook.exchange_responses import InsertOrderResponse
+from optibook import SIDE_ASK, SIDE_BID
 from optibook.synchronous_client import Exchange
 from collections import defaultdict
 from functools import reduce
+import heapq
 import colors
 from helper import color_pm_float, color_pm_int
 
@@ -57,19 +57,12 @@ class TradingAlgorithm:
 
         self.theo, self.margin = self.compute_market_book()
         self.volume_curve = [2, 8, 16, 32]
+        self.target_quotes = {}
 
     def place_order(self, instrument_id, price, volume, side):
-        bid_response: InsertOrderResponse = self.exchange.insert_order(
-            instrument_id,
-            price=price,
-            side=(SIDE_BID if side == "bid" else SIDE_ASK),
-            volume=volume,
-            order_type=ORDER_TYPE_LIMIT,  # add fill-kill
+        self.target_quotes[instrument_id].append(
+            (price, volume, SIDE_BID if side == "bid" else SIDE_ASK)
         )
-        if not bid_response.success:
-            logging.info(
-                f"{colors.RED} Unable to insert order: {bid_response.success}{colors.END}"
-            )
 
     def place_quotes_levels(self, instrument_id, initial_level, side):
         for steps, level_volume in enumerate(self.volume_curve):
@@ -113,11 +106,14 @@ class TradingAlgorithm:
             discount = (1 - alpha) ** el.volume
             return discount * acc + (1 - discount) * el.price
 
-        ticks = self.exchange.get_trade_tick_history(
-            "SMALL_CHIPS"
-        ) + self.exchange.get_trade_tick_history("SMALL_CHIPS_NEW_COUNTRY")
-
-        ticks.sort(key=lambda x: x.timestamp)
+        # the last ticks of each instrument, so that a busy one does not crowd the other out of the window
+        ticks = list(
+            heapq.merge(
+                self.exchange.get_trade_tick_history("SMALL_CHIPS"),
+                self.exchange.get_trade_tick_history("SMALL_CHIPS_NEW_COUNTRY"),
+                key=lambda x: x.timestamp,
+            )
+        )
         prices = list(map(lambda x: x.price, ticks))
         mean, stdev = statistics.mean(prices), statistics.stdev(prices)
         exemplars = list(filter(lambda x: abs(mean - x.price) <= 2 * stdev, ticks))
@@ -158,16 +154,13 @@ class TradingAlgorithm:
         logging.info(own_trades)
 
     def update_market_state(self):
-        self.positions = self.exchange.get_positions()
-        self.prev_pnl, self.pnl = self.pnl, self.exchange.get_pnl()
+        snapshot = self.exchange.get_snapshot(self.instruments)
+        self.positions = snapshot.positions
+        self.prev_pnl, self.pnl = self.pnl, snapshot.pnl
 
-        tradable_instruments = self.exchange.get_instruments()
         for instrument_id in self.instruments:
-            self.book[instrument_id] = self.exchange.get_last_price_book(instrument_id)
-            self.is_trading[instrument_id] = (
-                instrument_id in tradable_instruments
-                and not tradable_instruments[instrument_id].paused
-            )
+            self.book[instrument_id] = snapshot.price_books[instrument_id]
+            self.is_trading[instrument_id] = snapshot.tradable[instrument_id]
 
             self.own_trades[instrument_id] = self.exchange.poll_new_trades(
                 instrument_id
@@ -247,9 +240,8 @@ class TradingAlgorithm:
 
     def send_orders(self):
 
-        # this will be removed eventually
-        for instrument_id in self.instruments:
-            self.exchange.delete_orders(instrument_id)
+        # orders not placed again below are deleted by update_quotes
+        self.target_quotes = {instrument_id: [] for instrument_id in self.instruments}
 
         if self.is_trading["SMALL_CHIPS_NEW_COUNTRY"]:
             bids = self.book["SMALL_CHIPS_NEW_COUNTRY"].bids
@@ -333,6 +325,15 @@ class TradingAlgorithm:
                 f"{colors.BEIGE2}SMALL CHIP z-edges are {((edge_ask - self.sample_mean)/self.sample_stdev):.2f} {((edge_bid - self.sample_mean)/self.sample_stdev):.2f}{colors.END} {colors.GREY}(μ={self.sample_mean:.2f},σ={self.sample_stdev:.2f}){colors.END}"
             )
 
+        report = self.exchange.update_quotes(self.target_quotes)
+        if report.nr_failed:
+            logging.info(
+                f"{colors.RED} Unable to update {report.nr_failed} orders{colors.END}"
+            )
+        logging.debug(
+            f"{colors.GREY}{report.nr_rpcs} order requests, {report.nr_rpcs_saved} saved{colors.END}"
+        )
+
     def run(self):
         if not self.exchange.is_connected():
             logging.error(f"{colors.RED}Exchange not connected.{colors.END}")
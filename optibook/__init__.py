@@ -5,3 +5,4 @@ capnp.create_event_loop(threaded=True)
 from .synchronous_client import Exchange
 from .exchange_client import InfoClient, ExecClient
 from .exchange_client import ORDER_TYPE_IOC, ORDER_TYPE_LIMIT, SIDE_ASK, SIDE_BID
+from .base_client import PUMP_MODE_EVENT, PUMP_MODE_POLL
@@ -0,0 +1,369 @@
+"""
+Runs a strategy written against the synchronous Exchange on a replayed feed instead of a live exchange.
+
+A BacktestExchange has the interface of Exchange, but is backed by a MatchingEngine and a virtual clock. The strategy
+calls it like a live exchange and advances the clock where it would otherwise sleep:
+
+    exchange = BacktestExchange(instruments, feed)
+    bot = TradingAlgorithm(exchange)
+    while exchange.advance(0.3):
+        bot.run()
+
+Nothing waits for real time, so a day of market data replays in seconds, and the same feed always gives the same
+result.
+
+The feed is a time-ordered iterable of PriceBook and TradeTick, e.g. a recorded session or synthetic_feed(). The
+engine holds the recorded market as the orders of RECORDED_MARKET, replaced by every recorded PriceBook, next to the
+orders of the strategy:
+
+- Orders of the strategy that cross the recorded book trade against it, at the prices of the book.
+- A recorded PriceBook that crosses orders of the strategy trades with them, as if the market moved through them.
+- A recorded TradeTick also trades with the orders of the strategy at its price or better, up to its volume, before it
+  is published. The strategy's orders are assumed to be first in the queue at their price, so this is the optimistic
+  side of the fills the strategy could have had.
+
+The market does not react to the strategy: liquidity the strategy takes out comes back with the next recorded book.
+"""
+import concurrent.futures
+import itertools
+import random
+import types
+import typing
+from datetime import datetime, timedelta
+
+from .common_types import PriceBook, CompactPriceBook, TradeTick, OrderStatus, Trade, Instrument
+from .exchange_client import InfoClient, ExecClient, SIDE_BID, SIDE_ASK, ORDER_TYPE_LIMIT, ORDER_TYPE_IOC
+from .exchange_responses import InsertOrderResponse, AmendOrderResponse, DeleteOrderResponse
+from .latency import LatencyHistogram
+from .matching_engine import MatchingEngine, MatchingEngineListener, DEFAULT_BOOK_DEPTH
+from .quote_manager import QuoteManager, QuoteUpdateReport, PRICE_DECIMALS
+from .feed_file import FeedEvent, _to_ns
+from .state_snapshot import StateSequence
+from .simulated_exchange import SyntheticOrderFlow
+from .synchronous_client import Exchange
+
+RECORDED_MARKET = 'recorded_market'
+RECORDED_TAKER = 'recorded_taker'
+
+# trades made in the backtest are numbered from here, apart from the trade ids of the feed
+BACKTEST_FIRST_TRADE_ID = 1 << 48
+
+def _done_future(result, callback) -> concurrent.futures.Future:
+    fut = concurrent.futures.Future()
+    fut.set_result(result)
+    if callback is not None:
+        fut.add_done_callback(callback)
+    return fut
+
+
+class BacktestExchange(Exchange, MatchingEngineListener):
+    def __init__(self,
+                 instruments: typing.Sequence[Instrument],
+                 feed: typing.Iterable[FeedEvent],
+                 *,
+                 username: str = 'backtest',
+                 max_nr_trade_history: int = 100,
+                 book_depth: int = DEFAULT_BOOK_DEPTH):
+        """
+        Parameters
+        ----------
+        instruments: typing.Sequence[Instrument]
+            The instruments of the feed, as returned by get_instruments.
+        feed: typing.Iterable[FeedEvent]
+            The PriceBook and TradeTick events to replay, oldest first.
+        username: str
+            The owner of the orders of the strategy.
+        max_nr_trade_history: int
+            See Exchange.
+        book_depth: int
+            The number of levels per side in the price books returned by get_last_price_book.
+        """
+        # no connection and no event loop: the clients only keep the state, fed from the engine below
+        self._state_sequence = StateSequence()
+        self._i = InfoClient(max_nr_trade_history=max_nr_trade_history, state_sequence=self._state_sequence)
+        self._e = ExecClient(username=username, password=username, max_nr_trade_history=max_nr_trade_history,
+                             state_sequence=self._state_sequence)
+        self._wrapper = None
+        self._merged_trade_tick_histories = set()
+        self._quote_manager = QuoteManager(self._e)
+        self._username = username
+        self._exec_feed = ExecClient.ExecSubscription(self._e)
+
+        self._feed = iter(feed)
+        self._next_event = next(self._feed, None)
+        self._now_ns = _to_ns(self._next_event.timestamp) if self._next_event is not None else 0
+        self._recorded_books: typing.Dict[str, PriceBook] = {}
+        self._replayed_volume = 0
+        # trades of the strategy, the trade history only keeps the last max_nr_trade_history
+        self.nr_trades = 0
+
+        self.engine = MatchingEngine(listener=self, clock=lambda: self._now_ns, book_depth=book_depth,
+                                     first_trade_id=BACKTEST_FIRST_TRADE_ID)
+        for instrument in instruments:
+            self.engine.add_instrument(instrument.instrument_id, instrument.tick_size)
+            self._i._instruments[instrument.instrument_id] = instrument
+        # like the login reply of the exchange, every instrument starts with a flat position
+        self._e._position_accountant.reset(positions=[
+            types.SimpleNamespace(instrumentId=instrument.instrument_id, position=0, cash=0.0)
+            for instrument in instruments])
+
+    # virtual clock
+
+    def now(self) -> datetime:
+        """
+        Returns the current time of the backtest.
+        """
+        return datetime.fromtimestamp(self._now_ns / 1000000000)
+
+    def advance(self, seconds: float) -> bool:
+        """
+        Moves the virtual clock forward by seconds, replaying every event of the feed up to the new time. Call this
+        where the strategy would sleep.
+
+        Parameters
+        ----------
+        seconds: float
+            The time to move forward.
+
+        Returns
+        -------
+        bool
+            False once the feed is exhausted.
+        """
+        until_ns = self._now_ns + int(seconds * 1000000000)
+        event = self._next_event
+        while event is not None:
+            event_ns = _to_ns(event.timestamp)
+            if event_ns > until_ns:
+                break
+            self._now_ns = max(self._now_ns, event_ns)
+            self._replay(event)
+            event = self._next_event = next(self._feed, None)
+        self._now_ns = until_ns
+        return event is not None
+
+    def _replay(self, event: FeedEvent) -> None:
+        if isinstance(event, PriceBook):
+            self._recorded_books[event.instrument_id] = event
+            self._apply_recorded_book(event.instrument_id)
+        elif isinstance(event, TradeTick):
+            self._replay_trade_tick(event)
+        else:
+            raise Exception(f"Unsupported feed event {event}")
+
+    def _apply_recorded_book(self, instrument_id: str) -> None:
+        # most levels are the same as in the previous book, only the ones that changed are touched
+        engine = self.engine
+        outstanding = {(order.side, round(order.price, PRICE_DECIMALS)): order
+                       for order in engine.get_outstanding_orders(RECORDED_MARKET, instrument_id).values()}
+        book = self._recorded_books.get(instrument_id, None)
+        amends, inserts = [], []
+        for side, levels in ((SIDE_BID, book.bids), (SIDE_ASK, book.asks)):
+            for level in levels:
+                order = outstanding.pop((side, round(level.price, PRICE_DECIMALS)), None)
+                if order is not None:
+                    if order.volume == level.volume:
+                        continue
+                    if order.volume > level.volume:
+                        amends.append((order.order_id, level.volume))
+                        continue
+                    outstanding[(side, None, order.order_id)] = order
+                inserts.append((level.price, level.volume, side))
+
+        # levels that are gone go first, so that the new book does not trade with the old one
+        for order in outstanding.values():
+            engine.delete_order(RECORDED_MARKET, instrument_id, order.order_id)
+        for order_id, volume in amends:
+            engine.amend_order(RECORDED_MARKET, instrument_id, order_id, volume)
+        for price, volume, side in inserts:
+            engine.insert_order(RECORDED_MARKET, instrument_id, price, volume, side, ORDER_TYPE_LIMIT)
+
+    def _reaches_own_orders(self, tick: TradeTick) -> bool:
+        if tick.aggressor_side == SIDE_BID:
+            return any(order.side == SIDE_ASK and order.price <= tick.price
+                       for order in self._e._order_status_by_order_id[tick.instrument_id].values())
+        return any(order.side == SIDE_BID and order.price >= tick.price
+                   for order in self._e._order_status_by_order_id[tick.instrument_id].values())
+
+    def _replay_trade_tick(self, tick: TradeTick) -> None:
+        instrument_id = tick.instrument_id
+        volume = tick.volume
+        if self._reaches_own_orders(tick):
+            # without the recorded market in the way, the taker of the tick reaches the orders of the strategy only
+            self.engine.delete_orders(RECORDED_MARKET, instrument_id)
+            self._replayed_volume = 0
+            self.engine.insert_order(RECORDED_TAKER, instrument_id, tick.price, volume, tick.aggressor_side,
+                                     ORDER_TYPE_IOC)
+            volume -= self._replayed_volume
+            if instrument_id in self._recorded_books:
+                self._apply_recorded_book(instrument_id)
+        if volume > 0:
+            self._publish_trade_tick(tick.timestamp, instrument_id, tick.price, volume, tick.aggressor_side,
+                                     tick.buyer, tick.seller, tick.trade_id)
+
+    def _publish_trade_tick(self, timestamp: datetime, instrument_id: str, price: float, volume: int,
+                            aggressor_side: str, buyer: str, seller: str, trade_id: int) -> None:
+        self._i.onTradeTick(types.SimpleNamespace(timestamp=_to_ns(timestamp), instrumentId=instrument_id,
+                                                  price=price, volume=volume, aggressorSide=aggressor_side,
+                                                  buyer=buyer, seller=seller, tradeId=trade_id))
+        self._e.mark(instrument_id, price)
+
+    # MatchingEngineListener, in place of the info and exec feeds
+
+    def on_order_update(self, owner: str, order: OrderStatus) -> None:
+        if owner == self._username:
+            self._exec_feed.onOrderUpdate(types.SimpleNamespace(orderId=order.order_id,
+                                                                instrumentId=order.instrument_id, price=order.price,
+                                                                volume=order.volume, side=order.side))
+
+    def on_trade(self, owner: str, trade: Trade) -> None:
+        if owner == self._username:
+            self.nr_trades += 1
+            self._exec_feed.onTrade(types.SimpleNamespace(timestamp=_to_ns(trade.timestamp), orderId=trade.order_id,
+                                                          tradeId=trade.trade_id, instrumentId=trade.instrument_id,
+                                                          price=trade.price, volume=trade.volume, side=trade.side))
+
+    def on_trade_tick(self, trade_tick: TradeTick) -> None:
+        if RECORDED_TAKER in (trade_tick.buyer, trade_tick.seller):
+            self._replayed_volume += trade_tick.volume
+        if trade_tick.buyer == trade_tick.seller:
+            # the recorded market crossing itself while being replaced
+            return
+        self._publish_trade_tick(trade_tick.timestamp, trade_tick.instrument_id, trade_tick.price, trade_tick.volume,
+                                 trade_tick.aggressor_side, trade_tick.buyer, trade_tick.seller, trade_tick.trade_id)
+
+    # Exchange
+
+    def is_connected(self) -> bool:
+        return True
+
+    def connect(self) -> None:
+        pass
+
+    def disconnect(self) -> None:
+        pass
+
+    def insert_order(self,
+                     instrument_id: str,
+                     *,
+                     price: float,
+                     volume: int,
+                     side: str,
+                     order_type: str = ORDER_TYPE_LIMIT) -> InsertOrderResponse:
+        return self.engine.insert_order(self._username, instrument_id, price, volume, side, order_type)
+
+    def amend_order(self, instrument_id: str, *, order_id: int, volume: int) -> AmendOrderResponse:
+        return self.engine.amend_order(self._username, instrument_id, order_id, volume)
+
+    def delete_order(self, instrument_id: str, *, order_id: int) -> DeleteOrderResponse:
+        return self.engine.delete_order(self._username, instrument_id, order_id)
+
+    def delete_orders(self, instrument_id: str) -> None:
+        self.engine.delete_orders(self._username, instrument_id)
+
+    def insert_orders(self, orders: typing.Sequence[typing.Dict[str, typing.Any]]) -> typing.List[InsertOrderResponse]:
+        return [self.insert_order(**order) for order in orders]
+
+    def amend_orders(self, orders: typing.Sequence[typing.Dict[str, typing.Any]]) -> typing.List[AmendOrderResponse]:
+        return [self.amend_order(order['instrument_id'], order_id=order['order_id'], volume=order['volume'])
+                for order in orders]
+
+    def delete_orders_by_id(self, orders: typing.Sequence[typing.Dict[str, typing.Any]]) -> typing.List[DeleteOrderResponse]:
+        return [self.delete_order(order['instrument_id'], order_id=order['order_id']) for order in orders]
+
+    def update_quotes(self, targets: typing.Dict[str, typing.Sequence[typing.Tuple[float, int, str]]]) -> QuoteUpdateReport:
+        plan = self._quote_manager.plan(targets)
+        for instrument_id in plan.delete_alls:
+            self.delete_orders(instrument_id)
+        return self._quote_manager.apply(plan, self.delete_orders_by_id(plan.deletes), self.amend_orders(plan.amends),
+                                         self.insert_orders(plan.inserts))
+
+    def insert_order_async(self, instrument_id: str, *, price: float, volume: int, side: str,
+                           order_type: str = ORDER_TYPE_LIMIT, callback=None) -> concurrent.futures.Future:
+        return _done_future(self.insert_order(instrument_id, price=price, volume=volume, side=side,
+                                              order_type=order_type), callback)
+
+    def amend_order_async(self, instrument_id: str, *, order_id: int, volume: int,
+                          callback=None) -> concurrent.futures.Future:
+        return _done_future(self.amend_order(instrument_id, order_id=order_id, volume=volume), callback)
+
+    def delete_order_async(self, instrument_id: str, *, order_id: int, callback=None) -> concurrent.futures.Future:
+        return _done_future(self.delete_order(instrument_id, order_id=order_id), callback)
+
+    def delete_orders_async(self, instrument_id: str, callback=None) -> concurrent.futures.Future:
+        return _done_future(self.delete_orders(instrument_id), callback)
+
+    def get_latency_histograms(self) -> typing.Dict[str, LatencyHistogram]:
+        return {}
+
+    def _ensure_merged_trade_tick_history(self, instrument_ids: typing.Sequence[str]) -> None:
+        self._i.add_merged_trade_tick_history(tuple(instrument_ids))
+
+    def get_last_price_book(self, instrument_id: str) -> PriceBook:
+        if instrument_id not in self._recorded_books:
+            return None
+        return self.engine.get_price_book(instrument_id)
+
+    def get_last_compact_price_book(self, instrument_id: str) -> CompactPriceBook:
+        book = self.get_last_price_book(instrument_id)
+        return None if book is None else CompactPriceBook.from_price_book(book)
+
+
+class _TickCollector(MatchingEngineListener):
+    def __init__(self):
+        self.ticks = []
+
+    def on_trade_tick(self, trade_tick: TradeTick) -> None:
+        self.ticks.append(trade_tick)
+
+
+def synthetic_feed(instruments: typing.Sequence[Instrument],
+                   *,
+                   duration: float,
+                   interval: float = 1.0,
+                   start: datetime = datetime(2021, 1, 1, 9),
+                   seed: int = None,
+                   shared_fair_value: bool = False,
+                   **flow_parameters) -> typing.Iterator[FeedEvent]:
+    """
+    Generates a feed for BacktestExchange from the SyntheticOrderFlow of the simulated exchange, on a virtual clock.
+    Every interval seconds the flow of every instrument takes a step, and its trade ticks and the resulting price book
+    are emitted.
+
+    Parameters
+    ----------
+    instruments: typing.Sequence[Instrument]
+        The instruments to generate the feed for.
+    duration: float
+        The length of the feed in seconds.
+    interval: float
+        Seconds between steps of the order flow.
+    start: datetime
+        The time of the first event.
+    seed: int
+        Seed for the order flow. The same seed gives the same feed.
+    shared_fair_value: bool
+        Let all instruments follow the fair value of the first one, e.g. for a cross-listed pair.
+    flow_parameters
+        Passed on to every SyntheticOrderFlow, e.g. taker_rate=2.0.
+    """
+    now_ns = _to_ns(start)
+    collector = _TickCollector()
+    engine = MatchingEngine(listener=collector, clock=lambda: now_ns)
+    rng = random.Random(seed)
+    flows = []
+    for instrument in instruments:
+        engine.add_instrument(instrument.instrument_id, instrument.tick_size)
+        flows.append(SyntheticOrderFlow(engine, instrument.instrument_id, instrument.tick_size,
+                                        rng=random.Random(rng.random()), **flow_parameters))
+
+    for step in itertools.count():
+        if step * interval > duration:
+            return
+        now_ns = _to_ns(start + timedelta(seconds=step * interval))
+        for flow in flows:
+            flow.step(interval, fair_value=flows[0].fair_value if shared_fair_value and flow is not flows[0] else None)
+        yield from collector.ticks
+        collector.ticks = []
+        for flow in flows:
+            yield engine.get_price_book(flow.instrument_id)
@@ -3,6 +3,8 @@ import logging
 import typing
 import traceback
 import socket
+import struct
+import time
 import capnp
 from .idl import common_capnp
 
@@ -13,14 +15,42 @@ logger = logging.getLogger('client')
 
 TIMEOUT_VAL = 2
 
-def _get_default_settings():
-    from pathlib import Path
-    import json
-    optibook_path = Path.home() / Path('.optibook')
-    if optibook_path.is_file():
-        with optibook_path.open('r') as f:
-            return json.load(f)
-    return {}
+PUMP_MODE_POLL = 'poll'
+PUMP_MODE_EVENT = 'event'
+ALL_PUMP_MODES = [PUMP_MODE_POLL, PUMP_MODE_EVENT]
+
+POLL_INTERVAL = 0.1
+EVENT_PUMP_IDLE_INTERVAL = 1.0
+
+READ_CHUNK_SIZE = 1 << 16
+
+_GENERIC_REPLY_TYPE_ID = common_capnp.GenericReply.schema.node.id
+_FIRST_WORDS = struct.Struct('<II')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+
+# while conflating, read more at once so that a backlog in the socket is conflated in one go
+CONFLATION_READ_SIZE = 1 << 20
+
+_default_settings = None
+
+
+def get_default_settings() -> dict:
+    """
+    The settings in ~/.optibook, read the first time they are needed: only clients that are not given a host, port,
+    username or password use them.
+    """
+    global _default_settings
+    if _default_settings is None:
+        from pathlib import Path
+        import json
+        optibook_path = Path.home() / Path('.optibook')
+        if optibook_path.is_file():
+            with optibook_path.open('r') as f:
+                _default_settings = json.load(f)
+        else:
+            _default_settings = {}
+    return _default_settings
 
 
 def logger_decorator(func):
@@ -33,21 +63,29 @@ def logger_decorator(func):
     return wrapper
 
 
-_default_settings = _get_default_settings()
 
 class Client:
-    def __init__(self, host, port):
+    def __init__(self, host, port, pump_mode=PUMP_MODE_EVENT):
+        assert pump_mode in ALL_PUMP_MODES, f'pump_mode must be one of {ALL_PUMP_MODES}'
         self._host = host
         self._port = port
-        self._has_connected = False # We do not support re-connection, ensures we can only connect once
+        self._pump_mode = pump_mode
+        self._has_connected = False # connect only works once, a lost connection is restored with reconnect
         self.reset_data()
 
     def reset_data(self):
+        self._reset_connection()
+
+    def _reset_connection(self):
+        # the state of one connection, the data of the client survives a reconnect
         self._task = None
         self._socket = None
         self._client = None
         self._connected = False
         self._dcp = None
+        self._reader_fd = None
+        self._disconnected = None
+        self._flush_scheduled = False
 
     async def connect(self, loop=None):
         if not self._host or not self._port:
@@ -61,30 +99,123 @@ class Client:
         if self.is_connected():
             raise Exception("You are already connected")
         self.reset_data()
+        await self._open(loop)
 
+    async def reconnect(self, loop=None):
+        """
+        Connects again after the connection was lost, keeping the data of the client.
+        """
+        if not loop:
+            loop = asyncio.get_event_loop()
+        if self.is_connected():
+            raise Exception("You are already connected")
+        self._close_connection()
+        self._reset_connection()
+        try:
+            await self._open(loop)
+        except BaseException:
+            # a half opened connection would pass for a connected one, the next attempt starts over
+            self._close_connection()
+            raise
+
+    def _close_connection(self):
+        # whatever is left of a connection that was lost, or of an attempt that failed halfway
+        self._connected = False
+        self._remove_reader()
+        if self._socket is not None:
+            self._socket.close()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _open(self, loop):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((self._host, self._port))
+        # connect without blocking the loop, so that the other clients keep running and a timeout can interrupt it
+        self._socket.setblocking(False)
+        await loop.sock_connect(self._socket, (self._host, self._port))
+        self._socket.setblocking(True)
+        # exec messages are small, do not let Nagle hold them back
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self._client = capnp.TwoPartyClient(self._socket)
         self._connected = True
+        self._loop = loop
+        disconnected = self._disconnected = loop.create_future()
 
         def on_dc(*args, **kwargs):
-            self._connected = False
+            # after a reconnect, the connection that was lost may still report its end
+            if self._disconnected is disconnected:
+                self._connected = False
+            if not disconnected.done():
+                disconnected.set_result(None)
 
         self._dcp = self._client.on_disconnect().then(on_dc)
 
+        if self._pump_mode == PUMP_MODE_EVENT:
+            # pump the capnp event loop whenever the socket has data, instead of on a fixed interval
+            self._reader_fd = self._socket.fileno()
+            loop.add_reader(self._reader_fd, self._pump)
+
         await self._on_connected()
 
         self._task = loop.create_task(self._run())
-        self._loop = loop
         self._has_connected = True
 
     async def _on_connected(self):
         pass
 
     async def _run(self):
-        while self.is_connected():
-            capnp.poll_once()
-            await asyncio.sleep(0.1)
+        if self._pump_mode == PUMP_MODE_POLL:
+            while self.is_connected():
+                capnp.poll_once()
+                await asyncio.sleep(POLL_INTERVAL)
+            return
+
+        try:
+            while self.is_connected():
+                # the socket reader does the actual work, this only catches events not tied to socket activity
+                capnp.poll_once()
+                await asyncio.wait([self._disconnected], timeout=EVENT_PUMP_IDLE_INTERVAL)
+        finally:
+            self._remove_reader()
+
+    def _pump(self):
+        capnp.poll_once()
+        if not self._connected:
+            self._remove_reader()
+
+    def _flush(self):
+        self._flush_scheduled = False
+        capnp.poll_once()
+
+    def _remove_reader(self):
+        if self._reader_fd is not None:
+            self._loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+
+    async def _wait(self, promise):
+        if self._pump_mode == PUMP_MODE_POLL:
+            return await promise.a_wait()
+
+        fut = self._loop.create_future()
+
+        def on_result(result):
+            if not fut.done():
+                fut.set_result(result)
+
+        def on_error(exc):
+            if not fut.done():
+                fut.set_exception(exc)
+
+        # keep a reference to the continuation, capnp cancels it once it is garbage collected
+        pending = promise.then(on_result, on_error)
+        # flush the outgoing request soon, together with any other requests made in this iteration of the loop. The
+        # reply is picked up by the socket reader
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+        try:
+            return await fut
+        finally:
+            del pending
 
     def is_connected(self):
         if self._socket is None:
@@ -96,6 +227,10 @@ class Client:
         return self._connected
 
     async def disconnect(self):
+        self._remove_reader()
+        if self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(None)
+
         if self.is_connected():
             self._socket.shutdown(socket.SHUT_RDWR)
             self._socket.close()
@@ -111,16 +246,212 @@ class Client:
             asyncio.ensure_future(f, loop=self._loop)
 
 
+class FrameDecoder:
+    """
+    Splits a byte stream of capnp messages, as sent over the raw info connection, into frames.
+
+    Received data is copied into one reusable buffer and complete frames are handed out as memoryviews into that buffer,
+    so they can be read by capnp without further copies. A frame is only valid until the next call to feed().
+    """
+    def __init__(self, initial_capacity: int = 4 * READ_CHUNK_SIZE):
+        self._buf = bytearray(initial_capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def pending_bytes(self) -> bytes:
+        return bytes(self._view[self._start:self._end])
+
+    def feed(self, data) -> None:
+        nr_bytes = len(data)
+        if self._end + nr_bytes > len(self._buf):
+            self._make_room(nr_bytes)
+        self._buf[self._end:self._end + nr_bytes] = data
+        self._end += nr_bytes
+
+    def _make_room(self, nr_bytes):
+        # frames handed out earlier may still reference the buffer, so it is never resized, only replaced
+        pending = self._end - self._start
+        if pending + nr_bytes > len(self._buf):
+            buf = bytearray(max(2 * len(self._buf), pending + nr_bytes))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        else:
+            # the ranges may overlap, so go through a copy
+            self._buf[:pending] = self._view[self._start:self._end].tobytes()
+        self._start = 0
+        self._end = pending
+
+    def frames(self) -> typing.Iterator[memoryview]:
+        buf = self._buf
+        view = self._view
+        end = self._end
+        pos = self._start
+        while end - pos >= 8:
+            nr_segments, first_segment_size = _FIRST_WORDS.unpack_from(buf, pos)
+            nr_segments += 1
+            if nr_segments == 1:
+                size = 8 + first_segment_size * 8
+            else:
+                # the segment table is padded to a whole number of words
+                header_size = (4 + nr_segments * 4 + 7) & ~7
+                if end - pos < header_size:
+                    break
+                size = header_size + sum(struct.unpack_from(f'<{nr_segments}I', buf, pos + 4)) * 8
+            if end - pos < size:
+                break
+            pos += size
+            self._start = pos
+            yield view[pos - size:pos]
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+
+def _pointer_target(buf, pos: int, pointer: int) -> int:
+    offset = (pointer >> 2) & 0x3fffffff
+    if offset & 0x20000000:
+        offset -= 0x40000000
+    return pos + 8 + offset * 8
+
+
+def read_instrument_id(buf, start: int, end: int, type_ids: typing.Container[int]
+                       ) -> typing.Optional[typing.Tuple[int, bytes]]:
+    """
+    Reads the message type and the raw instrument id of a RawMessage frame by following the capnp pointers by hand,
+    about three times cheaper than decoding it with pycapnp. Only messages of the types in type_ids are assumed to
+    carry an instrument id, as their first pointer field. Returns None for what it does not handle, e.g. messages of
+    several segments; the id is empty for messages without one.
+    """
+    if end - start < 32 or _U32.unpack_from(buf, start)[0] != 0:
+        return None
+    root_pos = start + 8
+    root = _U64.unpack_from(buf, root_pos)[0]
+    if root & 3 != 0:
+        return None
+    raw_pos = _pointer_target(buf, root_pos, root)
+    raw_data_words = (root >> 32) & 0xffff
+    if raw_data_words < 1 or (root >> 48) < 1 or raw_pos + raw_data_words * 8 + 8 > end:
+        return None
+    msg_type = _U64.unpack_from(buf, raw_pos)[0]
+    if msg_type not in type_ids:
+        return msg_type, b''
+
+    msg_ptr_pos = raw_pos + raw_data_words * 8
+    msg_ptr = _U64.unpack_from(buf, msg_ptr_pos)[0]
+    if msg_ptr & 3 != 0:
+        return None
+    msg_pos = _pointer_target(buf, msg_ptr_pos, msg_ptr)
+    text_ptr_pos = msg_pos + ((msg_ptr >> 32) & 0xffff) * 8
+    if msg_ptr >> 48 == 0 or text_ptr_pos + 8 > end:
+        return msg_type, b''
+    text_ptr = _U64.unpack_from(buf, text_ptr_pos)[0]
+    if text_ptr == 0:
+        return msg_type, b''
+    if text_ptr & 3 != 1 or (text_ptr >> 32) & 7 != 2:
+        return None
+    text_pos = _pointer_target(buf, text_ptr_pos, text_ptr)
+    # the length includes the terminating NUL
+    length = (text_ptr >> 35) - 1
+    if length < 0 or text_pos + length > end:
+        return None
+    return msg_type, bytes(buf[text_pos:text_pos + length])
+
+
+class ConflationStats(typing.NamedTuple):
+    """
+    Counters of a FrameConflator.
+
+    Attributes
+    ----------
+    nr_frames: int
+        Frames received.
+    nr_conflated: int
+        Frames dropped because a later frame of the same type and instrument arrived before they were handled.
+    queue_depth: int
+        Frames received and not handled yet.
+    max_queue_depth: int
+        The largest number of frames received at once, before conflation.
+    """
+    nr_frames: int
+    nr_conflated: int
+    queue_depth: int
+    max_queue_depth: int
+
+
+class FrameConflator:
+    """
+    Drops frames that are superseded before they are handled, between the FrameDecoder and the message handlers.
+
+    All frames that arrived together are looked at before any of them is handled. Of the frames of a conflated type,
+    e.g. price books, only the latest per instrument is kept, in its own place. All other frames, e.g. trade ticks,
+    are kept, and the order of everything that is kept does not change: a tick that arrived before a book is handled
+    before it.
+
+    The more the handlers fall behind, the more arrives at once, so a burst is conflated instead of queued. Nothing
+    is read from the socket while the handlers run, so when they cannot keep up the sender is held back by TCP.
+    """
+    def __init__(self, conflated_type_ids: typing.Iterable[int]):
+        self._type_ids = frozenset(conflated_type_ids)
+        self.nr_frames = 0
+        self.nr_conflated = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    def stats(self) -> ConflationStats:
+        return ConflationStats(self.nr_frames, self.nr_conflated, self.queue_depth, self.max_queue_depth)
+
+    def conflate(self, frames: typing.List[memoryview]) -> typing.Iterator[memoryview]:
+        nr_frames = len(frames)
+        self.nr_frames += nr_frames
+        if nr_frames > self.max_queue_depth:
+            self.max_queue_depth = nr_frames
+        if nr_frames > 1:
+            type_ids = self._type_ids
+            kept = []
+            # (type, raw instrument id) -> index in kept of the latest frame
+            slots = {}
+            nr_superseded = 0
+            for frame in frames:
+                found = read_instrument_id(frame, 0, len(frame), type_ids)
+                if found is not None and found[0] in type_ids and found[1]:
+                    slot = slots.get(found)
+                    if slot is not None:
+                        kept[slot] = None
+                        nr_superseded += 1
+                    slots[found] = len(kept)
+                kept.append(frame)
+            if nr_superseded:
+                self.nr_conflated += nr_superseded
+                kept = [frame for frame in kept if frame is not None]
+            frames = kept
+
+        remaining = len(frames)
+        for frame in frames:
+            remaining -= 1
+            self.queue_depth = remaining
+            yield frame
+
+
 class RawClient:
-    def __init__(self, host, port):    
+    def __init__(self, host, port, recorder=None):
         self._host = host
         self._port = port
+        # a FeedRecorder that gets every frame received
+        self._recorder = recorder
+        # a FrameConflator between the decoder and the handlers, set by subclasses that conflate
+        self._conflator = None
         self._extra_callbacks_id = 0
         self._extra_callbacks = {}
-        self._has_connected = False # We do not support re-connection, ensures we can only connect once
+        self._has_connected = False # connect only works once, a lost connection is restored with reconnect
         self.reset_data()
 
     def reset_data(self):
+        self._reset_connection()
+
+    def _reset_connection(self):
+        # the state of one connection, the data of the client survives a reconnect
         self._task = None
         self._reader = None
         self._writer = None
@@ -131,7 +462,7 @@ class RawClient:
         c_id = self._extra_callbacks_id
         self._extra_callbacks[c_id] = f
         self._extra_callbacks_id += 1
-        return id
+        return c_id
 
     def remove_message_callback(self, c_id):
         del self._extra_callbacks[c_id]
@@ -139,29 +470,41 @@ class RawClient:
     async def _read(self):
         logger.info(f'start read {self._reader}')
         try:
+            decoder = FrameDecoder()
+            recorder = self._recorder
+            conflator = self._conflator
+            read_size = CONFLATION_READ_SIZE if conflator is not None else READ_CHUNK_SIZE
             while not self._writer.transport.is_closing():
-                nr_segments_b = await self._reader.readexactly(4)
-                nr_segments = int.from_bytes(nr_segments_b, byteorder='little') + 1
-                bytes_to_read = nr_segments * 4
-                if nr_segments % 2 == 0:
-                    bytes_to_read += 4
-                segment_sizes_b = await self._reader.readexactly(bytes_to_read)
-                total_size = 0
-
-                for i in range(nr_segments):
-                    segment_size = int.from_bytes(segment_sizes_b[i*4:(i+1)*4], byteorder='little')
-                    total_size += segment_size * 8
-                all_data = await self._reader.readexactly(total_size)
-                total_msg_buf = nr_segments_b + segment_sizes_b + all_data
-
-                with common_capnp.RawMessage.from_bytes(total_msg_buf) as msg:
-                    if msg.type == common_capnp.GenericReply.schema.node.id:
-                        await self._handle_message_reply(msg.msg.as_struct(common_capnp.GenericReply.schema))
-                    else:
-                        await self._on_message(msg)
-
-                    for f in self._extra_callbacks.values():
-                        f(msg)
+                data = await self._reader.read(read_size)
+                if not data:
+                    raise asyncio.IncompleteReadError(decoder.pending_bytes(), None)
+                decoder.feed(data)
+                if recorder is not None:
+                    # the frames of one read arrived together
+                    received_ns = time.time_ns()
+
+                frames = decoder.frames()
+                if conflator is not None:
+                    # the frames stay valid until the next feed, so the whole batch can be looked at first
+                    frames = list(frames)
+                    if recorder is not None:
+                        # the recording keeps everything that was received
+                        for frame in frames:
+                            recorder.record(frame, received_ns)
+                    frames = conflator.conflate(frames)
+
+                for frame in frames:
+                    if recorder is not None and conflator is None:
+                        recorder.record(frame, received_ns)
+                    with common_capnp.RawMessage.from_bytes(frame) as msg:
+                        if msg.type == _GENERIC_REPLY_TYPE_ID:
+                            await self._handle_message_reply(msg.msg.as_struct(common_capnp.GenericReply.schema))
+                        else:
+                            await self._on_message(msg)
+
+                        if self._extra_callbacks:
+                            for f in self._extra_callbacks.values():
+                                f(msg)
 
         except asyncio.exceptions.IncompleteReadError:
             logger.info('info disconnected due to incomplete read - most likely connection was closed')
@@ -207,8 +550,33 @@ class RawClient:
         if self.is_connected():
             raise Exception("You are already connected")
         self.reset_data()
+        await self._open()
+
+    async def reconnect(self, loop=None):
+        """
+        Connects again after the connection was lost, keeping the data of the client.
+        """
+        if self.is_connected():
+            raise Exception("You are already connected")
+        self._close_connection()
+        self._reset_connection()
+        try:
+            await self._open()
+        except BaseException:
+            # a half opened connection would pass for a connected one, the next attempt starts over
+            self._close_connection()
+            raise
+
+    def _close_connection(self):
+        # whatever is left of a connection that was lost, or of an attempt that failed halfway
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
 
-        self._reader, self._writer = await asyncio.open_connection(self._host, self._port, loop=loop)
+    async def _open(self):
+        self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
         logger.info(f'opened connection')
 
         async def try_run():
@@ -233,6 +601,8 @@ class RawClient:
         return self._writer and not self._writer.transport.is_closing()
 
     async def disconnect(self):
+        if self._recorder is not None:
+            self._recorder.flush()
         if self.is_connected():
             self._writer.close()
             try:
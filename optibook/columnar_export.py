@@ -0,0 +1,341 @@
+"""
+Exports trade ticks and price books to Parquet, for research with numpy, pandas or anything else that reads Arrow.
+
+A dataset is a directory with one table per kind of data, partitioned by instrument and by (UTC) date:
+
+    trade_ticks/instrument_id=PHILIPS_A/date=2021-06-01/part-000.parquet
+    price_books/instrument_id=PHILIPS_A/date=2021-06-01/part-000.parquet
+
+Trade ticks have the columns of TradeTickColumns plus buyer and seller. A price book row is one snapshot: its receive
+time and the top depth levels of each side, bid_price_0, bid_volume_0, ... ask_volume_<depth - 1>; missing levels
+have price NaN and volume 0.
+
+Data is written as it arrives, in row groups of at most row_group_size rows per instrument, so exporting a day never
+holds more than one row group per instrument in memory. The data can come from a recording (export_recording) or
+from a live InfoClient (ColumnarExporter.attach).
+
+Needs numpy and pyarrow, which are not installed with the client: pip install -r requirements-research.txt
+"""
+import os
+import typing
+from array import array
+from datetime import datetime, timezone
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .exchange_client import InfoClient
+from .feed_file import _PRICE_BOOK_TYPE_ID, _TRADE_TICK_TYPE_ID
+from .feed_replay import Timestamp, _as_ns, iter_frames
+from .idl import common_capnp, info_capnp
+from .trade_tick_history import SIDE_CODES
+
+TRADE_TICKS = 'trade_ticks'
+PRICE_BOOKS = 'price_books'
+
+DEFAULT_DEPTH = 5
+DEFAULT_ROW_GROUP_SIZE = 64 * 1024
+
+_NS_PER_DAY = 86400 * 1000000000
+_NAN = float('nan')
+
+_TRADE_TICK_SCHEMA = pa.schema([
+    ('timestamp_ns', pa.int64()),
+    ('price', pa.float64()),
+    ('volume', pa.uint32()),
+    ('aggressor_side', pa.uint8()),
+    ('trade_id', pa.uint64()),
+    ('buyer', pa.dictionary(pa.int32(), pa.string())),
+    ('seller', pa.dictionary(pa.int32(), pa.string())),
+])
+# array typecodes as in TradeTickHistory
+_TYPECODES = {pa.int64(): 'q', pa.float64(): 'd', pa.uint32(): 'I', pa.uint8(): 'B', pa.uint64(): 'Q'}
+
+
+def _price_book_schema(depth: int) -> pa.Schema:
+    fields = [('timestamp_ns', pa.int64())]
+    for side in ('bid', 'ask'):
+        fields += [(f'{side}_price_{level}', pa.float64()) for level in range(depth)]
+        fields += [(f'{side}_volume_{level}', pa.uint32()) for level in range(depth)]
+    return pa.schema(fields)
+
+
+class _Partition:
+    """
+    The rows of one table for one instrument on one day that have not been written yet, and the file they go to.
+    """
+    def __init__(self, path: str, schema: pa.Schema, day: int):
+        self.path = path
+        self.schema = schema
+        self.day = day
+        self.writer = None
+        self.nr_rows = 0
+        # numbers in arrays, strings in lists
+        self.columns = {field.name: [] if pa.types.is_dictionary(field.type) else array(_TYPECODES[field.type])
+                        for field in schema}
+        # price books: per side, the (price, volume) columns of every level
+        self.level_columns = [[(self.columns[f'{side}_price_{level}'], self.columns[f'{side}_volume_{level}'])
+                               for level in range(sum(1 for name in schema.names if name.startswith(side + '_price_')))]
+                              for side in ('bid', 'ask')]
+
+    def to_table(self) -> pa.Table:
+        arrays = []
+        for field in self.schema:
+            column = self.columns[field.name]
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(column, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(np.frombuffer(column, dtype=field.type.to_pandas_dtype()), field.type))
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write(self, compression: str) -> None:
+        if self.nr_rows == 0:
+            return
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression=compression)
+        self.writer.write_table(self.to_table(), row_group_size=self.nr_rows)
+        for name, column in self.columns.items():
+            del column[:]
+        self.nr_rows = 0
+
+    def close(self, compression: str) -> None:
+        self.write(compression)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ColumnarExporter:
+    """
+    Writes trade ticks and price books to a Parquet dataset, see the module documentation. Close it when done, the
+    last row groups and the file footers are only written then:
+
+        with ColumnarExporter('research/2021-06-01') as exporter:
+            exporter.attach(exchange._i)
+            ...
+    """
+    def __init__(self,
+                 directory: str,
+                 *,
+                 depth: int = DEFAULT_DEPTH,
+                 row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+                 compression: str = 'zstd'):
+        """
+        Parameters
+        ----------
+        directory: str
+            The root of the dataset, created if needed. Exporting into an existing dataset adds new files next to the
+            existing ones.
+        depth: int
+            The number of levels per side kept of every price book.
+        row_group_size: int
+            The number of rows per instrument buffered before they are written.
+        compression: str
+            The Parquet compression codec.
+        """
+        self.directory = directory
+        self.depth = depth
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.nr_trade_ticks = 0
+        self.nr_price_books = 0
+
+        self._price_book_schema = _price_book_schema(depth)
+        self._partitions: typing.Dict[typing.Tuple[str, str], _Partition] = {}
+        self._handler_ids: typing.List[typing.Tuple[InfoClient, int]] = []
+
+    def _partition(self, table: str, instrument_id: str, timestamp_ns: int) -> _Partition:
+        day = timestamp_ns // _NS_PER_DAY
+        partition = self._partitions.get((table, instrument_id), None)
+        if partition is not None and partition.day == day:
+            return partition
+        if partition is not None:
+            # the data of an instrument arrives in time order, its previous day is complete
+            partition.close(self.compression)
+
+        date = datetime.fromtimestamp(day * 86400, timezone.utc).date().isoformat()
+        partition_dir = os.path.join(self.directory, table, f'instrument_id={instrument_id}', f'date={date}')
+        number = 0
+        while os.path.exists(os.path.join(partition_dir, f'part-{number:03d}.parquet')):
+            number += 1
+        schema = _TRADE_TICK_SCHEMA if table == TRADE_TICKS else self._price_book_schema
+        partition = _Partition(os.path.join(partition_dir, f'part-{number:03d}.parquet'), schema, day)
+        self._partitions[table, instrument_id] = partition
+        return partition
+
+    def add_trade_tick(self, instrument_id: str, timestamp_ns: int, price: float, volume: int, aggressor_side: str,
+                       trade_id: int, buyer: str, seller: str) -> None:
+        partition = self._partition(TRADE_TICKS, instrument_id, timestamp_ns)
+        columns = partition.columns
+        columns['timestamp_ns'].append(timestamp_ns)
+        columns['price'].append(price)
+        columns['volume'].append(volume)
+        columns['aggressor_side'].append(SIDE_CODES[aggressor_side])
+        columns['trade_id'].append(trade_id)
+        columns['buyer'].append(buyer)
+        columns['seller'].append(seller)
+        partition.nr_rows += 1
+        self.nr_trade_ticks += 1
+        if partition.nr_rows >= self.row_group_size:
+            partition.write(self.compression)
+
+    def add_price_book(self, instrument_id: str, timestamp_ns: int, bids: typing.Sequence,
+                       asks: typing.Sequence) -> None:
+        """
+        Adds a snapshot. The levels are anything with a price and a volume, best first: PriceVolumes, or the levels
+        of a capnp PriceBook.
+        """
+        partition = self._partition(PRICE_BOOKS, instrument_id, timestamp_ns)
+        partition.columns['timestamp_ns'].append(timestamp_ns)
+        for levels, level_columns in zip((bids, asks), partition.level_columns):
+            nr_levels = min(len(levels), self.depth)
+            for level in range(nr_levels):
+                price_volume = levels[level]
+                prices, volumes = level_columns[level]
+                prices.append(price_volume.price)
+                volumes.append(price_volume.volume)
+            for prices, volumes in level_columns[nr_levels:]:
+                prices.append(_NAN)
+                volumes.append(0)
+        partition.nr_rows += 1
+        self.nr_price_books += 1
+        if partition.nr_rows >= self.row_group_size:
+            partition.write(self.compression)
+
+    def add_frame(self, timestamp_ns: int, frame) -> None:
+        """
+        Adds a RawMessage frame as received on the info connection; messages other than PriceBook and TradeTick are
+        ignored.
+        """
+        with common_capnp.RawMessage.from_bytes(frame) as msg:
+            if msg.type == _PRICE_BOOK_TYPE_ID:
+                book = msg.msg.as_struct(info_capnp.PriceBook.schema)
+                self.add_price_book(book.instrumentId, timestamp_ns, book.bids, book.asks)
+            elif msg.type == _TRADE_TICK_TYPE_ID:
+                tick = msg.msg.as_struct(common_capnp.TradeTick.schema)
+                self.add_trade_tick(tick.instrumentId, tick.timestamp, tick.price, tick.volume,
+                                    str(tick.aggressorSide), tick.tradeId, tick.buyer, tick.seller)
+
+    def attach(self, client: InfoClient) -> None:
+        """
+        Exports everything the client receives from now on, until detach or close. Price books are stamped with the
+        time the client received them.
+        """
+        def on_price_book(book):
+            self.add_price_book(book.instrumentId, int(client._clock() * 1000000000), book.bids, book.asks)
+
+        def on_trade_tick(tick):
+            self.add_trade_tick(tick.instrumentId, tick.timestamp, tick.price, tick.volume, str(tick.aggressorSide),
+                                tick.tradeId, tick.buyer, tick.seller)
+
+        self._handler_ids.append((client, client.add_message_handler(info_capnp.PriceBook, on_price_book)))
+        self._handler_ids.append((client, client.add_message_handler(common_capnp.TradeTick, on_trade_tick)))
+
+    def detach(self) -> None:
+        for client, h_id in self._handler_ids:
+            client.remove_message_handler(h_id)
+        self._handler_ids = []
+
+    def flush(self) -> None:
+        """
+        Writes the buffered rows as row groups, e.g. before reading the files of a live export.
+        """
+        for partition in self._partitions.values():
+            partition.write(self.compression)
+
+    def close(self) -> None:
+        self.detach()
+        for partition in self._partitions.values():
+            partition.close(self.compression)
+        self._partitions = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def export_recording(path: str,
+                     directory: str,
+                     start: Timestamp = None,
+                     end: Timestamp = None,
+                     instrument_ids: typing.Collection[str] = None,
+                     **kwargs) -> typing.Tuple[int, int]:
+    """
+    Exports a recording directory or a feed file (see feed_replay) to a dataset, optionally only a time range or some
+    instruments. The other keyword arguments go to ColumnarExporter.
+
+    Returns the number of trade ticks and price books exported.
+    """
+    with ColumnarExporter(directory, **kwargs) as exporter:
+        for timestamp_ns, frame in iter_frames(path, start, end, instrument_ids):
+            exporter.add_frame(timestamp_ns, frame)
+    return exporter.nr_trade_ticks, exporter.nr_price_books
+
+
+def _load(directory: str, table: str, instrument_id: str, start: Timestamp, end: Timestamp,
+          columns: typing.Optional[typing.List[str]]) -> pa.Table:
+    path = os.path.join(directory, table, f'instrument_id={instrument_id}')
+    if not os.path.isdir(path):
+        raise Exception(f"No {table} for {instrument_id} in {directory}")
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    start_ns = _as_ns(start)
+    end_ns = _as_ns(end)
+    condition = None
+    for part in (ds.field('timestamp_ns') >= start_ns if start_ns is not None else None,
+                 ds.field('timestamp_ns') < end_ns if end_ns is not None else None):
+        if part is not None:
+            condition = part if condition is None else condition & part
+    if columns is not None and 'timestamp_ns' not in columns:
+        columns = ['timestamp_ns'] + columns
+    # the partitions are read in order of their date, and within them in time order
+    table = dataset.to_table(columns=columns, filter=condition)
+    if len(dataset.files) > 1:
+        table = table.sort_by('timestamp_ns')
+    return table
+
+
+def _to_numpy(column: pa.ChunkedArray) -> np.ndarray:
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(pa.string())
+    return column.to_numpy()
+
+
+def load_trade_ticks(directory: str,
+                     instrument_id: str,
+                     start: Timestamp = None,
+                     end: Timestamp = None,
+                     columns: typing.List[str] = None) -> typing.Dict[str, np.ndarray]:
+    """
+    Loads the trade ticks of an instrument in [start, end) from a dataset, in time order, as one numpy array per
+    column; buyer and seller are object arrays of str. Only the given columns are read if columns is set.
+    """
+    table = _load(directory, TRADE_TICKS, instrument_id, start, end, columns)
+    return {name: _to_numpy(table.column(name)) for name in table.column_names if name in _TRADE_TICK_SCHEMA.names}
+
+
+def load_price_books(directory: str,
+                     instrument_id: str,
+                     start: Timestamp = None,
+                     end: Timestamp = None) -> typing.Dict[str, np.ndarray]:
+    """
+    Loads the price book snapshots of an instrument in [start, end) from a dataset, in time order.
+
+    Returns
+    -------
+    typing.Dict[str, np.ndarray]
+        timestamp_ns with shape (n,), and bid_price, bid_volume, ask_price and ask_volume with shape (n, depth), best
+        level first, e.g. the mid of every snapshot is (books['bid_price'][:, 0] + books['ask_price'][:, 0]) / 2.
+    """
+    table = _load(directory, PRICE_BOOKS, instrument_id, start, end, None)
+    result = {'timestamp_ns': _to_numpy(table.column('timestamp_ns'))}
+    for name in ('bid_price', 'bid_volume', 'ask_price', 'ask_volume'):
+        level_columns = sorted((c for c in table.column_names if c.startswith(name + '_')),
+                               key=lambda c: int(c.rsplit('_', 1)[1]))
+        result[name] = np.column_stack([_to_numpy(table.column(c)) for c in level_columns]) if level_columns \
+            else np.empty((len(table), 0))
+    return result
@@ -1,5 +1,8 @@
+from array import array
 from datetime import datetime
-from typing import List, Optional, Dict, Union
+from itertools import accumulate
+from operator import mul
+from typing import List, Optional, Dict, Union, Iterable
 from enum import Enum
 import copy
 import json
@@ -7,6 +10,8 @@ import logging
 
 logger = logging.getLogger('client')
 
+_EPOCH = datetime(1970, 1, 1)
+
 
 class SingleSidedBooking:
     def __init__(self):
@@ -56,15 +61,18 @@ class TradeTick:
     trade_id: int
         Id of the trade
     """
+    __slots__ = ('timestamp', 'instrument_id', 'price', 'volume', 'aggressor_side', 'buyer', 'seller', 'trade_id')
+
     def __init__(self, *, timestamp=None, instrument_id=None, price=None, volume=None, aggressor_side=None, buyer=None, seller=None, trade_id=None):
-        self.timestamp: datetime = datetime(1970, 1, 1) if not timestamp else timestamp
-        self.instrument_id: str = '' if not instrument_id else instrument_id
-        self.price: float = 0.0 if not price else price
-        self.volume: int = 0 if not volume else volume
-        self.aggressor_side: str = '' if not aggressor_side else aggressor_side
-        self.buyer: str = '' if not buyer else buyer
-        self.seller: str = '' if not seller else seller
-        self.trade_id: int = -1 if not trade_id else trade_id
+        # falsy values fall back to the defaults
+        self.timestamp: datetime = timestamp or _EPOCH
+        self.instrument_id: str = instrument_id or ''
+        self.price: float = price or 0.0
+        self.volume: int = volume or 0
+        self.aggressor_side: str = aggressor_side or ''
+        self.buyer: str = buyer or ''
+        self.seller: str = seller or ''
+        self.trade_id: int = trade_id or -1
 
     def __repr__(self):
         return f'TradeTick(timestamp={self.timestamp}, instrument_id={self.instrument_id}, price={self.price}, ' \
@@ -82,6 +90,8 @@ class PriceVolume:
 
     volume: int
     """
+    __slots__ = ('price', 'volume')
+
     def __init__(self, price, volume):
         self.price = price
         self.volume = volume
@@ -160,6 +170,175 @@ class PriceBook:
         return f"{level[0].center(bid_width, ' ')}|{level[1].center(price_width, ' ')}|{level[2].center(ask_width, ' ')}"
 
 
+class CompactPriceBook:
+    """
+    An order book at a specific point in time, stored as arrays of prices and volumes rather than PriceVolume objects.
+
+    The arrays support the buffer protocol, so they can be wrapped by e.g. numpy.frombuffer without copying.
+
+    Attributes
+    ----------
+    timestamp: datetime.datetime
+        The time of the snapshot.
+
+    instrument_id: str
+        The id of the instrument the book is on.
+
+    bid_prices: array.array of float64
+    bid_volumes: array.array of uint32
+        Bid levels, sorted from highest price to lowest price (i.e. from best to worst).
+
+    ask_prices: array.array of float64
+    ask_volumes: array.array of uint32
+        Ask levels, sorted from lowest price to highest price (i.e. from best to worst).
+    """
+    __slots__ = ('timestamp', 'instrument_id', 'bid_prices', 'bid_volumes', 'ask_prices', 'ask_volumes')
+
+    def __init__(self, *, timestamp=None, instrument_id=None, bid_prices=None, bid_volumes=None, ask_prices=None,
+                 ask_volumes=None):
+        self.timestamp: datetime = datetime(1970, 1, 1) if not timestamp else timestamp
+        self.instrument_id: str = '' if not instrument_id else instrument_id
+        self.bid_prices: array = array('d') if bid_prices is None else bid_prices
+        self.bid_volumes: array = array('I') if bid_volumes is None else bid_volumes
+        self.ask_prices: array = array('d') if ask_prices is None else ask_prices
+        self.ask_volumes: array = array('I') if ask_volumes is None else ask_volumes
+
+    @staticmethod
+    def from_levels(instrument_id: str, bids: Iterable, asks: Iterable, timestamp: datetime = None) -> "CompactPriceBook":
+        """
+        Builds the book from sequences of levels with a price and volume attribute, e.g. the bids and asks of a
+        PriceBook or of a capnp PriceBook message.
+        """
+        bid_prices, bid_volumes = array('d'), array('I')
+        for level in bids:
+            bid_prices.append(level.price)
+            bid_volumes.append(level.volume)
+        ask_prices, ask_volumes = array('d'), array('I')
+        for level in asks:
+            ask_prices.append(level.price)
+            ask_volumes.append(level.volume)
+        return CompactPriceBook(timestamp=timestamp, instrument_id=instrument_id, bid_prices=bid_prices,
+                                bid_volumes=bid_volumes, ask_prices=ask_prices, ask_volumes=ask_volumes)
+
+    @staticmethod
+    def from_price_book(book: "PriceBook") -> "CompactPriceBook":
+        return CompactPriceBook.from_levels(book.instrument_id, book.bids, book.asks, book.timestamp)
+
+    def to_price_book(self) -> "PriceBook":
+        return PriceBook(timestamp=self.timestamp, instrument_id=self.instrument_id,
+                         bids=list(map(PriceVolume, self.bid_prices, self.bid_volumes)),
+                         asks=list(map(PriceVolume, self.ask_prices, self.ask_volumes)))
+
+    def _side(self, side: str):
+        if side == 'bid':
+            return self.bid_prices, self.bid_volumes
+        elif side == 'ask':
+            return self.ask_prices, self.ask_volumes
+        raise Exception(f'Unknown side: {side}')
+
+    def best_bid(self) -> Optional[float]:
+        return self.bid_prices[0] if self.bid_prices else None
+
+    def best_ask(self) -> Optional[float]:
+        return self.ask_prices[0] if self.ask_prices else None
+
+    def spread(self) -> Optional[float]:
+        if not self.bid_prices or not self.ask_prices:
+            return None
+        return self.ask_prices[0] - self.bid_prices[0]
+
+    def mid(self) -> Optional[float]:
+        if not self.bid_prices or not self.ask_prices:
+            return None
+        return (self.bid_prices[0] + self.ask_prices[0]) / 2
+
+    def microprice(self) -> Optional[float]:
+        """
+        The mid weighted by the volume on the opposite side of the top of book, i.e. closer to the side with less volume.
+        """
+        if not self.bid_prices or not self.ask_prices:
+            return None
+        bid_volume, ask_volume = self.bid_volumes[0], self.ask_volumes[0]
+        return (self.bid_prices[0] * ask_volume + self.ask_prices[0] * bid_volume) / (bid_volume + ask_volume)
+
+    def depth_weighted_mid(self, nr_levels: int) -> Optional[float]:
+        """
+        Average price of the best nr_levels levels on both sides, weighted by volume.
+        """
+        if not self.bid_prices or not self.ask_prices:
+            return None
+        notional = sum(map(mul, self.bid_prices[:nr_levels], self.bid_volumes[:nr_levels])) + \
+            sum(map(mul, self.ask_prices[:nr_levels], self.ask_volumes[:nr_levels]))
+        return notional / (sum(self.bid_volumes[:nr_levels]) + sum(self.ask_volumes[:nr_levels]))
+
+    def imbalance(self, nr_levels: int = 1) -> Optional[float]:
+        """
+        (bid volume - ask volume) / (bid volume + ask volume) over the best nr_levels levels, between -1 and 1.
+        """
+        bid_volume = sum(self.bid_volumes[:nr_levels])
+        ask_volume = sum(self.ask_volumes[:nr_levels])
+        if bid_volume + ask_volume == 0:
+            return None
+        return (bid_volume - ask_volume) / (bid_volume + ask_volume)
+
+    def volume_at(self, side: str, price: float) -> int:
+        """
+        Volume on a side of the book at exactly the given price.
+        """
+        prices, volumes = self._side(side)
+        for i, level_price in enumerate(prices):
+            if level_price == price:
+                return volumes[i]
+        return 0
+
+    def volume_through(self, side: str, price: float) -> int:
+        """
+        Volume on a side of the book at the given price or better, i.e. bids at or above and asks at or below price.
+        """
+        prices, volumes = self._side(side)
+        nr_levels = 0
+        if side == 'bid':
+            while nr_levels < len(prices) and prices[nr_levels] >= price:
+                nr_levels += 1
+        else:
+            while nr_levels < len(prices) and prices[nr_levels] <= price:
+                nr_levels += 1
+        return sum(volumes[:nr_levels])
+
+    def cumulative_volumes(self, side: str) -> array:
+        """
+        Volume available on a side of the book up to and including each level.
+        """
+        return array('Q', accumulate(self._side(side)[1]))
+
+    def vwap_to_fill(self, side: str, volume: int) -> Optional[float]:
+        """
+        Average price at which an order for volume lots would trade against the book. side is the side of the order,
+        a 'bid' order trades against the asks and an 'ask' order against the bids. Returns None if the book does not
+        have enough volume.
+        """
+        prices, volumes = self._side('ask' if side == 'bid' else 'bid')
+        remaining = volume
+        notional = 0.0
+        for level_price, level_volume in zip(prices, volumes):
+            traded = min(remaining, level_volume)
+            notional += traded * level_price
+            remaining -= traded
+            if remaining == 0:
+                return notional / volume
+        return None
+
+    def __repr__(self):
+        return repr(self.to_price_book()).replace('PriceBook(', 'CompactPriceBook(', 1)
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactPriceBook):
+            return NotImplemented
+        return self.instrument_id == other.instrument_id and self.bid_prices == other.bid_prices and \
+            self.bid_volumes == other.bid_volumes and self.ask_prices == other.ask_prices and \
+            self.ask_volumes == other.ask_volumes
+
+
 class Trade:
     """
     A private trade.
@@ -191,14 +370,16 @@ class Trade:
         If 'bid' you bought.
         If 'ask' you sold.
     """
-    def __init__(self):
-        self.timestamp: datetime = datetime(1970, 1, 1)
-        self.order_id: int = 0
-        self.trade_id: int = -1
-        self.instrument_id: str = ''
-        self.price: float = 0.0
-        self.volume: int = 0
-        self.side: str = ''
+    __slots__ = ('timestamp', 'order_id', 'trade_id', 'instrument_id', 'price', 'volume', 'side')
+
+    def __init__(self, *, timestamp=_EPOCH, order_id=0, trade_id=-1, instrument_id='', price=0.0, volume=0, side=''):
+        self.timestamp: datetime = timestamp
+        self.order_id: int = order_id
+        self.trade_id: int = trade_id
+        self.instrument_id: str = instrument_id
+        self.price: float = price
+        self.volume: int = volume
+        self.side: str = side
 
     def __repr__(self):
         return f'Trade(timestamp={self.timestamp}, order_id={self.order_id}, trade_id={self.trade_id}, ' \
@@ -227,18 +408,66 @@ class OrderStatus:
         If 'bid' this is a bid order.
         If 'ask' this is an ask order.
     """
-    def __init__(self):
-        self.order_id: int = 0
-        self.instrument_id: str = ''
-        self.price: float = 0.0
-        self.volume: int = 0
-        self.side: str = ''
+    __slots__ = ('order_id', 'instrument_id', 'price', 'volume', 'side')
+
+    def __init__(self, *, order_id=0, instrument_id='', price=0.0, volume=0, side=''):
+        self.order_id: int = order_id
+        self.instrument_id: str = instrument_id
+        self.price: float = price
+        self.volume: int = volume
+        self.side: str = side
 
     def __repr__(self):
         return f'OrderStatus(order_id={self.order_id}, instrument_id={self.instrument_id}, price={self.price}, ' \
                f'volume={self.volume}, side={self.side})'
 
 
+class PositionPnl:
+    """
+    The position in one instrument and what it has made so far.
+
+    Attributes
+    ----------
+    instrument_id: str
+        The id of the instrument.
+
+    volume: int
+        The number of lots held, negative if short.
+
+    cash: float
+        The cash arising from all buy and sell trades in the instrument.
+
+    average_price: float
+        The average price the open position was built at, None if the position is flat.
+
+    realized_pnl: float
+        The PnL of the lots that have been closed, per the cost basis of the account (average cost or FIFO).
+
+    mark_price: float
+        The price the open position is valued at, the last traded price of the instrument. None if it has not
+        traded yet.
+
+    unrealized_pnl: float
+        The PnL of the open position at the mark price, None if there is no mark price.
+    """
+    __slots__ = ('instrument_id', 'volume', 'cash', 'average_price', 'realized_pnl', 'mark_price', 'unrealized_pnl')
+
+    def __init__(self, *, instrument_id='', volume=0, cash=0.0, average_price=None, realized_pnl=0.0,
+                 mark_price=None, unrealized_pnl=None):
+        self.instrument_id: str = instrument_id
+        self.volume: int = volume
+        self.cash: float = cash
+        self.average_price: Optional[float] = average_price
+        self.realized_pnl: float = realized_pnl
+        self.mark_price: Optional[float] = mark_price
+        self.unrealized_pnl: Optional[float] = unrealized_pnl
+
+    def __repr__(self):
+        return f'PositionPnl(instrument_id={self.instrument_id}, volume={self.volume}, cash={self.cash}, ' \
+               f'average_price={self.average_price}, realized_pnl={self.realized_pnl}, ' \
+               f'mark_price={self.mark_price}, unrealized_pnl={self.unrealized_pnl})'
+
+
 class InstrumentType(Enum):
     STOCK = 1
     STOCK_OPTION = 2
@@ -1,28 +1,40 @@
 # Copyright (c) Optiver I.P. B.V. 2019
 
+import asyncio
 import logging
 import json
+import math
 import itertools
+import sys
+import time
 import typing
 from datetime import datetime
 from collections import defaultdict, deque
-from .base_client import Client, RawClient, logger_decorator
+from .base_client import Client, RawClient, logger_decorator, PUMP_MODE_EVENT, FrameConflator, ConflationStats
 from .common_types import (
     PriceBook,
+    CompactPriceBook,
     PriceVolume,
     Trade,
     TradeTick,
     OrderStatus,
     Instrument,
     PriceChangeLimit,
+    PositionPnl,
 )
 from .exchange_responses import (
     InsertOrderResponse,
     AmendOrderResponse,
     DeleteOrderResponse,
 )
-from .base_client import _default_settings
-import aiohttp
+from .trade_tick_history import (
+    TradeTickHistory,
+    TradeTickColumns,
+    MergedTradeTickHistory,
+    MergedTradeTickColumns,
+)
+from .base_client import get_default_settings
+from .state_snapshot import StateSequence
 
 import capnp
 from .idl import exec_capnp, info_capnp, common_capnp
@@ -43,11 +55,16 @@ ALL_ORDER_TYPES = [ORDER_TYPE_LIMIT, ORDER_TYPE_IOC]
 
 UNMAPPED_USER = "UNMAPPED_USER"
 
+EXEC_CALLBACKS = ["onOrderUpdate", "onTrade", "onSingleSidedBooking"]
+
 
 async def get_exchange_host_for_user(primary_host: str, username: str) -> str:
     """
     Returns the hostname of the exchange the user specified by <username> is currently assigned to
     """
+    # only needed when no host is given, and slow to import
+    import aiohttp
+
     async with aiohttp.ClientSession() as session:
         params = {"username": username}
         async with session.get(
@@ -66,32 +83,65 @@ async def get_exchange_host_for_user(primary_host: str, username: str) -> str:
 
 
 class InfoClient(RawClient):
+    # message type id -> (schema, name of the handler method), resolved to bound methods per instance
+    _MESSAGE_HANDLERS = {
+        msg_type.schema.node.id: (msg_type.schema, handler_name)
+        for msg_type, handler_name in [
+            (info_capnp.PriceBook, "onPriceBook"),
+            (common_capnp.TradeTick, "onTradeTick"),
+            (info_capnp.InstrumentCreated, "onInstrumentCreated"),
+            (info_capnp.InstrumentExpired, "onInstrumentExpired"),
+            (info_capnp.InstrumentPaused, "onInstrumentPaused"),
+            (info_capnp.InstrumentResumed, "onInstrumentResumed"),
+            (info_capnp.InstrumentParametersUpdated, "onInstrumentParametersUpdated"),
+            (info_capnp.InstrumentStartupData, "onInstrumentStartupData"),
+        ]
+    }
+
     def __init__(
         self,
         host: str = None,
         port: int = None,
         max_nr_trade_history: int = 100,
         admin_password: str = None,
+        lazy_price_books: bool = False,
+        feed_recorder=None,
+        state_sequence: StateSequence = None,
+        conflate_price_books: bool = False,
     ):
         if (not host and port) or (not port and host):
             raise Exception(
                 "InitialisationError: The host and port must be either be both set or unset"
             )
 
-        super(InfoClient, self).__init__(host, port)
+        super(InfoClient, self).__init__(host, port, recorder=feed_recorder)
 
         self._admin_password = admin_password
         self._max_trade_history = max_nr_trade_history
+        self._lazy_price_books = lazy_price_books
+        # the time price books are stamped with, replaced by feed_replay.FeedCapture with the time of the recording
+        self._clock = time.time
+        # bracketing the processing of every message, see state_snapshot
+        self._state_sequence = state_sequence if state_sequence is not None else StateSequence()
+        if conflate_price_books:
+            # price books that are superseded before they are handled are dropped, see FrameConflator
+            self._conflator = FrameConflator([info_capnp.PriceBook.schema.node.id])
+
+        self._extra_handlers = {}
+        self._dispatch_table = {
+            type_id: (schema, getattr(self, handler_name), [])
+            for type_id, (schema, handler_name) in self._MESSAGE_HANDLERS.items()
+        }
 
     async def connect(self, loop=None):
         if not self._host:
-            primary_host = _default_settings["host"]
-            username = _default_settings["username"]
+            primary_host = get_default_settings()["host"]
+            username = get_default_settings()["username"]
             self._host = await get_exchange_host_for_user(primary_host, username)
             logger.debug(self._host)
 
         if not self._port:
-            self._port = _default_settings["info_port"]
+            self._port = get_default_settings()["info_port"]
 
         await super(InfoClient, self).connect(loop)
 
@@ -103,13 +153,33 @@ class InfoClient(RawClient):
     def reset_data(self) -> None:
         super(InfoClient, self).reset_data()
         self._last_price_book_by_instrument_id = dict()
-
-        self._trade_tick_history_last_polled_index = defaultdict(lambda: 0)
-        self._trade_tick_history = defaultdict(deque)
+        # lazy mode only: serialized books that have not been decoded yet, with their time of arrival
+        self._raw_price_book_by_instrument_id = dict()
+        self._last_compact_price_book_by_instrument_id = dict()
+
+        self._trade_tick_history_last_polled_sequence = defaultdict(lambda: 0)
+        self._trade_tick_history: typing.Dict[str, TradeTickHistory] = {}
+        self._merged_trade_tick_history: typing.Dict[
+            typing.Tuple[str, ...], MergedTradeTickHistory
+        ] = {}
+        self._merged_trade_tick_history_by_instrument_id = defaultdict(list)
+        self._merged_trade_tick_history_last_polled_sequence = defaultdict(lambda: 0)
         self._last_traded_price = {}
         self._instruments = {}
         self._expired_instruments_last_polled = {}
 
+    async def reconnect(self, loop=None):
+        # the books are sent again on subscribing, until then the ones from before are stale
+        state_sequence = self._state_sequence
+        state_sequence.begin_write()
+        try:
+            self._last_price_book_by_instrument_id = dict()
+            self._raw_price_book_by_instrument_id = dict()
+            self._last_compact_price_book_by_instrument_id = dict()
+        finally:
+            state_sequence.end_write()
+        await super(InfoClient, self).reconnect(loop)
+
     async def _on_connected(self):
         msg = common_capnp.RawMessage.new_message()
         msg.type = info_capnp.InfoSubscribeRequest.schema.node.id
@@ -123,36 +193,40 @@ class InfoClient(RawClient):
         logger.debug("logged in!")
 
     async def _on_message(self, msg):
-        if msg.type == info_capnp.PriceBook.schema.node.id:
-            self.onPriceBook(msg.msg.as_struct(info_capnp.PriceBook.schema))
-        elif msg.type == common_capnp.TradeTick.schema.node.id:
-            self.onTradeTick(msg.msg.as_struct(common_capnp.TradeTick.schema))
-        elif msg.type == info_capnp.InstrumentCreated.schema.node.id:
-            self.onInstrumentCreated(
-                msg.msg.as_struct(info_capnp.InstrumentCreated.schema)
-            )
-        elif msg.type == info_capnp.InstrumentExpired.schema.node.id:
-            self.onInstrumentExpired(
-                msg.msg.as_struct(info_capnp.InstrumentExpired.schema)
-            )
-        elif msg.type == info_capnp.InstrumentPaused.schema.node.id:
-            self.onInstrumentPaused(
-                msg.msg.as_struct(info_capnp.InstrumentPaused.schema)
-            )
-        elif msg.type == info_capnp.InstrumentResumed.schema.node.id:
-            self.onInstrumentResumed(
-                msg.msg.as_struct(info_capnp.InstrumentResumed.schema)
-            )
-        elif msg.type == info_capnp.InstrumentParametersUpdated.schema.node.id:
-            self.onInstrumentParametersUpdated(
-                msg.msg.as_struct(info_capnp.InstrumentParametersUpdated.schema)
-            )
-        elif msg.type == info_capnp.InstrumentStartupData.schema.node.id:
-            self.onInstrumentStartupData(
-                msg.msg.as_struct(info_capnp.InstrumentStartupData.schema)
-            )
-        else:
+        try:
+            schema, handler, extra_handlers = self._dispatch_table[msg.type]
+        except KeyError:
             raise Exception(f"Unknown message from server {msg}")
+        decoded = msg.msg.as_struct(schema)
+        state_sequence = self._state_sequence
+        state_sequence.begin_write()
+        try:
+            handler(decoded)
+            for h in extra_handlers:
+                h(decoded)
+        finally:
+            state_sequence.end_write()
+
+    def add_message_handler(self, message_type, handler) -> int:
+        """
+        Registers an additional handler for one type of info message, e.g. info_capnp.PriceBook or
+        common_capnp.TradeTick. The handler is called with the decoded message, after the client has processed it.
+        The message is only valid for the duration of the call.
+
+        Returns an id that can be passed to remove_message_handler.
+        """
+        type_id = getattr(message_type, "schema", message_type).node.id
+        if type_id not in self._dispatch_table:
+            raise Exception(f"Unknown message type {message_type}")
+        h_id = self._extra_callbacks_id
+        self._extra_callbacks_id += 1
+        self._extra_handlers[h_id] = (type_id, handler)
+        self._dispatch_table[type_id][2].append(handler)
+        return h_id
+
+    def remove_message_handler(self, h_id: int) -> None:
+        type_id, handler = self._extra_handlers.pop(h_id)
+        self._dispatch_table[type_id][2].remove(handler)
 
     def onInstrumentParametersUpdated(self, msg):
         self._instruments[msg.instrumentId].parameters = json.loads(msg.parameters)
@@ -184,75 +258,373 @@ class InfoClient(RawClient):
         self._instruments[msg.instrumentId].paused = False
 
     def onPriceBook(self, priceBook):
-        pb = PriceBook(
+        if self._lazy_price_books:
+            # copying the message is an order of magnitude cheaper than building the PriceBook, which may never be read
+            self._raw_price_book_by_instrument_id[priceBook.instrumentId] = (
+                priceBook.as_builder().to_bytes(),
+                self._clock(),
+            )
+            return
+
+        self._last_price_book_by_instrument_id[
+            priceBook.instrumentId
+        ] = self._to_price_book(priceBook, datetime.fromtimestamp(self._clock()))
+
+    @staticmethod
+    def _to_price_book(priceBook, timestamp: datetime) -> PriceBook:
+        return PriceBook(
+            timestamp=timestamp,
             instrument_id=priceBook.instrumentId,
             bids=[PriceVolume(r.price, r.volume) for r in priceBook.bids],
             asks=[PriceVolume(r.price, r.volume) for r in priceBook.asks],
         )
-        pb.timestamp = datetime.now()
-        self._last_price_book_by_instrument_id[priceBook.instrumentId] = pb
+
+    def _decode_price_book(self, instrument_id: str) -> None:
+        raw = self._raw_price_book_by_instrument_id.pop(instrument_id, None)
+        if raw is None:
+            return
+        data, received_at = raw
+        with info_capnp.PriceBook.from_bytes(data) as priceBook:
+            self._last_compact_price_book_by_instrument_id[
+                instrument_id
+            ] = CompactPriceBook.from_levels(
+                instrument_id,
+                priceBook.bids,
+                priceBook.asks,
+                datetime.fromtimestamp(received_at),
+            )
+        # the PriceBook is built from the compact book when it is asked for
+        self._last_price_book_by_instrument_id.pop(instrument_id, None)
 
     def onTradeTick(self, trade):
-        t = TradeTick()
-        t.instrument_id = trade.instrumentId
-        t.volume = trade.volume
-        t.price = trade.price
-        t.aggressor_side = str(trade.aggressorSide)
-        t.timestamp = datetime.fromtimestamp(trade.timestamp / 1000000000)
-        t.buyer = trade.buyer
-        t.seller = trade.seller
-        t.trade_id = trade.tradeId
-        self._last_traded_price[trade.instrumentId] = trade.price
-        inst_hist = self._trade_tick_history[t.instrument_id]
-        inst_hist.append(t)
-        while len(inst_hist) > self._max_trade_history:
-            inst_hist.popleft()
-            self._trade_tick_history_last_polled_index[t.instrument_id] = max(
-                self._trade_tick_history_last_polled_index[t.instrument_id] - 1, 0
+        instrument_id = trade.instrumentId
+        price = trade.price
+        self._last_traded_price[instrument_id] = price
+
+        inst_hist = self._trade_tick_history.get(instrument_id, None)
+        if inst_hist is None:
+            inst_hist = TradeTickHistory(
+                sys.intern(instrument_id), max(self._max_trade_history, 1)
             )
+            self._trade_tick_history[inst_hist.instrument_id] = inst_hist
+        row = (
+            trade.timestamp,
+            price,
+            trade.volume,
+            str(trade.aggressorSide),
+            trade.tradeId,
+            # the same few names are repeated in every tick, keep a single copy of each
+            sys.intern(trade.buyer),
+            sys.intern(trade.seller),
+        )
+        inst_hist.append(*row)
+
+        merged_hists = self._merged_trade_tick_history_by_instrument_id.get(
+            instrument_id, None
+        )
+        if merged_hists:
+            for merged_hist in merged_hists:
+                merged_hist.append(*row, inst_hist.instrument_id)
 
     def get_last_traded_price(self, instrument_id: str) -> float:
         return self._last_traded_price.get(instrument_id, None)
 
     def get_last_price_book(self, instrument_id: str) -> PriceBook:
-        return self._last_price_book_by_instrument_id.get(instrument_id, None)
+        if not self._lazy_price_books:
+            return self._last_price_book_by_instrument_id.get(instrument_id, None)
+
+        if instrument_id in self._raw_price_book_by_instrument_id:
+            self._decode_price_book(instrument_id)
+        book = self._last_price_book_by_instrument_id.get(instrument_id, None)
+        if book is None:
+            compact = self._last_compact_price_book_by_instrument_id.get(instrument_id, None)
+            if compact is None:
+                return None
+            book = compact.to_price_book()
+            self._last_price_book_by_instrument_id[instrument_id] = book
+        return book
+
+    def get_last_compact_price_book(self, instrument_id: str) -> CompactPriceBook:
+        if not self._lazy_price_books:
+            book = self._last_price_book_by_instrument_id.get(instrument_id, None)
+            return None if book is None else CompactPriceBook.from_price_book(book)
+
+        if instrument_id in self._raw_price_book_by_instrument_id:
+            self._decode_price_book(instrument_id)
+        return self._last_compact_price_book_by_instrument_id.get(instrument_id, None)
 
     def get_trade_tick_history(self, instrument_id: str) -> typing.List[TradeTick]:
-        return list(self._trade_tick_history.get(instrument_id, []))
+        inst_hist = self._trade_tick_history.get(instrument_id, None)
+        if inst_hist is None:
+            return []
+        return inst_hist.ticks()
 
     def poll_new_trade_ticks(self, instrument_id: str) -> typing.List[TradeTick]:
-        new_trade_ticks = list(
-            itertools.islice(
-                self._trade_tick_history[instrument_id],
-                self._trade_tick_history_last_polled_index[instrument_id],
-                len(self._trade_tick_history[instrument_id]),
-            )
-        )
-        self._trade_tick_history_last_polled_index[instrument_id] = len(
-            self._trade_tick_history[instrument_id]
+        inst_hist = self._trade_tick_history.get(instrument_id, None)
+        if inst_hist is None:
+            return []
+        # read once, a tick the loop thread appends in between is returned by the next poll
+        sequence = inst_hist.sequence
+        new_trade_ticks = inst_hist.ticks_by_sequence(
+            self._trade_tick_history_last_polled_sequence[instrument_id],
+            sequence,
         )
+        self._trade_tick_history_last_polled_sequence[instrument_id] = sequence
         return new_trade_ticks
 
+    def get_trade_tick_columns(
+        self, instrument_id: str, start: int = None, stop: int = None
+    ) -> typing.Optional[TradeTickColumns]:
+        """
+        Zero-copy views on the columns of the trade tick history of an instrument, start and stop index the history
+        from oldest to newest like a list slice. See TradeTickColumns for how long the views stay valid.
+        """
+        inst_hist = self._trade_tick_history.get(instrument_id, None)
+        if inst_hist is None:
+            return None
+        return inst_hist.columns(start, stop)
+
+    def get_trade_tick_columns_between(
+        self,
+        instrument_id: str,
+        start: typing.Union[datetime, int],
+        end: typing.Union[datetime, int],
+    ) -> typing.Optional[TradeTickColumns]:
+        """
+        Zero-copy views on the trade ticks of an instrument with start <= timestamp < end. Times are datetimes or
+        nanoseconds since the epoch.
+        """
+        inst_hist = self._trade_tick_history.get(instrument_id, None)
+        if inst_hist is None:
+            return None
+        return inst_hist.columns_between(start, end)
+
     def poll_new_expired_instruments(self) -> typing.Dict[str, Instrument]:
         expired_instruments = self._expired_instruments_last_polled.copy()
         self._expired_instruments_last_polled.clear()
         return expired_instruments
 
+    def add_merged_trade_tick_history(
+        self, instrument_ids: typing.Sequence[str], capacity: int = None
+    ) -> MergedTradeTickHistory:
+        """
+        Starts keeping a time-ordered history of the public trades of several instruments, e.g. a cross-listed pair or
+        an ETF and its constituents. It is filled with a k-way merge of the existing histories of the instruments and
+        appended to as new ticks arrive. By default it holds as many ticks as the per-instrument histories together.
+
+        Calling it again for the same instrument_ids returns the existing history.
+        """
+        key = tuple(instrument_ids)
+        merged_hist = self._merged_trade_tick_history.get(key, None)
+        if merged_hist is not None:
+            return merged_hist
+
+        if capacity is None:
+            capacity = max(self._max_trade_history, 1) * len(key)
+        merged_hist = MergedTradeTickHistory.merged_from(
+            key,
+            [self._trade_tick_history[i] for i in key if i in self._trade_tick_history],
+            capacity,
+        )
+        self._merged_trade_tick_history[key] = merged_hist
+        for instrument_id in set(key):
+            self._merged_trade_tick_history_by_instrument_id[instrument_id].append(
+                merged_hist
+            )
+        return merged_hist
+
+    def get_merged_trade_tick_history(
+        self, instrument_ids: typing.Sequence[str]
+    ) -> typing.List[TradeTick]:
+        return self.add_merged_trade_tick_history(instrument_ids).ticks()
+
+    def poll_new_merged_trade_ticks(
+        self, instrument_ids: typing.Sequence[str]
+    ) -> typing.List[TradeTick]:
+        merged_hist = self.add_merged_trade_tick_history(instrument_ids)
+        key = merged_hist.instrument_ids
+        sequence = merged_hist.sequence
+        new_trade_ticks = merged_hist.ticks_by_sequence(
+            self._merged_trade_tick_history_last_polled_sequence[key],
+            sequence,
+        )
+        self._merged_trade_tick_history_last_polled_sequence[key] = sequence
+        return new_trade_ticks
+
+    def get_merged_trade_tick_columns(
+        self, instrument_ids: typing.Sequence[str], start: int = None, stop: int = None
+    ) -> MergedTradeTickColumns:
+        """
+        Zero-copy views on the columns of the merged history of the instruments, see get_trade_tick_columns.
+        """
+        return self.add_merged_trade_tick_history(instrument_ids).columns(start, stop)
+
     def clear_trade_tick_history(self) -> None:
-        self._trade_tick_history = defaultdict(deque)
+        self._trade_tick_history = {}
+        self._trade_tick_history_last_polled_sequence = defaultdict(lambda: 0)
+        self._merged_trade_tick_history = {}
+        self._merged_trade_tick_history_by_instrument_id = defaultdict(list)
+        self._merged_trade_tick_history_last_polled_sequence = defaultdict(lambda: 0)
+
+    def get_conflation_stats(self) -> typing.Optional[ConflationStats]:
+        return self._conflator.stats() if self._conflator is not None else None
 
     def get_instruments(self) -> typing.Dict[str, Instrument]:
         return self._instruments
 
 
+COST_BASIS_AVERAGE = "average"
+COST_BASIS_FIFO = "fifo"
+ALL_COST_BASES = [COST_BASIS_AVERAGE, COST_BASIS_FIFO]
+
+
 class PositionAccountant:
-    def __init__(self, positions=defaultdict()):
+    """
+    Keeps the positions, cash and PnL of an account up to date trade by trade, so that reading them is O(1).
+
+    Realized PnL is computed per the cost basis, the average cost of the open position or FIFO over its lots. Open
+    positions are valued at the mark price of their instrument, the last traded price, which has to be fed in through
+    mark. The marks and the callbacks survive reset, only the account data starts over.
+    """
+
+    def __init__(self, positions=(), cost_basis: str = COST_BASIS_AVERAGE):
+        assert cost_basis in ALL_COST_BASES, f"cost_basis must be one of {ALL_COST_BASES}"
+        self._cost_basis = cost_basis
+        self._mark_price = {}
+        self._callbacks_id = 0
+        self._callbacks = {}
+        self.reset(positions)
+
+    def reset(self, positions=()) -> None:
+        """
+        Starts over from the given positions, e.g. those of the login reply of the exchange. A position that is
+        already open is taken to have been built at the price that explains its cash.
+        """
         self._position_by_instrument_id = {}
+        self._volume_by_instrument_id = {}
+        # cost of the open position per instrument: the sum of volume * price over the lots still open
+        self._basis_by_instrument_id = {}
+        # FIFO only: the open lots per instrument, oldest first, as [volume, price]
+        self._lots_by_instrument_id = {}
+        self._cash = 0.0
+        self._basis = 0.0
+        # the open positions valued at their mark price, for the instruments that have one
+        self._market_value = 0.0
+        # instruments with an open position but no mark price
+        self._unmarked = set()
+        for inst in positions:
+            self._new_position(inst.instrumentId)
+            if inst.position != 0:
+                self._book(inst.instrumentId, inst.position, -inst.cash / inst.position)
+            else:
+                self._book_cash(inst.instrumentId, inst.cash)
+
+    def resync(self, positions) -> typing.List[str]:
+        """
+        Brings the account in line with the given positions, e.g. those of the login reply after a reconnect. Only
+        the instruments whose position or cash differs start over as in reset, the others keep their lots and
+        realized PnL. Returns the instruments that changed.
+        """
+        expected = {inst.instrumentId: (inst.position, inst.cash) for inst in positions}
+        changed = []
+        for instrument_id, pos in list(self._position_by_instrument_id.items()):
+            volume, cash = expected.get(instrument_id, (0, 0.0))
+            if pos["volume"] != volume or not math.isclose(pos["cash"], cash, abs_tol=1e-6):
+                self._drop_position(instrument_id)
+                changed.append(instrument_id)
         for inst in positions:
-            self._position_by_instrument_id[inst.instrumentId] = {
-                "volume": inst.position,
-                "cash": inst.cash,
-            }
+            if inst.instrumentId in self._position_by_instrument_id:
+                continue
+            self._new_position(inst.instrumentId)
+            if inst.position != 0:
+                self._book(inst.instrumentId, inst.position, -inst.cash / inst.position)
+            else:
+                self._book_cash(inst.instrumentId, inst.cash)
+            if inst.instrumentId not in changed:
+                changed.append(inst.instrumentId)
+        if self._callbacks:
+            for instrument_id in changed:
+                if instrument_id in self._position_by_instrument_id:
+                    self._notify(instrument_id)
+        return changed
+
+    def _drop_position(self, instrument_id: str) -> None:
+        pos = self._position_by_instrument_id.pop(instrument_id)
+        volume = self._volume_by_instrument_id.pop(instrument_id)
+        self._cash -= pos["cash"]
+        self._basis -= self._basis_by_instrument_id.pop(instrument_id)
+        self._lots_by_instrument_id.pop(instrument_id, None)
+        mark_price = self._mark_price.get(instrument_id, None)
+        if mark_price is not None:
+            self._market_value -= volume * mark_price
+        self._unmarked.discard(instrument_id)
+
+    def _new_position(self, instrument_id: str) -> typing.Dict:
+        pos = self._position_by_instrument_id[instrument_id] = {
+            "volume": 0,
+            "cash": 0.0,
+        }
+        self._volume_by_instrument_id[instrument_id] = 0
+        self._basis_by_instrument_id[instrument_id] = 0.0
+        if self._cost_basis == COST_BASIS_FIFO:
+            self._lots_by_instrument_id[instrument_id] = deque()
+        return pos
+
+    def _book_cash(self, instrument_id: str, cash: float) -> None:
+        self._position_by_instrument_id[instrument_id]["cash"] += cash
+        self._cash += cash
+
+    def _book(self, instrument_id: str, volume: int, price: float) -> None:
+        # volume is positive for a buy, negative for a sell
+        pos = self._position_by_instrument_id.get(instrument_id, None)
+        if pos is None:
+            pos = self._new_position(instrument_id)
+        old_volume = pos["volume"]
+        new_volume = old_volume + volume
+        old_basis = self._basis_by_instrument_id[instrument_id]
+
+        if self._cost_basis == COST_BASIS_FIFO:
+            new_basis = old_basis
+            lots = self._lots_by_instrument_id[instrument_id]
+            remaining = volume
+            while remaining != 0 and lots and (lots[0][0] > 0) != (remaining > 0):
+                lot = lots[0]
+                closed = -remaining if abs(remaining) < abs(lot[0]) else lot[0]
+                new_basis -= closed * lot[1]
+                lot[0] -= closed
+                remaining += closed
+                if lot[0] == 0:
+                    lots.popleft()
+            if remaining != 0:
+                lots.append([remaining, price])
+                new_basis += remaining * price
+            if not lots:
+                new_basis = 0.0
+        elif old_volume == 0 or (old_volume > 0) == (volume > 0):
+            new_basis = old_basis + volume * price
+        elif abs(volume) <= abs(old_volume):
+            # the part of the position that is left keeps its average price
+            new_basis = old_basis * new_volume / old_volume
+        else:
+            new_basis = new_volume * price
+
+        pos["volume"] = new_volume
+        pos["cash"] -= volume * price
+        self._volume_by_instrument_id[instrument_id] = new_volume
+        self._basis_by_instrument_id[instrument_id] = new_basis
+        self._cash -= volume * price
+        self._basis += new_basis - old_basis
+
+        mark_price = self._mark_price.get(instrument_id, None)
+        if mark_price is not None:
+            self._market_value += volume * mark_price
+        elif new_volume != 0:
+            self._unmarked.add(instrument_id)
+        else:
+            self._unmarked.discard(instrument_id)
+
+        if self._callbacks:
+            self._notify(instrument_id)
 
     def handle_trade(self, trade):
         # logger.debug(f'Private trade: {trade}.')
@@ -264,17 +636,7 @@ class PositionAccountant:
         else:
             raise Exception("Unknown trade side.")
 
-        if trade.instrumentId not in self._position_by_instrument_id:
-            self._position_by_instrument_id[trade.instrumentId] = {
-                "volume": 0,
-                "cash": 0.0,
-            }
-        self._position_by_instrument_id[trade.instrumentId]["volume"] += (
-            sidemult * trade.volume
-        )
-        self._position_by_instrument_id[trade.instrumentId]["cash"] -= (
-            sidemult * trade.volume * trade.price
-        )
+        self._book(trade.instrumentId, sidemult * trade.volume, trade.price)
 
     def handle_single_sided_booking(self, ssb):
         logger.debug(f"Single sided booking: {ssb}")
@@ -286,23 +648,108 @@ class PositionAccountant:
         else:
             raise Exception("Unknown action: " + str(ssb.action))
 
-        if ssb.instrumentId not in self._position_by_instrument_id:
-            self._position_by_instrument_id[ssb.instrumentId] = {
-                "volume": 0,
-                "cash": 0.0,
-            }
-        self._position_by_instrument_id[ssb.instrumentId]["volume"] += (
-            sidemult * ssb.volume
-        )
-        self._position_by_instrument_id[ssb.instrumentId]["cash"] -= (
-            sidemult * ssb.volume * ssb.price
-        )
+        self._book(ssb.instrumentId, sidemult * ssb.volume, ssb.price)
+
+    def mark(self, instrument_id: str, price: float) -> None:
+        """
+        Sets the price open positions in the instrument are valued at, called for every public trade.
+        """
+        if not price:
+            # the startup data of an instrument that has not traded yet
+            return
+        old_price = self._mark_price.get(instrument_id, None)
+        self._mark_price[instrument_id] = price
+        volume = self._volume_by_instrument_id.get(instrument_id, 0)
+        if volume == 0 or price == old_price:
+            return
+        if old_price is None:
+            self._market_value += volume * price
+            self._unmarked.discard(instrument_id)
+        else:
+            self._market_value += volume * (price - old_price)
+        if self._callbacks:
+            self._notify(instrument_id)
 
     def get_positions(self) -> typing.Dict[str, typing.Dict]:
         return self._position_by_instrument_id
 
+    def get_volumes(self) -> typing.Dict[str, int]:
+        return self._volume_by_instrument_id.copy()
+
     def get_cash(self) -> float:
-        return sum([pos["cash"] for pos in self._position_by_instrument_id.values()])
+        return self._cash
+
+    def get_pnl(self) -> typing.Optional[float]:
+        """
+        The PnL of the account with the open positions at their mark price, None if an open position has none.
+        """
+        if self._unmarked:
+            instrument_id = next(iter(self._unmarked))
+            logger.error(
+                f"No public trade-tick found to evaluate '{instrument_id}'-position "
+                f"({self._volume_by_instrument_id[instrument_id]}) against and no valuation provided. "
+                f"Unable to calculate PnL."
+            )
+            return None
+        return self._cash + self._market_value
+
+    def get_realized_pnl(self) -> float:
+        return self._cash + self._basis
+
+    def get_position_pnl(self, instrument_id: str) -> typing.Optional[PositionPnl]:
+        pos = self._position_by_instrument_id.get(instrument_id, None)
+        if pos is None:
+            return None
+        volume = pos["volume"]
+        basis = self._basis_by_instrument_id[instrument_id]
+        mark_price = self._mark_price.get(instrument_id, None)
+        unrealized_pnl = None
+        if mark_price is not None:
+            unrealized_pnl = volume * mark_price - basis
+        elif volume == 0:
+            unrealized_pnl = 0.0
+        return PositionPnl(
+            instrument_id=instrument_id,
+            volume=volume,
+            cash=pos["cash"],
+            average_price=basis / volume if volume != 0 else None,
+            realized_pnl=pos["cash"] + basis,
+            mark_price=mark_price,
+            unrealized_pnl=unrealized_pnl,
+        )
+
+    def add_callback(self, callback: typing.Callable[[PositionPnl], None]) -> int:
+        """
+        Registers a function that is called with the PositionPnl of an instrument every time it changes: on every
+        own trade or single sided booking, and on a new mark price while the position is open.
+
+        Returns an id that can be passed to remove_callback.
+        """
+        c_id = self._callbacks_id
+        self._callbacks_id += 1
+        self._callbacks[c_id] = callback
+        return c_id
+
+    def remove_callback(self, c_id: int) -> None:
+        del self._callbacks[c_id]
+
+    def _notify(self, instrument_id: str) -> None:
+        position_pnl = self.get_position_pnl(instrument_id)
+        for callback in list(self._callbacks.values()):
+            callback(position_pnl)
+
+
+def _changes_state(func):
+    # brackets an exec callback that changes the state of the client, see state_snapshot
+    def wrapper(self, *args, **kwargs):
+        state_sequence = self._exec._state_sequence
+        state_sequence.begin_write()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            state_sequence.end_write()
+
+    return wrapper
 
 
 class ExecClient(Client):
@@ -314,6 +761,9 @@ class ExecClient(Client):
         password: str = None,
         admin_password: str = None,
         max_nr_trade_history: str = 100,
+        pump_mode: str = PUMP_MODE_EVENT,
+        cost_basis: str = COST_BASIS_AVERAGE,
+        state_sequence: StateSequence = None,
     ):
 
         if (not host and port) or (not port and host):
@@ -326,7 +776,14 @@ class ExecClient(Client):
                 "InitialisationError: The username and password must be either both set or both unset"
             )
 
-        super().__init__(host=host, port=port)
+        # kept across reset_data, it holds the mark prices and the callbacks
+        self._position_accountant = PositionAccountant(cost_basis=cost_basis)
+        # bracketing the processing of every exec callback, see state_snapshot
+        self._state_sequence = state_sequence if state_sequence is not None else StateSequence()
+        self._extra_callbacks_id = 0
+        self._extra_handlers = {}
+        self._handlers_by_callback = {name: [] for name in EXEC_CALLBACKS}
+        super().__init__(host=host, port=port, pump_mode=pump_mode)
         self._max_trade_history = max_nr_trade_history
         self._username = username
         self._password = password
@@ -334,21 +791,30 @@ class ExecClient(Client):
 
     async def connect(self, loop=None):
         if not self._host:
-            primary_host = _default_settings["host"]
-            username = _default_settings["username"]
+            primary_host = get_default_settings()["host"]
+            username = get_default_settings()["username"]
             self._host = await get_exchange_host_for_user(primary_host, username)
             logger.debug(self._host)
 
         if not self._port:
-            self._port = _default_settings["exec_port"]
+            self._port = get_default_settings()["exec_port"]
 
         await super(ExecClient, self).connect(loop)
         await self._authenticate()
 
+    async def reconnect(self, loop=None):
+        await super(ExecClient, self).reconnect(loop)
+        try:
+            await self._authenticate(resync=True)
+        except BaseException:
+            # connected but not logged in, the next attempt has to start over
+            self._close_connection()
+            raise
+
     def reset_data(self) -> None:
         super(ExecClient, self).reset_data()
         self._exec = None
-        self._position_accountant = PositionAccountant()
+        self._position_accountant.reset()
         self._trade_history_last_polled_index = defaultdict(lambda: 0)
         self._trade_history = defaultdict(deque)
         self._order_status_by_order_id = defaultdict(dict)
@@ -356,29 +822,48 @@ class ExecClient(Client):
     async def _on_connected(self):
         self._exec_portal = self._client.bootstrap().cast_as(exec_capnp.ExecPortal)
 
-    async def _authenticate(self) -> None:
+    async def _authenticate(self, resync: bool = False) -> None:
         username = self._username
         password = self._password
         admin_password = self._admin_password
 
         if not username:
-            username = _default_settings["username"]
+            username = get_default_settings()["username"]
         if not password:
-            password = _default_settings["password"]
+            password = get_default_settings()["password"]
 
         self._username = username
         if admin_password is None:
-            result = await self._exec_portal.login(
-                username, password, self.ExecSubscription(self)
-            ).a_wait()
+            result = await self._wait(
+                self._exec_portal.login(username, password, self.ExecSubscription(self))
+            )
         else:
-            result = await self._exec_portal.adminLogin(
-                username, password, admin_password, self.ExecSubscription(self)
-            ).a_wait()
+            result = await self._wait(
+                self._exec_portal.adminLogin(
+                    username, password, admin_password, self.ExecSubscription(self)
+                )
+            )
         self._exec = result.exec
-        self._position_accountant = PositionAccountant(
-            positions=result.positions.positions
-        )
+        if resync:
+            self._resync(result.positions.positions)
+        else:
+            self._position_accountant.reset(positions=result.positions.positions)
+
+    def _resync(self, positions) -> None:
+        # after a reconnect: the trade history and the poll positions are kept, the account follows the exchange
+        state_sequence = self._state_sequence
+        state_sequence.begin_write()
+        try:
+            changed = self._position_accountant.resync(positions)
+            # orders do not outlive the connection on the exchange
+            nr_orders = 0
+            for orders in self._order_status_by_order_id.values():
+                nr_orders += len(orders)
+                orders.clear()
+        finally:
+            state_sequence.end_write()
+        logger.info(f"resynced after reconnect: positions changed in {changed}, "
+                    f"{nr_orders} outstanding orders ended with the connection")
 
     async def insert_order(
         self,
@@ -393,9 +878,9 @@ class ExecClient(Client):
         assert (
             order_type in ALL_ORDER_TYPES
         ), f"order_type must be one of {ALL_ORDER_TYPES}"
-        result = await self._exec.insertOrder(
-            instrument_id, price, volume, side, order_type
-        ).a_wait()
+        result = await self._wait(
+            self._exec.insertOrder(instrument_id, price, volume, side, order_type)
+        )
         if not result.success:
             logger.warning(f"order insert failed with reason: {result.errorReason}")
             return InsertOrderResponse(
@@ -408,7 +893,9 @@ class ExecClient(Client):
     async def amend_order(
         self, instrument_id: str, order_id: int, volume: int
     ) -> AmendOrderResponse:
-        result = await self._exec.amendOrder(instrument_id, order_id, volume).a_wait()
+        result = await self._wait(
+            self._exec.amendOrder(instrument_id, order_id, volume)
+        )
         if not result.success:
             logger.warning(f"order amend failed with reason: {result.errorReason}")
             return AmendOrderResponse(success=False, error_reason=result.errorReason)
@@ -417,26 +904,42 @@ class ExecClient(Client):
     async def delete_order(
         self, instrument_id: str, order_id: int
     ) -> DeleteOrderResponse:
-        result = await self._exec.deleteOrder(instrument_id, order_id).a_wait()
+        result = await self._wait(self._exec.deleteOrder(instrument_id, order_id))
         if not result.success:
             logger.warning(f"order delete failed with reason: {result.errorReason}")
             return DeleteOrderResponse(success=False, error_reason=result.errorReason)
         return DeleteOrderResponse(success=True, error_reason=None)
 
     async def delete_orders(self, instrument_id: str) -> None:
-        await self._exec.deleteOrders(instrument_id).a_wait()
+        await self._wait(self._exec.deleteOrders(instrument_id))
+
+    # The batch versions send all requests before waiting for any reply, so a batch takes about one round-trip.
+    # Each order is a dict with the keyword arguments of the single-order version.
+
+    async def insert_orders(
+        self, orders: typing.Sequence[typing.Dict[str, typing.Any]]
+    ) -> typing.List[InsertOrderResponse]:
+        return await asyncio.gather(*[self.insert_order(**order) for order in orders])
+
+    async def amend_orders(
+        self, orders: typing.Sequence[typing.Dict[str, typing.Any]]
+    ) -> typing.List[AmendOrderResponse]:
+        return await asyncio.gather(*[self.amend_order(**order) for order in orders])
+
+    async def delete_orders_by_id(
+        self, orders: typing.Sequence[typing.Dict[str, typing.Any]]
+    ) -> typing.List[DeleteOrderResponse]:
+        return await asyncio.gather(*[self.delete_order(**order) for order in orders])
 
     async def update_instrument_parameters(
         self, instrument_id: str, parameters: typing.Dict[str, typing.Any]
     ) -> None:
-        await self._exec.updateInstrumentParameters(
-            instrument_id, json.dumps(parameters)
-        ).a_wait()
+        await self._wait(
+            self._exec.updateInstrumentParameters(instrument_id, json.dumps(parameters))
+        )
 
     def get_positions(self) -> typing.Dict[str, int]:
-        return {
-            k: v["volume"] for k, v in self._position_accountant.get_positions().items()
-        }
+        return self._position_accountant.get_volumes()
 
     def get_positions_and_cash(self) -> typing.Dict[str, typing.Dict]:
         return self._position_accountant.get_positions()
@@ -444,10 +947,30 @@ class ExecClient(Client):
     def get_cash(self) -> float:
         return self._position_accountant.get_cash()
 
+    def get_pnl(self) -> typing.Optional[float]:
+        return self._position_accountant.get_pnl()
+
+    def get_realized_pnl(self) -> float:
+        return self._position_accountant.get_realized_pnl()
+
+    def get_position_pnl(self, instrument_id: str) -> typing.Optional[PositionPnl]:
+        return self._position_accountant.get_position_pnl(instrument_id)
+
+    def mark(self, instrument_id: str, price: float) -> None:
+        self._position_accountant.mark(instrument_id, price)
+
+    def add_position_callback(self, callback: typing.Callable[[PositionPnl], None]) -> int:
+        return self._position_accountant.add_callback(callback)
+
+    def remove_position_callback(self, c_id: int) -> None:
+        self._position_accountant.remove_callback(c_id)
+
     def get_outstanding_orders(
         self, instrument_id: str
     ) -> typing.Dict[int, OrderStatus]:
-        return self._order_status_by_order_id[instrument_id].copy()
+        # not through the defaultdict, that would insert from the thread of the caller
+        orders = self._order_status_by_order_id.get(instrument_id, None)
+        return orders.copy() if orders is not None else {}
 
     def get_trade_history(self, instrument_id: str) -> typing.List[Trade]:
         return list(self._trade_history[instrument_id])
@@ -468,36 +991,64 @@ class ExecClient(Client):
     def clear_trade_history(self) -> None:
         self._trade_history = defaultdict(deque)
 
+    def add_message_handler(self, callback_name: str, handler) -> int:
+        """
+        Registers an additional handler for one of the exec feed callbacks, 'onOrderUpdate', 'onTrade' or
+        'onSingleSidedBooking'. The handler is called with the message, after the client has processed it. The message
+        is only valid for the duration of the call.
+
+        Returns an id that can be passed to remove_message_handler.
+        """
+        if callback_name not in self._handlers_by_callback:
+            raise Exception(f"Unknown exec callback {callback_name}, must be one of {EXEC_CALLBACKS}")
+        h_id = self._extra_callbacks_id
+        self._extra_callbacks_id += 1
+        self._extra_handlers[h_id] = (callback_name, handler)
+        self._handlers_by_callback[callback_name].append(handler)
+        return h_id
+
+    def remove_message_handler(self, h_id: int) -> None:
+        callback_name, handler = self._extra_handlers.pop(h_id)
+        self._handlers_by_callback[callback_name].remove(handler)
+
     class ExecSubscription(exec_capnp.ExecPortal.ExecFeed.Server):
         def __init__(self, exec_client):
             self._exec = exec_client
 
         @logger_decorator
+        @_changes_state
         def onOrderUpdate(self, order, **kwargs):
             order_id = order.orderId
             instrument_id = order.instrumentId
-
-            o = OrderStatus()
-            o.order_id = order.orderId
-            o.instrument_id = order.instrumentId
-            o.volume = order.volume
-            o.side = order.side
-            o.price = order.price
-            self._exec._order_status_by_order_id[instrument_id][order_id] = o
-            if order.volume == 0:
-                self._exec._order_status_by_order_id[instrument_id].pop(order_id)
+            volume = order.volume
+
+            if volume == 0:
+                self._exec._order_status_by_order_id[instrument_id].pop(order_id, None)
+            else:
+                self._exec._order_status_by_order_id[instrument_id][order_id] = OrderStatus(
+                    order_id=order_id,
+                    instrument_id=instrument_id,
+                    price=order.price,
+                    volume=volume,
+                    side=order.side,
+                )
             # logger.debug("order %s", order)
 
+            for h in self._exec._handlers_by_callback["onOrderUpdate"]:
+                h(order)
+
         @logger_decorator
+        @_changes_state
         def onTrade(self, trade, **kwargs):
-            tc = Trade()
-            tc.timestamp = datetime.fromtimestamp(trade.timestamp / 1000000000)
-            tc.trade_id = trade.tradeId
-            tc.price = trade.price
-            tc.side = trade.side
-            tc.volume = trade.volume
-            tc.instrument_id = trade.instrumentId
-            tc.order_id = trade.orderId
+            tc = Trade(
+                timestamp=datetime.fromtimestamp(trade.timestamp / 1000000000),
+                order_id=trade.orderId,
+                trade_id=trade.tradeId,
+                instrument_id=trade.instrumentId,
+                price=trade.price,
+                volume=trade.volume,
+                side=trade.side,
+            )
             inst_hist = self._exec._trade_history[tc.instrument_id]
             inst_hist.append(tc)
             while len(inst_hist) > self._exec._max_trade_history:
@@ -509,10 +1060,17 @@ class ExecClient(Client):
             self._exec._position_accountant.handle_trade(trade)
             # logger.debug("trade end %s", trade)
 
+            for h in self._exec._handlers_by_callback["onTrade"]:
+                h(trade)
+
         @logger_decorator
+        @_changes_state
         def onSingleSidedBooking(self, ssb, **kwargs):
             self._exec._position_accountant.handle_single_sided_booking(ssb)
 
+            for h in self._exec._handlers_by_callback["onSingleSidedBooking"]:
+                h(ssb)
+
         @logger_decorator
         def onForcedDisconnect(self, reason, **kwargs):
             logger.error(f"Forcing a disconnect due to an error: {reason}.")
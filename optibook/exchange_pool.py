@@ -0,0 +1,278 @@
+"""
+Several exchange accounts in one process, on one event loop and one info feed.
+
+    pool = ExchangePool(host='...')
+    market_maker = pool.add_session('team-a', '...')
+    hedger = pool.add_session('team-b', '...')
+    pool.connect()
+
+Every session is an Exchange with its own ExecClient: its own login, orders, positions and PnL. The public feed is
+received and decoded once, by the InfoClient of the pool, and every session reads the same price books and trade
+histories. Polling, e.g. poll_new_trade_ticks, is tracked per session, so sessions do not take ticks from each other.
+
+All clients run on the loop thread of the pool. The round-trip latency of requests is kept per session, see
+get_latency_histograms. With a reconnect_policy the pool restores lost connections, of the info feed as well as of
+every session, see get_reconnect_stats.
+"""
+import typing
+from collections import defaultdict
+
+from . import exchange_client
+from .base_client import PUMP_MODE_EVENT, ConflationStats
+from .common_types import TradeTick, Instrument
+from .exchange_client import InfoClient, ExecClient
+from .feed_recorder import FeedRecorder
+from .idl import info_capnp
+from .latency import LatencyHistogram
+from .state_snapshot import StateSequence
+from .synchronous_client import Exchange
+from .synchronous_wrapper import SynchronousWrapper, ReconnectPolicy, ReconnectStats
+
+
+class SharedInfoClient:
+    """
+    The view of one session on the InfoClient of a pool. Everything is read from the shared client, only the
+    positions of the poll methods are kept per view.
+    """
+    def __init__(self, info_client: InfoClient):
+        self._info = info_client
+        self._trade_tick_last_polled_sequence = defaultdict(lambda: 0)
+        self._merged_trade_tick_last_polled_sequence = defaultdict(lambda: 0)
+        self._expired_instruments_last_polled = {}
+        self._expired_handler = info_client.add_message_handler(info_capnp.InstrumentExpired, self._on_expired)
+
+    def __getattr__(self, name):
+        # everything that is not per view, e.g. get_last_price_book or add_message_handler
+        return getattr(self._info, name)
+
+    def close(self) -> None:
+        self._info.remove_message_handler(self._expired_handler)
+
+    def _on_expired(self, msg) -> None:
+        # runs after the shared client moved the instrument to its expired instruments
+        instrument = self._info._expired_instruments_last_polled.get(msg.instrumentId, None)
+        if instrument is not None:
+            self._expired_instruments_last_polled[msg.instrumentId] = instrument
+
+    def poll_new_trade_ticks(self, instrument_id: str) -> typing.List[TradeTick]:
+        inst_hist = self._info._trade_tick_history.get(instrument_id, None)
+        if inst_hist is None:
+            return []
+        # read once, see InfoClient.poll_new_trade_ticks
+        sequence = inst_hist.sequence
+        new_trade_ticks = inst_hist.ticks_by_sequence(self._trade_tick_last_polled_sequence[instrument_id], sequence)
+        self._trade_tick_last_polled_sequence[instrument_id] = sequence
+        return new_trade_ticks
+
+    def poll_new_merged_trade_ticks(self, instrument_ids: typing.Sequence[str]) -> typing.List[TradeTick]:
+        merged_hist = self._info.add_merged_trade_tick_history(instrument_ids)
+        key = merged_hist.instrument_ids
+        sequence = merged_hist.sequence
+        new_trade_ticks = merged_hist.ticks_by_sequence(self._merged_trade_tick_last_polled_sequence[key], sequence)
+        self._merged_trade_tick_last_polled_sequence[key] = sequence
+        return new_trade_ticks
+
+    def poll_new_expired_instruments(self) -> typing.Dict[str, Instrument]:
+        expired_instruments = self._expired_instruments_last_polled.copy()
+        self._expired_instruments_last_polled.clear()
+        return expired_instruments
+
+    def clear_trade_tick_history(self) -> None:
+        raise Exception('The trade tick history is shared by all sessions of the pool and cannot be cleared by one')
+
+
+class ExchangeSession(Exchange):
+    """
+    An Exchange that is part of an ExchangePool, see ExchangePool.add_session.
+    """
+    def __init__(self, pool: 'ExchangePool', name: str, exec_client: ExecClient):
+        self.pool = pool
+        self.name = name
+        self._attach(SharedInfoClient(pool._info_client), exec_client,
+                     SynchronousWrapper([exec_client], loop=pool._wrapper.get_loop()), pool._state_sequence)
+
+    def is_connected(self) -> bool:
+        return self.pool.is_connected() and self._wrapper.is_connected()
+
+    def connect(self) -> None:
+        super(ExchangeSession, self).connect()
+        # a lost connection of the session is restored by the pool, which runs the loop
+        self.pool._wrapper.supervise(self._e)
+
+    def disconnect(self) -> None:
+        self.pool._wrapper.unsupervise(self._e)
+        super(ExchangeSession, self).disconnect()
+
+    def get_reconnect_stats(self) -> typing.Optional[ReconnectStats]:
+        """
+        Returns the reconnect counters of the pool, which all sessions share, see ExchangePool.get_reconnect_stats.
+        """
+        return self.pool.get_reconnect_stats()
+
+    def _close(self) -> None:
+        for h_id in self._mark_handlers:
+            self._i.remove_message_handler(h_id)
+        self._i.close()
+
+
+class ExchangePool:
+    def __init__(self,
+                 host: str = None,
+                 info_port: int = None,
+                 exec_port: int = None,
+                 admin_password: str = None,
+                 full_message_logging: bool = False,
+                 max_nr_trade_history: int = 100,
+                 pump_mode: str = PUMP_MODE_EVENT,
+                 lazy_price_books: bool = False,
+                 feed_recorder: FeedRecorder = None,
+                 conflate_price_books: bool = False,
+                 reconnect_policy: ReconnectPolicy = None):
+        """
+        Runs any number of exchange sessions, each logged in with its own credentials, on one event loop thread and
+        one subscription to the info feed.
+
+        Parameters
+        ----------
+        host: str
+            The network location the Exchange Server runs on.
+        info_port: int
+            The port of the Info interface exposed by the Exchange.
+        exec_port: int
+            The port of the Execution interface exposed by the Exchange.
+        admin_password: str
+            Reserved for dedicated clients only and can be left empty.
+        full_message_logging: bool
+            If set to to True enables logging on VERBOSE level, see Exchange.
+        max_nr_trade_history: int
+            Keep at most this number of trades per instrument in history, for the public trades of the pool as well as
+            the private trades of every session.
+        pump_mode: str
+            'event' or 'poll', see Exchange.
+        lazy_price_books: bool
+            See Exchange.
+        feed_recorder: FeedRecorder
+            See Exchange.
+        conflate_price_books: bool
+            See Exchange.
+        reconnect_policy: ReconnectPolicy
+            If set, lost connections are restored with exponential backoff, see Exchange: the info feed is subscribed to
+            again first, then every connected session logs in again.
+        """
+        if full_message_logging:
+            exchange_client.logger.setLevel('VERBOSE')
+
+        self._host = host
+        self._exec_port = exec_port
+        self._admin_password = admin_password
+        self._max_nr_trade_history = max_nr_trade_history
+        self._pump_mode = pump_mode
+
+        # one sequence for all clients, they all change state on the same thread
+        self._state_sequence = StateSequence()
+        self._info_client = InfoClient(host=host, port=info_port, max_nr_trade_history=max_nr_trade_history,
+                                       lazy_price_books=lazy_price_books, feed_recorder=feed_recorder,
+                                       state_sequence=self._state_sequence, conflate_price_books=conflate_price_books)
+        self._wrapper = SynchronousWrapper([self._info_client], reconnect_policy=reconnect_policy)
+        self._sessions: typing.Dict[str, ExchangeSession] = {}
+
+    def add_session(self,
+                    username: str,
+                    password: str,
+                    cost_basis: str = exchange_client.COST_BASIS_AVERAGE,
+                    name: str = None) -> ExchangeSession:
+        """
+        Adds a session that logs in with its own credentials. It is connected right away if the pool is, otherwise
+        together with the pool.
+
+        Parameters
+        ----------
+        username: str
+            The username of the session.
+        password: str
+            The password of the session.
+        cost_basis: str
+            'average' or 'fifo', see Exchange.
+        name: str
+            The name of the session in get_sessions and get_latency_histograms, the username if None.
+
+        Returns
+        -------
+        ExchangeSession
+            An Exchange for the session, which reads the info feed of the pool.
+        """
+        name = name if name is not None else username
+        if name in self._sessions:
+            raise Exception(f'There already is a session named "{name}" in the pool')
+        exec_client = ExecClient(host=self._host, port=self._exec_port, username=username, password=password,
+                                 admin_password=self._admin_password, max_nr_trade_history=self._max_nr_trade_history,
+                                 pump_mode=self._pump_mode, cost_basis=cost_basis,
+                                 state_sequence=self._state_sequence)
+        session = ExchangeSession(self, name, exec_client)
+        self._sessions[name] = session
+        if self.is_connected():
+            session.connect()
+        return session
+
+    def remove_session(self, name: str) -> None:
+        """
+        Logs out a session and removes it from the pool.
+        """
+        session = self._sessions.pop(name)
+        # also when its connection is lost, so that the pool stops restoring it
+        self._wrapper.unsupervise(session._e)
+        if session._wrapper.is_connected():
+            session.disconnect()
+        if self._wrapper.get_loop().is_running():
+            async def close():
+                session._close()
+
+            self._wrapper.run_on_loop(close(), record_latency=False)
+        else:
+            session._close()
+
+    def get_sessions(self) -> typing.Dict[str, ExchangeSession]:
+        return dict(self._sessions)
+
+    def is_connected(self) -> bool:
+        return self._wrapper.is_connected()
+
+    def connect(self) -> None:
+        """
+        Subscribes to the info feed and logs in every session added so far.
+        """
+        self._wrapper.connect()
+        for session in self._sessions.values():
+            session.connect()
+
+    def disconnect(self) -> None:
+        """
+        Logs out every session and stops the loop thread.
+        """
+        for session in self._sessions.values():
+            if session._wrapper.is_connected():
+                session.disconnect()
+        self._wrapper.disconnect()
+
+    def get_conflation_stats(self) -> typing.Optional[ConflationStats]:
+        return self._info_client.get_conflation_stats()
+
+    def get_reconnect_stats(self) -> typing.Optional[ReconnectStats]:
+        """
+        Returns how often a connection of the pool was lost, of the info feed or of any session, and how long it took
+        until all of them were connected again, None if reconnect_policy is not set.
+        """
+        return self._wrapper.get_reconnect_stats()
+
+    def get_latency_histograms(self) -> typing.Dict[str, typing.Dict[str, LatencyHistogram]]:
+        """
+        Returns the round-trip latency histograms of every session, by session name, see Exchange.get_latency_histograms.
+        """
+        return {name: session.get_latency_histograms() for name, session in self._sessions.items()}
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
@@ -0,0 +1,148 @@
+"""
+Info feed frames on disk, with the time they were received.
+
+A feed file is a sequence of records: a 16 byte header (receive time in nanoseconds since the epoch, frame size, and
+the instrument tag) followed by the capnp frame exactly as it is sent over the raw info connection. Frames are a whole
+number of words, so every frame in the file stays 8 byte aligned and can be read by capnp in place.
+
+The instrument tag numbers the instrument of the message within the file, see feed_recorder; 0 means not known.
+
+Files are read through mmap: the pages are shared between all processes reading the same file, e.g. the workers of a
+parameter sweep, and nothing is decoded that is not asked for.
+"""
+import mmap
+import struct
+import typing
+from datetime import datetime
+
+from .common_types import PriceBook, TradeTick
+from .exchange_client import InfoClient
+from .idl import common_capnp, info_capnp
+
+RECORD_HEADER = struct.Struct('<qII')
+
+_PRICE_BOOK_TYPE_ID = info_capnp.PriceBook.schema.node.id
+_TRADE_TICK_TYPE_ID = common_capnp.TradeTick.schema.node.id
+
+FeedEvent = typing.Union[PriceBook, TradeTick]
+
+
+def _to_ns(timestamp: datetime) -> int:
+    return int(timestamp.timestamp() * 1000000) * 1000
+
+
+def to_frame(message) -> bytes:
+    """
+    Wraps a capnp message in a RawMessage, as on the info connection.
+    """
+    raw = common_capnp.RawMessage.new_message()
+    raw.type = message.schema.node.id
+    raw.msg = message
+    return raw.to_bytes()
+
+
+def price_book_frame(price_book: PriceBook) -> bytes:
+    book = info_capnp.PriceBook.new_message()
+    book.instrumentId = price_book.instrument_id
+    for levels, side in ((price_book.bids, book.init('bids', len(price_book.bids))),
+                         (price_book.asks, book.init('asks', len(price_book.asks)))):
+        for price_volume, level in zip(levels, side):
+            level.price = price_volume.price
+            level.volume = price_volume.volume
+    return to_frame(book)
+
+
+def trade_tick_frame(trade_tick: TradeTick) -> bytes:
+    tick = common_capnp.TradeTick.new_message()
+    tick.tradeId = trade_tick.trade_id
+    tick.timestamp = _to_ns(trade_tick.timestamp)
+    tick.instrumentId = trade_tick.instrument_id
+    tick.price = trade_tick.price
+    tick.volume = trade_tick.volume
+    tick.aggressorSide = trade_tick.aggressor_side
+    tick.buyer = trade_tick.buyer
+    tick.seller = trade_tick.seller
+    return to_frame(tick)
+
+
+def write_record(f: typing.BinaryIO, timestamp_ns: int, frame, instrument_tag: int = 0) -> None:
+    f.write(RECORD_HEADER.pack(timestamp_ns, len(frame), instrument_tag))
+    f.write(frame)
+
+
+def write_events(path: str, events: typing.Iterable[FeedEvent]) -> int:
+    """
+    Writes PriceBook and TradeTick events to a new feed file, each received at its own timestamp. Returns the number
+    of events written.
+    """
+    nr_events = 0
+    with open(path, 'wb') as f:
+        for event in events:
+            if isinstance(event, PriceBook):
+                frame = price_book_frame(event)
+            elif isinstance(event, TradeTick):
+                frame = trade_tick_frame(event)
+            else:
+                raise Exception(f"Cannot write feed event {event}")
+            write_record(f, _to_ns(event.timestamp), frame)
+            nr_events += 1
+    return nr_events
+
+
+def iter_frames(path: str) -> typing.Iterator[typing.Tuple[int, memoryview]]:
+    """
+    Yields (receive time in nanoseconds, frame) for every record of a feed file. A frame is a view into the mapped
+    file, only valid until the next one is requested.
+    """
+    with open(path, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        pos = 0
+        end = len(mapped)
+        while pos + RECORD_HEADER.size <= end:
+            timestamp_ns, size, _ = RECORD_HEADER.unpack_from(mapped, pos)
+            pos += RECORD_HEADER.size
+            if pos + size > end:
+                # the last record of a file that is still being written
+                break
+            frame = view[pos:pos + size]
+            try:
+                yield timestamp_ns, frame
+            finally:
+                frame.release()
+            pos += size
+    finally:
+        view.release()
+        mapped.close()
+
+
+def decode_event(timestamp_ns: int, frame) -> typing.Optional[FeedEvent]:
+    """
+    Turns a PriceBook or TradeTick frame into the corresponding client type, or returns None for other messages. Price
+    books are time stamped with their receive time, like InfoClient does.
+    """
+    with common_capnp.RawMessage.from_bytes(frame) as msg:
+        if msg.type == _PRICE_BOOK_TYPE_ID:
+            return InfoClient._to_price_book(msg.msg.as_struct(info_capnp.PriceBook.schema),
+                                             datetime.fromtimestamp(timestamp_ns / 1000000000))
+        if msg.type == _TRADE_TICK_TYPE_ID:
+            tick = msg.msg.as_struct(common_capnp.TradeTick.schema)
+            return TradeTick(timestamp=datetime.fromtimestamp(tick.timestamp / 1000000000),
+                             instrument_id=tick.instrumentId, price=tick.price, volume=tick.volume,
+                             aggressor_side=str(tick.aggressorSide), buyer=tick.buyer, seller=tick.seller,
+                             trade_id=tick.tradeId)
+    return None
+
+
+def read_events(path: str) -> typing.Iterator[FeedEvent]:
+    """
+    Yields the PriceBook and TradeTick events of a feed file, e.g. as the feed of a BacktestExchange. Other messages
+    are skipped.
+    """
+    for timestamp_ns, frame in iter_frames(path):
+        event = decode_event(timestamp_ns, frame)
+        if event is not None:
+            yield event
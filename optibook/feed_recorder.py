@@ -0,0 +1,298 @@
+"""
+Records the raw info feed as received by an InfoClient, for replay and research later on.
+
+Frames are appended to segment files in the feed_file format, in a directory:
+
+    000001.feed          the records, append-only
+    000001.index.json    written when the segment is complete
+
+A segment is closed and the next one started once it reaches segment_size bytes. The index of a segment maps every
+instrument id to its tag in the record headers, and holds a checkpoint every INDEX_INTERVAL_NS: the offset of the first
+record at or after that time, overall and per instrument. A reader can seek to a time and skip the records of other
+instruments by their header alone, without decoding anything.
+
+The event loop only copies each frame into a buffer. Full buffers are handed to a background thread that works out
+the instrument of every record, fills in the tags, writes to disk and maintains the index.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import typing
+
+from .base_client import read_instrument_id
+from .exchange_client import InfoClient
+from .feed_file import RECORD_HEADER
+from .idl import common_capnp
+
+logger = logging.getLogger('client')
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+DEFAULT_FLUSH_SIZE = 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+INDEX_INTERVAL_NS = 1000000000
+
+SEGMENT_NAME = '{:06d}.feed'
+INDEX_NAME = '{:06d}.index.json'
+_SEGMENT_PATTERN = re.compile(r'^(\d{6})\.feed$')
+
+# the writer thread holds the GIL while it indexes, give it up this often
+_RECORDS_PER_GIL_RELEASE = 64
+
+_TAG = struct.Struct('<I')
+_TAG_OFFSET = 12
+
+# every info message carries the id of its instrument, as its first pointer field
+_SCHEMAS_BY_TYPE = {type_id: schema for type_id, (schema, _) in InfoClient._MESSAGE_HANDLERS.items()}
+
+
+def _read_instrument_id(buf, start: int, end: int) -> typing.Optional[typing.Tuple[int, bytes]]:
+    return read_instrument_id(buf, start, end, _SCHEMAS_BY_TYPE)
+
+
+def segment_numbers(directory: str) -> typing.List[int]:
+    """
+    The numbers of the segments in a recording directory, in order.
+    """
+    return sorted(int(m.group(1)) for m in map(_SEGMENT_PATTERN.match, os.listdir(directory)) if m)
+
+
+class _Segment:
+    def __init__(self, directory: str, number: int):
+        self.number = number
+        self.path = os.path.join(directory, SEGMENT_NAME.format(number))
+        self.index_path = os.path.join(directory, INDEX_NAME.format(number))
+        self.file = open(self.path, 'xb')
+        self.size = 0
+        self.nr_records = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.tags: typing.Dict[str, int] = {}
+        self.checkpoints: typing.List[typing.List[int]] = []
+        self.offsets: typing.Dict[str, typing.List[int]] = {}
+        self._next_checkpoint_ns = None
+
+    def add(self, timestamp_ns: int, instrument_id: str) -> int:
+        """
+        Indexes a record that starts at the current end of the segment, returns its instrument tag.
+        """
+        if self._next_checkpoint_ns is None or timestamp_ns >= self._next_checkpoint_ns:
+            checkpoint_ns = timestamp_ns - timestamp_ns % INDEX_INTERVAL_NS
+            self.checkpoints.append([checkpoint_ns, self.size])
+            self._next_checkpoint_ns = checkpoint_ns + INDEX_INTERVAL_NS
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp_ns
+        self.last_timestamp = timestamp_ns
+        self.nr_records += 1
+
+        if not instrument_id:
+            return 0
+        tag = self.tags.get(instrument_id, None)
+        if tag is None:
+            tag = self.tags[instrument_id] = len(self.tags) + 1
+            self.offsets[instrument_id] = []
+        offsets = self.offsets[instrument_id]
+        # every checkpoint since the previous record of the instrument starts looking here
+        while len(offsets) < len(self.checkpoints):
+            offsets.append(self.size)
+        return tag
+
+    def close(self) -> None:
+        self.file.close()
+        for offsets in self.offsets.values():
+            while len(offsets) < len(self.checkpoints):
+                offsets.append(self.size)
+        index = {
+            'nr_records': self.nr_records,
+            'size': self.size,
+            'first_timestamp': self.first_timestamp,
+            'last_timestamp': self.last_timestamp,
+            'instruments': self.tags,
+            'checkpoints': self.checkpoints,
+            'offsets': self.offsets,
+        }
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+
+
+class FeedRecorder:
+    """
+    Appends info feed frames with their receive time to a segmented log on disk. Pass it to InfoClient or Exchange as
+    feed_recorder to record everything the client receives, and close it when done:
+
+        with FeedRecorder('captures/today') as recorder:
+            exchange = Exchange(feed_recorder=recorder)
+            ...
+
+    A recorder that fails to write, e.g. because the disk is full, logs the error and stops recording; it never
+    raises into the client.
+    """
+    def __init__(self,
+                 directory: str,
+                 *,
+                 segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 flush_size: int = DEFAULT_FLUSH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        """
+        Parameters
+        ----------
+        directory: str
+            Where to write the segments, created if needed. Recording into a directory that already has segments
+            continues after the last one.
+        segment_size: int
+            Bytes after which the next segment is started.
+        flush_size: int
+            Bytes buffered on the event loop before they are handed to the writer thread.
+        flush_interval: float
+            Seconds after which buffered data is handed to the writer thread even if the buffer is not full, also when
+            no more frames arrive.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._segment_size = segment_size
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._flush_interval_ns = int(flush_interval * 1000000000)
+
+        self._buffer = bytearray()
+        self._buffer_since_ns = None
+        self._flush_timer: typing.Optional[asyncio.TimerHandle] = None
+        self._failed = False
+        self._closed = False
+        self.nr_records = 0
+
+        numbers = segment_numbers(directory)
+        self._next_segment_number = numbers[-1] + 1 if numbers else 1
+        self._segment: typing.Optional[_Segment] = None
+        self._instrument_ids: typing.Dict[bytes, str] = {}
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_loop, name='feed-recorder', daemon=True)
+        self._thread.start()
+
+    def record(self, frame, received_ns: int = None) -> None:
+        """
+        Appends a frame. Called on the event loop for every frame received, so it only copies.
+        """
+        if self._failed:
+            return
+        if received_ns is None:
+            received_ns = time.time_ns()
+        buffer = self._buffer
+        buffer += RECORD_HEADER.pack(received_ns, len(frame), 0)
+        buffer += frame
+        self.nr_records += 1
+        if self._buffer_since_ns is None:
+            self._buffer_since_ns = received_ns
+            self._arm_flush_timer()
+        elif len(buffer) >= self._flush_size or received_ns - self._buffer_since_ns >= self._flush_interval_ns:
+            self.flush()
+
+    def _arm_flush_timer(self) -> None:
+        # a quiet feed would otherwise leave the buffer unwritten until the next frame
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not on a loop, e.g. when recording a replay, the interval is only checked as frames arrive
+            return
+        self._flush_timer = loop.call_later(self._flush_interval, self.flush)
+
+    def flush(self) -> None:
+        """
+        Hands the buffered frames to the writer thread, without waiting for them to be written.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._buffer:
+            self._queue.put(self._buffer)
+            self._buffer = bytearray()
+        self._buffer_since_ns = None
+
+    def close(self) -> None:
+        """
+        Writes everything recorded so far, closes the last segment and stops the writer thread.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # writer thread
+
+    def _write_loop(self) -> None:
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    break
+                self._write_chunk(chunk)
+        except Exception:
+            self._failed = True
+            logger.exception(f'feed recorder failed, recording to {self.directory} stopped')
+        finally:
+            if self._segment is not None:
+                try:
+                    self._segment.close()
+                except Exception:
+                    logger.exception(f'feed recorder could not close {self._segment.path}')
+                self._segment = None
+
+    def _instrument_id(self, chunk: bytearray, view: memoryview, start: int, end: int) -> str:
+        found = _read_instrument_id(chunk, start, end)
+        if found is None:
+            with common_capnp.RawMessage.from_bytes(view[start:end]) as msg:
+                schema = _SCHEMAS_BY_TYPE.get(msg.type, None)
+                return msg.msg.as_struct(schema).instrumentId if schema is not None else ''
+        raw_id = found[1]
+        instrument_id = self._instrument_ids.get(raw_id, None)
+        if instrument_id is None:
+            instrument_id = self._instrument_ids[raw_id] = raw_id.decode()
+        return instrument_id
+
+    def _write_chunk(self, chunk: bytearray) -> None:
+        view = memoryview(chunk)
+        pos = 0
+        # the part of the chunk that goes into the current segment
+        start = 0
+        nr_records = 0
+        while pos < len(chunk):
+            nr_records += 1
+            if nr_records % _RECORDS_PER_GIL_RELEASE == 0:
+                # let the event loop thread in, instead of making it wait for the switch interval of the interpreter
+                time.sleep(0)
+            timestamp_ns, size, _ = RECORD_HEADER.unpack_from(chunk, pos)
+            record_size = RECORD_HEADER.size + size
+            segment = self._segment
+            if segment is None or (segment.size + record_size > self._segment_size and segment.nr_records > 0):
+                if segment is not None:
+                    segment.file.write(view[start:pos])
+                    segment.close()
+                segment = self._segment = _Segment(self.directory, self._next_segment_number)
+                self._next_segment_number += 1
+                start = pos
+
+            _TAG.pack_into(chunk, pos + _TAG_OFFSET,
+                           segment.add(timestamp_ns, self._instrument_id(chunk, view, pos + RECORD_HEADER.size,
+                                                                         pos + record_size)))
+            segment.size += record_size
+            pos += record_size
+
+        self._segment.file.write(view[start:pos])
+        # readers of the live segment see whole chunks
+        self._segment.file.flush()
+        view.release()
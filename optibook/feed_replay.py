@@ -0,0 +1,381 @@
+"""
+Replays an info feed recorded by a FeedRecorder (see feed_recorder).
+
+The segments of a recording are read through mmap, one at a time. A time range starts at the index checkpoint just
+before it, and records of instruments that were not asked for are skipped on their header tag, so only what is
+replayed is ever decoded. Pages that have been read are given back to the kernel as the reader moves on, so memory
+use stays flat however large the recording is.
+
+Frames are fed into the handlers of an InfoClient, onPriceBook, onTradeTick and onInstrument*, as if they were
+received again, either as fast as possible or paced to the time they were received:
+
+    capture = FeedCapture('captures/today')
+    client = InfoClient()
+    capture.replay(client, start=datetime(2021, 6, 1, 14), instrument_ids=['PHILIPS_A'], speed=10)
+
+A segment that is still being written, or that was never closed, has no index yet; it is read from the start and
+filtered by decoding the instrument id of every record.
+"""
+import asyncio
+import bisect
+import json
+import mmap
+import os
+import time
+import typing
+from datetime import datetime
+
+from .exchange_client import InfoClient
+from .feed_file import (
+    RECORD_HEADER,
+    FeedEvent,
+    _PRICE_BOOK_TYPE_ID,
+    _TRADE_TICK_TYPE_ID,
+    _to_ns,
+    decode_event,
+    iter_frames as iter_feed_file_frames,
+)
+from .feed_recorder import SEGMENT_NAME, INDEX_NAME, _SCHEMAS_BY_TYPE, _read_instrument_id, segment_numbers
+from .idl import common_capnp
+
+# read pages are dropped from the mapping every this many bytes
+_RELEASE_INTERVAL = 64 * 1024 * 1024
+
+_GENERIC_REPLY_TYPE_ID = common_capnp.GenericReply.schema.node.id
+
+Timestamp = typing.Union[datetime, int]
+
+
+def _as_ns(timestamp: typing.Optional[Timestamp]) -> typing.Optional[int]:
+    if timestamp is None or isinstance(timestamp, int):
+        return timestamp
+    return _to_ns(timestamp)
+
+
+def _frame_instrument_id(frame) -> str:
+    found = _read_instrument_id(frame, 0, len(frame))
+    if found is not None:
+        return found[1].decode()
+    with common_capnp.RawMessage.from_bytes(frame) as msg:
+        schema = _SCHEMAS_BY_TYPE.get(msg.type, None)
+        return msg.msg.as_struct(schema).instrumentId if schema is not None else ''
+
+
+class _RecordedClock:
+    # stands in for time.time in the InfoClient being replayed into
+    __slots__ = ('timestamp_ns',)
+
+    def __init__(self):
+        self.timestamp_ns = 0
+
+    def __call__(self) -> float:
+        return self.timestamp_ns / 1000000000
+
+
+class CaptureSegment:
+    """
+    One segment file of a recording, with its index if it has one.
+    """
+    def __init__(self, directory: str, number: int):
+        self.number = number
+        self.path = os.path.join(directory, SEGMENT_NAME.format(number))
+        self.index = None
+        index_path = os.path.join(directory, INDEX_NAME.format(number))
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+
+    @property
+    def first_timestamp(self) -> typing.Optional[int]:
+        if self.index is not None:
+            return self.index['first_timestamp']
+        with open(self.path, 'rb') as f:
+            header = f.read(RECORD_HEADER.size)
+        return RECORD_HEADER.unpack(header)[0] if len(header) == RECORD_HEADER.size else None
+
+    @property
+    def last_timestamp(self) -> typing.Optional[int]:
+        """
+        The receive time of the last record, None if the segment has no index.
+        """
+        return self.index['last_timestamp'] if self.index is not None else None
+
+    def overlaps(self, start_ns: typing.Optional[int], end_ns: typing.Optional[int]) -> bool:
+        if self.index is None:
+            # still being written, or left behind by a crash; its records have to be looked at
+            return True
+        if self.index['nr_records'] == 0:
+            return False
+        return ((start_ns is None or self.index['last_timestamp'] >= start_ns) and
+                (end_ns is None or self.index['first_timestamp'] < end_ns))
+
+    def _start_offset(self, start_ns: typing.Optional[int], instrument_ids: typing.Optional[typing.Sequence[str]]):
+        if self.index is None or (start_ns is None and instrument_ids is None):
+            return 0
+        checkpoints = self.index['checkpoints']
+        i = 0
+        if start_ns is not None:
+            i = max(bisect.bisect_right([checkpoint[0] for checkpoint in checkpoints], start_ns) - 1, 0)
+        if instrument_ids is None:
+            return checkpoints[i][1] if checkpoints else 0
+        offsets = self.index['offsets']
+        return min((offsets[instrument_id][i] for instrument_id in instrument_ids if instrument_id in offsets),
+                   default=self.index['size'])
+
+    def frames(self,
+               start_ns: int = None,
+               end_ns: int = None,
+               instrument_ids: typing.Collection[str] = None) -> typing.Iterator[typing.Tuple[int, memoryview]]:
+        """
+        Yields (receive time in nanoseconds, frame) for the records in [start_ns, end_ns) of the given instruments.
+        A frame is a view into the mapped segment, only valid until the next one is requested.
+        """
+        tags = None
+        if instrument_ids is not None and self.index is not None:
+            tags = {self.index['instruments'][i] for i in instrument_ids if i in self.index['instruments']}
+            if not tags:
+                return
+
+        with open(self.path, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        try:
+            pos = self._start_offset(start_ns, instrument_ids)
+            end = len(mapped)
+            released = pos - pos % mmap.ALLOCATIONGRANULARITY
+            can_release = hasattr(mapped, 'madvise')
+            header = RECORD_HEADER
+            while pos + header.size <= end:
+                if can_release and pos - released >= _RELEASE_INTERVAL:
+                    # the pages are backed by the file, dropping them only means they are read again if needed
+                    until = pos - pos % mmap.ALLOCATIONGRANULARITY
+                    mapped.madvise(mmap.MADV_DONTNEED, released, until - released)
+                    released = until
+                timestamp_ns, size, tag = header.unpack_from(mapped, pos)
+                if end_ns is not None and timestamp_ns >= end_ns:
+                    break
+                frame_pos = pos + header.size
+                pos = frame_pos + size
+                if pos > end:
+                    # the last record of a segment that is still being written
+                    break
+                if start_ns is not None and timestamp_ns < start_ns:
+                    continue
+                if tags is not None and tag not in tags:
+                    continue
+
+                frame = view[frame_pos:pos]
+                try:
+                    if instrument_ids is not None and tags is None and \
+                            _frame_instrument_id(frame) not in instrument_ids:
+                        continue
+                    yield timestamp_ns, frame
+                finally:
+                    frame.release()
+        finally:
+            view.release()
+            mapped.close()
+
+
+class FeedCapture:
+    """
+    A recording directory written by a FeedRecorder. The segments are listed when it is created; segments that the
+    recorder starts later on are not seen.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.segments = [CaptureSegment(directory, number) for number in segment_numbers(directory)]
+
+    @property
+    def first_timestamp(self) -> typing.Optional[int]:
+        return self.segments[0].first_timestamp if self.segments else None
+
+    @property
+    def last_timestamp(self) -> typing.Optional[int]:
+        """
+        The receive time of the last record, as far as the indexes know.
+        """
+        return next((s.last_timestamp for s in reversed(self.segments) if s.last_timestamp is not None), None)
+
+    def instrument_ids(self) -> typing.Set[str]:
+        """
+        The instruments in the indexed segments.
+        """
+        return {i for segment in self.segments if segment.index is not None for i in segment.index['instruments']}
+
+    def frames(self,
+               start: Timestamp = None,
+               end: Timestamp = None,
+               instrument_ids: typing.Collection[str] = None) -> typing.Iterator[typing.Tuple[int, memoryview]]:
+        """
+        Yields (receive time in nanoseconds, frame) for every record received in [start, end), of the given
+        instruments only if instrument_ids is set. Times are datetimes or nanoseconds since the epoch. A frame is
+        only valid until the next one is requested.
+        """
+        start_ns = _as_ns(start)
+        end_ns = _as_ns(end)
+        if instrument_ids is not None:
+            instrument_ids = set(instrument_ids)
+        for segment in self.segments:
+            if segment.overlaps(start_ns, end_ns):
+                yield from segment.frames(start_ns, end_ns, instrument_ids)
+
+    def events(self,
+               start: Timestamp = None,
+               end: Timestamp = None,
+               instrument_ids: typing.Collection[str] = None) -> typing.Iterator[FeedEvent]:
+        """
+        Yields the PriceBook and TradeTick events in [start, end), e.g. as the feed of a BacktestExchange.
+        """
+        for timestamp_ns, frame in self.frames(start, end, instrument_ids):
+            event = decode_event(timestamp_ns, frame)
+            if event is not None:
+                yield event
+
+    def _instrument_frames(self) -> typing.Iterator[typing.Tuple[int, memoryview]]:
+        # the instrument messages the exchange sends right after subscribing, up to the first book or tick
+        for timestamp_ns, frame in self.frames():
+            with common_capnp.RawMessage.from_bytes(frame) as msg:
+                if msg.type in (_PRICE_BOOK_TYPE_ID, _TRADE_TICK_TYPE_ID):
+                    return
+            yield timestamp_ns, frame
+
+    def _replay_frames(self, client: InfoClient, start, end, instrument_ids):
+        if start is not None and not client._instruments:
+            # a replay that starts later still needs the instruments, for the handlers of the other messages
+            yield from self._instrument_frames()
+        yield from self.frames(start, end, instrument_ids)
+
+    @staticmethod
+    def _dispatch(client: InfoClient, clock: '_RecordedClock', timestamp_ns: int, frame) -> bool:
+        with common_capnp.RawMessage.from_bytes(frame) as msg:
+            entry = client._dispatch_table.get(msg.type, None)
+            if entry is None:
+                # replies to the requests of the recording client
+                if msg.type == _GENERIC_REPLY_TYPE_ID:
+                    return False
+                raise Exception(f"Unknown message in recording {msg}")
+            schema, handler, extra_handlers = entry
+            clock.timestamp_ns = timestamp_ns
+            decoded = msg.msg.as_struct(schema)
+            handler(decoded)
+            for h in extra_handlers:
+                h(decoded)
+            if client._extra_callbacks:
+                for f in client._extra_callbacks.values():
+                    f(msg)
+        return True
+
+    def replay(self,
+               client: InfoClient,
+               start: Timestamp = None,
+               end: Timestamp = None,
+               instrument_ids: typing.Collection[str] = None,
+               speed: float = None) -> int:
+        """
+        Feeds the recorded messages into the handlers of an InfoClient that is not connected, in the order they were
+        received. Price books are time stamped with their receive time.
+
+        Parameters
+        ----------
+        client: InfoClient
+            The client to replay into. Its state is kept, so a replay can continue where the previous one stopped.
+        start: Timestamp
+            Replay from this receive time; the instruments are replayed first if the client does not know any yet.
+        end: Timestamp
+            Replay up to, not including, this receive time.
+        instrument_ids: typing.Collection[str]
+            Only replay the messages of these instruments.
+        speed: float
+            Replay as fast as possible if None, otherwise at this multiple of the speed the messages were received at,
+            e.g. 1.0 for real time.
+
+        Returns
+        -------
+        int
+            The number of messages replayed.
+        """
+        nr_messages = 0
+        first_ns = None
+        started = None
+        clock = client._clock = _RecordedClock()
+        try:
+            for timestamp_ns, frame in self._replay_frames(client, start, end, instrument_ids):
+                if speed is not None:
+                    if first_ns is None:
+                        first_ns, started = timestamp_ns, time.monotonic()
+                    delay = started + (timestamp_ns - first_ns) / 1000000000 / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                nr_messages += self._dispatch(client, clock, timestamp_ns, frame)
+        finally:
+            client._clock = time.time
+        return nr_messages
+
+    async def replay_async(self,
+                           client: InfoClient,
+                           start: Timestamp = None,
+                           end: Timestamp = None,
+                           instrument_ids: typing.Collection[str] = None,
+                           speed: float = None) -> int:
+        """
+        Like replay, but waits on the event loop when pacing, so a strategy running on the same loop sees the
+        messages arrive over time. As fast as possible it still yields to the loop after every message.
+        """
+        nr_messages = 0
+        first_ns = None
+        started = None
+        loop = asyncio.get_running_loop()
+        clock = client._clock = _RecordedClock()
+        try:
+            for timestamp_ns, frame in self._replay_frames(client, start, end, instrument_ids):
+                delay = 0
+                if speed is not None:
+                    if first_ns is None:
+                        first_ns, started = timestamp_ns, loop.time()
+                    delay = max(started + (timestamp_ns - first_ns) / 1000000000 / speed - loop.time(), 0)
+                await asyncio.sleep(delay)
+                nr_messages += self._dispatch(client, clock, timestamp_ns, frame)
+        finally:
+            client._clock = time.time
+        return nr_messages
+
+
+def iter_frames(path: str,
+                start: Timestamp = None,
+                end: Timestamp = None,
+                instrument_ids: typing.Collection[str] = None) -> typing.Iterator[typing.Tuple[int, memoryview]]:
+    """
+    Yields (receive time in nanoseconds, frame) for the records of a recording directory or of a single feed file,
+    see FeedCapture.frames.
+    """
+    if os.path.isdir(path):
+        yield from FeedCapture(path).frames(start, end, instrument_ids)
+        return
+    start_ns = _as_ns(start)
+    end_ns = _as_ns(end)
+    if instrument_ids is not None:
+        instrument_ids = set(instrument_ids)
+    for timestamp_ns, frame in iter_feed_file_frames(path):
+        if end_ns is not None and timestamp_ns >= end_ns:
+            break
+        if (start_ns is None or timestamp_ns >= start_ns) and \
+                (instrument_ids is None or _frame_instrument_id(frame) in instrument_ids):
+            yield timestamp_ns, frame
+
+
+def read_events(path: str,
+                start: Timestamp = None,
+                end: Timestamp = None,
+                instrument_ids: typing.Collection[str] = None) -> typing.Iterator[FeedEvent]:
+    """
+    Yields the PriceBook and TradeTick events of a recording directory or of a single feed file.
+    """
+    for timestamp_ns, frame in iter_frames(path, start, end, instrument_ids):
+        event = decode_event(timestamp_ns, frame)
+        if event is not None:
+            yield event
@@ -0,0 +1,21 @@
+"""
+The capnp schemas of the exchange protocol, as modules: from optibook.idl import info_capnp.
+
+They are compiled once, when this package is imported; the clients need all of them as soon as they are defined.
+Loading goes to the files directly instead of through the import hook of pycapnp, which searches sys.path for them.
+"""
+import os
+
+import capnp
+
+_IDL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load(file_name: str):
+    return capnp.load(os.path.join(_IDL_DIRECTORY, file_name), imports=[_IDL_DIRECTORY])
+
+
+common_capnp = _load('common.capnp')
+info_capnp = _load('info.capnp')
+exec_capnp = _load('exec.capnp')
+management_capnp = _load('management.capnp')
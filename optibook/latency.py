@@ -0,0 +1,74 @@
+import math
+import typing
+
+
+class LatencyHistogram:
+    """
+    Counts latencies in buckets that grow by a factor of two, starting at <min_latency> seconds. The last bucket
+    also counts everything that does not fit in the others.
+
+    Recording is O(1) and does not allocate, so it can be done for every call.
+    """
+    def __init__(self, min_latency: float = 1e-6, nr_buckets: int = 32):
+        self._min_latency = min_latency
+        self._counts = [0] * nr_buckets
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def record(self, latency: float) -> None:
+        if latency <= self._min_latency:
+            bucket = 0
+        else:
+            bucket = min(math.ceil(math.log2(latency / self._min_latency)), len(self._counts) - 1)
+        self._counts[bucket] += 1
+        self._count += 1
+        self._total += latency
+        if latency > self._max:
+            self._max = latency
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def mean(self) -> typing.Optional[float]:
+        return self._total / self._count if self._count else None
+
+    @property
+    def max(self) -> typing.Optional[float]:
+        return self._max if self._count else None
+
+    def buckets(self) -> typing.List[typing.Tuple[float, int]]:
+        """
+        Returns (upper bound in seconds, count) per bucket.
+        """
+        return [(self._min_latency * 2 ** i, count) for i, count in enumerate(self._counts)]
+
+    def percentile(self, pct: float) -> typing.Optional[float]:
+        """
+        Returns the upper bound of the bucket holding the pct-th percentile (pct between 0 and 100), i.e. the
+        percentile rounded up to the next power of two times min_latency.
+        """
+        if not self._count:
+            return None
+        threshold = self._count * pct / 100
+        seen = 0
+        for upper_bound, count in self.buckets():
+            seen += count
+            if seen >= threshold:
+                return min(upper_bound, self._max)
+        return self._max
+
+    def reset(self) -> None:
+        self._counts = [0] * len(self._counts)
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def __repr__(self):
+        if not self._count:
+            return 'LatencyHistogram(count=0)'
+        return f'LatencyHistogram(count={self._count}, mean={self.mean * 1000:.3f}ms, ' \
+               f'p50<={self.percentile(50) * 1000:.3f}ms, p99<={self.percentile(99) * 1000:.3f}ms, ' \
+               f'max={self._max * 1000:.3f}ms)'
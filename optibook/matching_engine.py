@@ -0,0 +1,417 @@
+import itertools
+import time
+import typing
+from bisect import bisect_left, insort
+from datetime import datetime
+
+from .common_types import OrderStatus, Trade, TradeTick, PriceBook, PriceVolume
+from .exchange_client import SIDE_BID, SIDE_ASK, ALL_SIDES, ORDER_TYPE_IOC, ALL_ORDER_TYPES
+from .exchange_responses import InsertOrderResponse, AmendOrderResponse, DeleteOrderResponse
+
+DEFAULT_BOOK_DEPTH = 10
+
+
+class MatchingEngineListener:
+    """
+    Receives the events of a MatchingEngine. They are delivered synchronously, while the request that caused them is
+    being handled. Override the ones of interest, the engine does not build the events nobody listens to.
+    """
+    def on_order_update(self, owner: str, order: OrderStatus) -> None:
+        """
+        An order of owner was added to the book or changed. A volume of 0 means it is gone (filled or deleted).
+        """
+        pass
+
+    def on_trade(self, owner: str, trade: Trade) -> None:
+        """
+        An order of owner traded.
+        """
+        pass
+
+    def on_trade_tick(self, trade_tick: TradeTick) -> None:
+        pass
+
+    def on_book_update(self, instrument_id: str) -> None:
+        """
+        The price book of the instrument changed. Called once per request, not once per change.
+        """
+        pass
+
+
+class _Order:
+    __slots__ = ('order_id', 'owner', 'instrument_id', 'price', 'volume', 'side', 'level', 'prev', 'next')
+
+    def __init__(self, order_id, owner, instrument_id, price, volume, side):
+        self.order_id = order_id
+        self.owner = owner
+        self.instrument_id = instrument_id
+        self.price = price
+        self.volume = volume
+        self.side = side
+        self.level = None
+        self.prev = None
+        self.next = None
+
+    def status(self) -> OrderStatus:
+        return OrderStatus(order_id=self.order_id, instrument_id=self.instrument_id, price=self.price,
+                           volume=self.volume, side=self.side)
+
+
+class _Level:
+    """
+    The orders at one price, in time priority. The orders form a doubly linked list, so that any order can be taken
+    out in O(1).
+    """
+    __slots__ = ('key', 'price', 'volume', 'head', 'tail')
+
+    def __init__(self, key, price):
+        self.key = key
+        self.price = price
+        self.volume = 0
+        self.head = None
+        self.tail = None
+
+    def append(self, order: _Order) -> None:
+        order.level = self
+        order.prev = self.tail
+        order.next = None
+        if self.tail is None:
+            self.head = order
+        else:
+            self.tail.next = order
+        self.tail = order
+        self.volume += order.volume
+
+    def unlink(self, order: _Order) -> None:
+        """
+        Takes the order out of the queue, without touching the volume of the level.
+        """
+        if order.prev is None:
+            self.head = order.next
+        else:
+            order.prev.next = order.next
+        if order.next is None:
+            self.tail = order.prev
+        else:
+            order.next.prev = order.prev
+        order.level = order.prev = order.next = None
+
+
+class _BookSide:
+    """
+    The price levels of one side of a book, indexed by tick. Levels are kept by key, which is the tick for bids and
+    minus the tick for asks, so that on both sides the best level has the highest key and sits at the end of the sorted
+    list of keys: trading away or adding the best level, the common cases, are O(1).
+
+    The top depth levels are kept as a ready list of PriceVolume, updated with every change instead of being rebuilt
+    for every snapshot. Snapshots share the list, it is copied before the next change.
+    """
+    def __init__(self, side: str, depth: int):
+        self.side = side
+        self.sign = 1 if side == SIDE_BID else -1
+        self.keys = []
+        self.levels: typing.Dict[int, _Level] = {}
+        self.depth = depth
+        self._top: typing.List[PriceVolume] = []
+        self._top_shared = False
+
+    def best(self) -> typing.Optional[_Level]:
+        return self.levels[self.keys[-1]] if self.keys else None
+
+    def top(self) -> typing.List[PriceVolume]:
+        self._top_shared = True
+        return self._top
+
+    def _mutable_top(self) -> typing.List[PriceVolume]:
+        if self._top_shared:
+            self._top = list(self._top)
+            self._top_shared = False
+        return self._top
+
+    def _rank(self, key: int) -> int:
+        """
+        The position of the level from the best, or -1 if it is not in the top depth levels.
+        """
+        keys = self.keys
+        if len(keys) > self.depth and key < keys[-self.depth]:
+            return -1
+        return len(keys) - 1 - bisect_left(keys, key)
+
+    def add(self, order: _Order, tick: int) -> None:
+        key = self.sign * tick
+        level = self.levels.get(key, None)
+        if level is None:
+            level = self.levels[key] = _Level(key, order.price)
+            keys = self.keys
+            if not keys or key > keys[-1]:
+                keys.append(key)
+            else:
+                insort(keys, key)
+            level.append(order)
+            rank = self._rank(key)
+            if rank >= 0:
+                top = self._mutable_top()
+                top.insert(rank, PriceVolume(level.price, level.volume))
+                if len(top) > self.depth:
+                    top.pop()
+        else:
+            level.append(order)
+            self._update_top(level)
+
+    def _update_top(self, level: _Level) -> None:
+        rank = self._rank(level.key)
+        if rank >= 0:
+            self._mutable_top()[rank] = PriceVolume(level.price, level.volume)
+
+    def reduce(self, level: _Level, volume: int) -> None:
+        """
+        Lowers the volume of a level that stays in the book.
+        """
+        level.volume -= volume
+        self._update_top(level)
+
+    def remove(self, level: _Level) -> None:
+        keys = self.keys
+        rank = self._rank(level.key)
+        if level.key == keys[-1]:
+            keys.pop()
+        else:
+            del keys[bisect_left(keys, level.key)]
+        del self.levels[level.key]
+        if rank >= 0:
+            top = self._mutable_top()
+            del top[rank]
+            if len(keys) >= self.depth:
+                # the next level moves up into the top
+                next_level = self.levels[keys[-self.depth]]
+                top.append(PriceVolume(next_level.price, next_level.volume))
+
+    def remove_order(self, order: _Order) -> None:
+        level = order.level
+        level.unlink(order)
+        if level.head is None:
+            self.remove(level)
+        else:
+            self.reduce(level, order.volume)
+
+    def price_levels(self, nr_levels: int = None) -> typing.List[typing.Tuple[float, int]]:
+        levels = self.levels
+        return [(levels[key].price, levels[key].volume) for key in itertools.islice(reversed(self.keys), nr_levels)]
+
+
+class _Book:
+    def __init__(self, instrument_id: str, tick_size: float, depth: int):
+        self.instrument_id = instrument_id
+        self.tick_size = tick_size
+        self.sides = {SIDE_BID: _BookSide(SIDE_BID, depth), SIDE_ASK: _BookSide(SIDE_ASK, depth)}
+
+
+class MatchingEngine:
+    """
+    A limit order book per instrument with price-time priority, handling the requests of the Exec interface:
+    insert (limit and ioc), amend, delete and delete all.
+
+    Prices must lie on the tick grid of the instrument. Amending can only lower the volume of an order, which keeps its
+    place in the queue.
+
+    Orders belong to an owner, e.g. a username, and are looked up by id in O(1). Events are reported to the listener.
+    The top book_depth levels of every book are maintained incrementally, see get_price_book.
+    """
+    def __init__(self, listener: MatchingEngineListener = None, clock: typing.Callable[[], int] = time.time_ns,
+                 book_depth: int = DEFAULT_BOOK_DEPTH, first_trade_id: int = 1):
+        """
+        clock returns the current time in nanoseconds since the epoch, used to time stamp trades and price books.
+        Trade ids count up from first_trade_id, so that they can be kept apart from those of another source.
+        """
+        self._clock = clock
+        self._book_depth = book_depth
+        self._books: typing.Dict[str, _Book] = {}
+        self._orders: typing.Dict[int, _Order] = {}
+        self._orders_by_owner: typing.Dict[typing.Tuple[str, str], typing.Dict[int, _Order]] = {}
+        self._next_order_id = 1
+        self._next_trade_id = first_trade_id
+        self.listener = listener or MatchingEngineListener()
+
+    @property
+    def listener(self) -> MatchingEngineListener:
+        return self._listener
+
+    @listener.setter
+    def listener(self, listener: MatchingEngineListener) -> None:
+        self._listener = listener
+        listener_type = type(listener)
+        self._wants_order_updates = listener_type.on_order_update is not MatchingEngineListener.on_order_update
+        self._wants_trades = listener_type.on_trade is not MatchingEngineListener.on_trade
+        self._wants_trade_ticks = listener_type.on_trade_tick is not MatchingEngineListener.on_trade_tick
+
+    def add_instrument(self, instrument_id: str, tick_size: float) -> None:
+        assert instrument_id not in self._books, f"Instrument {instrument_id} already exists"
+        assert tick_size > 0, "tick_size must be positive"
+        self._books[instrument_id] = _Book(instrument_id, tick_size, self._book_depth)
+
+    def get_instrument_ids(self) -> typing.List[str]:
+        return list(self._books)
+
+    @staticmethod
+    def _to_tick(book: _Book, price: float) -> typing.Optional[int]:
+        tick = round(price / book.tick_size)
+        if abs(tick * book.tick_size - price) > 1e-9 * max(1.0, abs(price)):
+            return None
+        return tick
+
+    def insert_order(self, owner: str, instrument_id: str, price: float, volume: int, side: str,
+                     order_type: str) -> InsertOrderResponse:
+        book = self._books.get(instrument_id, None)
+        if book is None:
+            return InsertOrderResponse(success=False, order_id=None, error_reason=f"Unknown instrument {instrument_id}")
+        if side not in ALL_SIDES:
+            return InsertOrderResponse(success=False, order_id=None, error_reason=f"Invalid side {side}")
+        if order_type not in ALL_ORDER_TYPES:
+            return InsertOrderResponse(success=False, order_id=None, error_reason=f"Invalid order type {order_type}")
+        if volume <= 0:
+            return InsertOrderResponse(success=False, order_id=None, error_reason="Volume must be positive")
+        tick = self._to_tick(book, price)
+        if tick is None:
+            return InsertOrderResponse(success=False, order_id=None,
+                                       error_reason=f"Price {price} is not a multiple of the tick size {book.tick_size}")
+
+        order_id = self._next_order_id
+        self._next_order_id += 1
+        order = _Order(order_id, owner, instrument_id, round(tick * book.tick_size, 10), volume, side)
+
+        book_changed = self._match(book, order, tick)
+        if order.volume > 0 and order_type != ORDER_TYPE_IOC:
+            book.sides[side].add(order, tick)
+            self._orders[order_id] = order
+            owner_orders = self._orders_by_owner.get((owner, instrument_id), None)
+            if owner_orders is None:
+                owner_orders = self._orders_by_owner[(owner, instrument_id)] = {}
+            owner_orders[order_id] = order
+            if self._wants_order_updates:
+                self._listener.on_order_update(owner, order.status())
+            book_changed = True
+
+        if book_changed:
+            self._listener.on_book_update(instrument_id)
+        return InsertOrderResponse(success=True, order_id=order_id, error_reason=None)
+
+    def _match(self, book: _Book, order: _Order, tick: int) -> bool:
+        passive_side = book.sides[SIDE_ASK if order.side == SIDE_BID else SIDE_BID]
+        keys = passive_side.keys
+        # the passive level is reachable while its key is at least this
+        limit_key = passive_side.sign * tick
+        timestamp = None
+        while order.volume > 0 and keys and keys[-1] >= limit_key:
+            level = passive_side.levels[keys[-1]]
+            traded = 0
+            while order.volume > 0 and level.head is not None:
+                passive = level.head
+                volume = min(order.volume, passive.volume)
+                order.volume -= volume
+                passive.volume -= volume
+                traded += volume
+                if passive.volume == 0:
+                    level.unlink(passive)
+                    self._forget(passive)
+                if timestamp is None:
+                    # all trades of one request happen at the same time
+                    timestamp = datetime.fromtimestamp(self._clock() / 1000000000)
+                self._report_trade(order, passive, volume, timestamp)
+
+            if level.head is None:
+                passive_side.remove(level)
+            else:
+                passive_side.reduce(level, traded)
+        return timestamp is not None
+
+    def _report_trade(self, aggressor: _Order, passive: _Order, volume: int, timestamp: datetime) -> None:
+        trade_id = self._next_trade_id
+        self._next_trade_id += 1
+
+        listener = self._listener
+        price = passive.price
+        if self._wants_order_updates:
+            listener.on_order_update(passive.owner, passive.status())
+        if self._wants_trades:
+            for order in (passive, aggressor):
+                listener.on_trade(order.owner, Trade(timestamp=timestamp, order_id=order.order_id, trade_id=trade_id,
+                                                     instrument_id=order.instrument_id, price=price, volume=volume,
+                                                     side=order.side))
+        if self._wants_trade_ticks:
+            buyer, seller = (aggressor, passive) if aggressor.side == SIDE_BID else (passive, aggressor)
+            listener.on_trade_tick(TradeTick(timestamp=timestamp, instrument_id=aggressor.instrument_id, price=price,
+                                             volume=volume, aggressor_side=aggressor.side, buyer=buyer.owner,
+                                             seller=seller.owner, trade_id=trade_id))
+
+    def _forget(self, order: _Order) -> None:
+        del self._orders[order.order_id]
+        del self._orders_by_owner[(order.owner, order.instrument_id)][order.order_id]
+
+    def _find(self, owner: str, instrument_id: str, order_id: int) -> typing.Optional[_Order]:
+        order = self._orders.get(order_id, None)
+        if order is None or order.owner != owner or order.instrument_id != instrument_id:
+            return None
+        return order
+
+    def amend_order(self, owner: str, instrument_id: str, order_id: int, volume: int) -> AmendOrderResponse:
+        order = self._find(owner, instrument_id, order_id)
+        if order is None:
+            return AmendOrderResponse(success=False, error_reason=f"Order {order_id} not found")
+        if volume <= 0:
+            return AmendOrderResponse(success=False, error_reason="Volume must be positive, use delete to remove an order")
+        if volume > order.volume:
+            return AmendOrderResponse(success=False, error_reason="Amending can only lower the volume of an order")
+        if volume < order.volume:
+            self._books[instrument_id].sides[order.side].reduce(order.level, order.volume - volume)
+            order.volume = volume
+            if self._wants_order_updates:
+                self._listener.on_order_update(owner, order.status())
+            self._listener.on_book_update(instrument_id)
+        return AmendOrderResponse(success=True, error_reason=None)
+
+    def _delete(self, book: _Book, order: _Order) -> None:
+        book.sides[order.side].remove_order(order)
+        self._forget(order)
+        order.volume = 0
+        if self._wants_order_updates:
+            self._listener.on_order_update(order.owner, order.status())
+
+    def delete_order(self, owner: str, instrument_id: str, order_id: int) -> DeleteOrderResponse:
+        order = self._find(owner, instrument_id, order_id)
+        if order is None:
+            return DeleteOrderResponse(success=False, error_reason=f"Order {order_id} not found")
+        self._delete(self._books[instrument_id], order)
+        self._listener.on_book_update(instrument_id)
+        return DeleteOrderResponse(success=True, error_reason=None)
+
+    def delete_orders(self, owner: str, instrument_id: str) -> DeleteOrderResponse:
+        book = self._books.get(instrument_id, None)
+        if book is None:
+            return DeleteOrderResponse(success=False, error_reason=f"Unknown instrument {instrument_id}")
+        orders = list(self._orders_by_owner.get((owner, instrument_id), {}).values())
+        for order in orders:
+            self._delete(book, order)
+        if orders:
+            self._listener.on_book_update(instrument_id)
+        return DeleteOrderResponse(success=True, error_reason=None)
+
+    def get_outstanding_orders(self, owner: str, instrument_id: str) -> typing.Dict[int, OrderStatus]:
+        return {order_id: order.status()
+                for order_id, order in self._orders_by_owner.get((owner, instrument_id), {}).items()}
+
+    def get_price_book(self, instrument_id: str) -> PriceBook:
+        """
+        Returns the top book_depth levels of the instrument. Cheap: the levels are kept up to date as orders change.
+        The lists of the book must not be modified.
+        """
+        book = self._books[instrument_id]
+        return PriceBook(timestamp=datetime.fromtimestamp(self._clock() / 1000000000), instrument_id=instrument_id,
+                         bids=book.sides[SIDE_BID].top(), asks=book.sides[SIDE_ASK].top())
+
+    def get_price_levels(self, instrument_id: str, nr_levels: int = None) \
+            -> typing.Tuple[typing.List[typing.Tuple[float, int]], typing.List[typing.Tuple[float, int]]]:
+        """
+        Returns the (price, volume) levels of the bids and of the asks, best first, up to any depth.
+        """
+        book = self._books[instrument_id]
+        return book.sides[SIDE_BID].price_levels(nr_levels), book.sides[SIDE_ASK].price_levels(nr_levels)
@@ -0,0 +1,183 @@
+"""
+Runs a strategy against a BacktestExchange for many sets of parameters, spread over all cores.
+
+The market data is a feed file (see feed_file) or a recording directory (see feed_replay) that every worker maps into
+memory, so it is read from disk once and shared through the page cache instead of being pickled to every process.
+Each trial replays the whole feed with its own parameters and reports its PnL, number of trades, largest position and
+largest drawdown. A trial stops early once a position goes over the position limit.
+
+The strategy is created by a picklable function make_strategy(exchange, parameters) returning an object with a run()
+method, which is called once per cycle, like the main loop of bot.py.
+"""
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import typing
+
+from .backtester import BacktestExchange
+from .common_types import Instrument
+from .feed_replay import read_events
+
+Parameters = typing.Dict[str, typing.Any]
+
+
+class TrialResult(typing.NamedTuple):
+    """
+    The outcome of one trial.
+
+    Attributes
+    ----------
+    parameters: Parameters
+    pnl: float
+        The PnL at the end of the trial, valued at the last traded prices.
+    nr_trades: int
+    max_position: int
+        The largest absolute position in any instrument.
+    max_drawdown: float
+        The largest drop of the PnL from its highest point so far, measured once per cycle.
+    nr_cycles: int
+    stopped_early: bool
+        True if the trial was stopped because a position went over the limit.
+    """
+    parameters: Parameters
+    pnl: float
+    nr_trades: int
+    max_position: int
+    max_drawdown: float
+    nr_cycles: int
+    stopped_early: bool
+
+
+def grid(**values: typing.Sequence) -> typing.List[Parameters]:
+    """
+    Every combination of the given values, e.g. grid(LEVEL=[0.1, 0.2], OWN_WEIGHT=[0.01, 0.03]) gives four sets.
+    """
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+def random_search(nr_trials: int, seed: int = None, **ranges) -> typing.List[Parameters]:
+    """
+    nr_trials random sets of parameters. A range is either a (low, high) tuple, drawn from uniformly, or a list to
+    pick from.
+    """
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(nr_trials):
+        trials.append({name: rng.uniform(*value) if isinstance(value, tuple) else rng.choice(value)
+                       for name, value in ranges.items()})
+    return trials
+
+
+@contextlib.contextmanager
+def _quiet():
+    # strategies print and log as they trade, which would dominate a trial
+    logging.disable(logging.WARNING)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def run_trial(feed_path: str,
+              instruments: typing.Sequence[Instrument],
+              make_strategy: typing.Callable[[BacktestExchange, Parameters], typing.Any],
+              parameters: Parameters,
+              *,
+              cycle_seconds: float = 0.3,
+              position_limit: int = None,
+              quiet: bool = True) -> TrialResult:
+    """
+    Runs one trial in the current process. See sweep for the parameters.
+    """
+    exchange = BacktestExchange(instruments, read_events(feed_path))
+    pnl = peak = 0.0
+    max_position = 0
+    max_drawdown = 0.0
+    nr_cycles = 0
+    stopped_early = False
+    with _quiet() if quiet else contextlib.nullcontext():
+        strategy = make_strategy(exchange, parameters)
+        while exchange.advance(cycle_seconds):
+            strategy.run()
+            nr_cycles += 1
+
+            position = max((abs(volume) for volume in exchange.get_positions().values()), default=0)
+            max_position = max(max_position, position)
+            current_pnl = exchange.get_pnl()
+            if current_pnl is not None:
+                pnl = current_pnl
+                peak = max(peak, pnl)
+                max_drawdown = max(max_drawdown, peak - pnl)
+            if position_limit is not None and position > position_limit:
+                stopped_early = True
+                break
+
+    return TrialResult(parameters=parameters, pnl=pnl, nr_trades=exchange.nr_trades, max_position=max_position,
+                       max_drawdown=max_drawdown, nr_cycles=nr_cycles, stopped_early=stopped_early)
+
+
+def sweep(feed_path: str,
+          instruments: typing.Sequence[Instrument],
+          make_strategy: typing.Callable[[BacktestExchange, Parameters], typing.Any],
+          parameter_sets: typing.Sequence[Parameters],
+          *,
+          cycle_seconds: float = 0.3,
+          position_limit: int = None,
+          max_workers: int = None) -> typing.List[TrialResult]:
+    """
+    Runs a trial for every set of parameters, in parallel.
+
+    Parameters
+    ----------
+    feed_path: str
+        The feed file or recording directory to replay in every trial.
+    instruments: typing.Sequence[Instrument]
+        The instruments of the feed.
+    make_strategy: typing.Callable[[BacktestExchange, Parameters], typing.Any]
+        Creates the strategy for a trial. It is sent to the workers, so it must be a module level function.
+    parameter_sets: typing.Sequence[Parameters]
+        One dict of parameters per trial, see grid and random_search.
+    cycle_seconds: float
+        Virtual seconds between calls to the run() method of the strategy.
+    position_limit: int
+        Stop a trial once the absolute position in an instrument goes over this.
+    max_workers: int
+        The number of worker processes, by default one per core.
+
+    Returns
+    -------
+    typing.List[TrialResult]
+        The results, in the order of parameter_sets.
+    """
+    # spawned rather than forked, the capnp event loop thread of this process does not survive a fork
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(run_trial, feed_path, instruments, make_strategy, parameters,
+                                   cycle_seconds=cycle_seconds, position_limit=position_limit)
+                   for parameters in parameter_sets]
+        return [fut.result() for fut in futures]
+
+
+def _format_value(value) -> str:
+    return f'{value:.4g}' if isinstance(value, float) else str(value)
+
+
+def format_table(results: typing.Sequence[TrialResult], sort_by: str = 'pnl') -> str:
+    """
+    Formats results as a text table, one row per trial, best first.
+    """
+    names = sorted({name for result in results for name in result.parameters})
+    header = names + ['pnl', 'trades', 'max_pos', 'drawdown', 'cycles', 'stopped']
+    rows = []
+    for result in sorted(results, key=lambda r: getattr(r, sort_by), reverse=True):
+        rows.append([_format_value(result.parameters.get(name, '')) for name in names] +
+                    [f'{result.pnl:.2f}', str(result.nr_trades), str(result.max_position),
+                     f'{result.max_drawdown:.2f}', str(result.nr_cycles), 'yes' if result.stopped_early else ''])
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in [header] + rows)
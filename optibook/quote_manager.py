@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import typing
+from collections import defaultdict
+
+from .common_types import OrderStatus
+from .exchange_client import ExecClient, ALL_SIDES, ORDER_TYPE_LIMIT
+from .exchange_responses import InsertOrderResponse, AmendOrderResponse, DeleteOrderResponse
+
+logger = logging.getLogger("client")
+
+# Prices of targets and of outstanding orders are compared after rounding, so that e.g. 100.0 + 3 * 0.1 matches an
+# order at 100.3.
+PRICE_DECIMALS = 6
+
+Quote = typing.Tuple[float, int, str]
+
+class QuoteUpdateReport(typing.NamedTuple):
+    """
+    What a QuoteManager.update_quotes cycle sent to the exchange.
+
+    Attributes
+    ----------
+    nr_inserts: int
+    nr_amends: int
+    nr_deletes: int
+        Single-order deletes plus delete-all requests.
+    nr_kept: int
+        Outstanding orders that were left untouched, keeping their queue priority.
+    nr_failed: int
+        Requests the exchange rejected.
+    nr_rpcs_naive: int
+        Requests needed to reach the same quotes by deleting all orders per instrument and inserting every quote.
+    """
+    nr_inserts: int
+    nr_amends: int
+    nr_deletes: int
+    nr_kept: int
+    nr_failed: int
+    nr_rpcs_naive: int
+
+    @property
+    def nr_rpcs(self) -> int:
+        return self.nr_inserts + self.nr_amends + self.nr_deletes
+
+    @property
+    def nr_rpcs_saved(self) -> int:
+        return self.nr_rpcs_naive - self.nr_rpcs
+
+
+class QuotePlan(typing.NamedTuple):
+    """
+    The requests of one QuoteManager cycle. Inserts, amends and deletes are dicts with the arguments of the
+    corresponding ExecClient methods.
+    """
+    delete_alls: typing.List[str]
+    deletes: typing.List[typing.Dict[str, typing.Any]]
+    amends: typing.List[typing.Dict[str, typing.Any]]
+    inserts: typing.List[typing.Dict[str, typing.Any]]
+    nr_kept: int
+    nr_rpcs_naive: int
+    deleted_by_delete_all: typing.Dict[str, typing.List[int]]
+
+
+class QuoteManager:
+    """
+    Moves the outstanding limit orders of an ExecClient to a target ladder with as few requests as possible.
+
+    For every (side, price) the outstanding orders are matched against the target volume, oldest order first. Orders
+    that fit are kept, the first order that does not fit is amended down to the remaining volume, and the rest is
+    deleted. Volume still missing is inserted as a new order. Levels that did not change are therefore not touched at
+    all and keep their place in the queue.
+
+    The outstanding orders are those reported on the exec feed (ExecClient._order_status_by_order_id). The replies of
+    a cycle are applied to that view too, so the next cycle sees its own inserts even if the feed has not reported
+    them yet.
+    """
+    def __init__(self, exec_client: ExecClient):
+        self._exec = exec_client
+
+    def _plan_instrument(self, instrument_id: str, quotes: typing.Iterable[Quote], inserts: list, amends: list,
+                         deletes: list) -> int:
+        target_volumes = defaultdict(int)
+        for price, volume, side in quotes:
+            assert side in ALL_SIDES, f"side must be one of {ALL_SIDES}"
+            if volume > 0:
+                target_volumes[(side, round(price, PRICE_DECIMALS))] += volume
+
+        orders_by_level = defaultdict(list)
+        for order in self._exec._order_status_by_order_id[instrument_id].values():
+            orders_by_level[(order.side, round(order.price, PRICE_DECIMALS))].append(order)
+
+        nr_kept = 0
+        for level, orders in orders_by_level.items():
+            remaining = target_volumes.pop(level, 0)
+            # order ids increase with time, so this is queue priority
+            for order in sorted(orders, key=lambda o: o.order_id):
+                if remaining >= order.volume:
+                    remaining -= order.volume
+                    nr_kept += 1
+                elif remaining > 0:
+                    amends.append(dict(instrument_id=instrument_id, order_id=order.order_id, volume=remaining))
+                    remaining = 0
+                else:
+                    deletes.append(dict(instrument_id=instrument_id, order_id=order.order_id))
+            if remaining > 0:
+                target_volumes[level] = remaining
+
+        for (side, price), volume in target_volumes.items():
+            inserts.append(dict(instrument_id=instrument_id, price=price, volume=volume, side=side,
+                                order_type=ORDER_TYPE_LIMIT))
+        return nr_kept
+
+    def plan(self, targets: typing.Dict[str, typing.Sequence[Quote]]) -> QuotePlan:
+        """
+        Works out the requests update_quotes sends, without sending them. Pass the plan and the responses to the
+        requests to apply() afterwards.
+        """
+        inserts, amends, deletes, delete_alls = [], [], [], []
+        nr_kept = 0
+        nr_rpcs_naive = 0
+        for instrument_id, quotes in targets.items():
+            instrument_inserts, instrument_amends, instrument_deletes = [], [], []
+            instrument_kept = self._plan_instrument(instrument_id, quotes, instrument_inserts, instrument_amends,
+                                                    instrument_deletes)
+            quotes = [(price, volume, side) for price, volume, side in quotes if volume > 0]
+            naive = 1 + len(quotes)
+            nr_rpcs_naive += naive
+
+            if len(instrument_inserts) + len(instrument_amends) + len(instrument_deletes) > naive:
+                delete_alls.append(instrument_id)
+                inserts.extend(dict(instrument_id=instrument_id, price=price, volume=volume, side=side,
+                                    order_type=ORDER_TYPE_LIMIT) for price, volume, side in quotes)
+            else:
+                inserts.extend(instrument_inserts)
+                amends.extend(instrument_amends)
+                deletes.extend(instrument_deletes)
+                nr_kept += instrument_kept
+
+        return QuotePlan(
+            delete_alls=delete_alls,
+            deletes=deletes,
+            amends=amends,
+            inserts=inserts,
+            nr_kept=nr_kept,
+            nr_rpcs_naive=nr_rpcs_naive,
+            # the orders a delete-all removes are known now, orders inserted after it must survive it
+            deleted_by_delete_all={instrument_id: list(self._exec._order_status_by_order_id[instrument_id])
+                                   for instrument_id in delete_alls},
+        )
+
+    async def update_quotes(self, targets: typing.Dict[str, typing.Sequence[Quote]]) -> QuoteUpdateReport:
+        """
+        Brings the outstanding orders of every instrument in targets to the given quotes. Instruments that are not in
+        targets are left alone; pass an empty list to pull all quotes of an instrument.
+
+        When matching order by order would take more requests than deleting all orders of the instrument and inserting
+        the quotes again, e.g. because the whole ladder moved, the latter is done instead.
+
+        Parameters
+        ----------
+        targets: typing.Dict[str, typing.Sequence[Quote]]
+            Per instrument_id, the wanted (price, volume, side) quotes. Quotes on the same side and price are added up.
+
+        Returns
+        -------
+        QuoteUpdateReport
+            The number of requests sent, and how many that saved compared to deleting and re-inserting everything.
+        """
+        plan = self.plan(targets)
+
+        # deletes go out first, so that the exchange never sees the old and the new quotes at the same time
+        _, delete_responses, amend_responses, insert_responses = await asyncio.gather(
+            asyncio.gather(*[self._exec.delete_orders(instrument_id) for instrument_id in plan.delete_alls]),
+            self._exec.delete_orders_by_id(plan.deletes),
+            self._exec.amend_orders(plan.amends),
+            self._exec.insert_orders(plan.inserts),
+        )
+        return self.apply(plan, delete_responses, amend_responses, insert_responses)
+
+    def apply(self, plan: QuotePlan, delete_responses: typing.Sequence[DeleteOrderResponse],
+              amend_responses: typing.Sequence[AmendOrderResponse],
+              insert_responses: typing.Sequence[InsertOrderResponse]) -> QuoteUpdateReport:
+        """
+        Applies the responses to the requests of a plan to the view of the outstanding orders.
+        """
+        deletes, amends, inserts = plan.deletes, plan.amends, plan.inserts
+        nr_failed = 0
+        order_status = self._exec._order_status_by_order_id
+        # the view of the outstanding orders is part of what get_snapshot copies, see state_snapshot
+        state_sequence = self._exec._state_sequence
+        state_sequence.begin_write()
+        try:
+            for instrument_id, order_ids in plan.deleted_by_delete_all.items():
+                for order_id in order_ids:
+                    order_status[instrument_id].pop(order_id, None)
+            # an order whose delete or amend failed is kept, if it is gone onOrderUpdate removes it
+            for delete, response in zip(deletes, delete_responses):
+                if response.success:
+                    order_status[delete['instrument_id']].pop(delete['order_id'], None)
+                nr_failed += not response.success
+            for amend, response in zip(amends, amend_responses):
+                orders = order_status[amend['instrument_id']]
+                if not response.success:
+                    nr_failed += 1
+                elif amend['order_id'] in orders:
+                    order = orders[amend['order_id']]
+                    orders[amend['order_id']] = OrderStatus(order_id=order.order_id, instrument_id=order.instrument_id,
+                                                            price=order.price, volume=amend['volume'], side=order.side)
+            # an insert that traded before its reply arrived may already have been reported and removed by the feed
+            traded_order_ids = {trade.order_id for instrument_id in {insert['instrument_id'] for insert in inserts}
+                                for trade in self._exec._trade_history[instrument_id]}
+            for insert, response in zip(inserts, insert_responses):
+                if not response.success:
+                    nr_failed += 1
+                    continue
+                if response.order_id in traded_order_ids:
+                    continue
+                order_status[insert['instrument_id']].setdefault(response.order_id, OrderStatus(
+                    order_id=response.order_id,
+                    instrument_id=insert['instrument_id'],
+                    price=insert['price'],
+                    volume=insert['volume'],
+                    side=insert['side'],
+                ))
+        finally:
+            state_sequence.end_write()
+
+        report = QuoteUpdateReport(
+            nr_inserts=len(inserts),
+            nr_amends=len(amends),
+            nr_deletes=len(deletes) + len(plan.delete_alls),
+            nr_kept=plan.nr_kept,
+            nr_failed=nr_failed,
+            nr_rpcs_naive=plan.nr_rpcs_naive,
+        )
+        logger.debug(f"quote update: {report.nr_rpcs} requests ({report.nr_rpcs_saved} saved), "
+                     f"{plan.nr_kept} orders kept")
+        return report
@@ -0,0 +1,496 @@
+"""
+A local stand-in for the exchange, to develop and benchmark against without a connection to a live instance.
+
+It serves the raw info feed and the capnp Exec interface on two ports, like the real exchange, so an unmodified
+Exchange can connect to it:
+
+    python -m optibook.simulated_exchange --info-port 7001 --exec-port 8001
+
+    Exchange(host='127.0.0.1', info_port=7001, exec_port=8001, username='me', password='anything')
+
+Orders are matched with price-time priority by a MatchingEngine. Synthetic order flow keeps the books moving: per
+instrument a market maker quotes a ladder around a random-walk fair value and takers trade against it at random.
+Any username and password are accepted.
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import math
+import random
+import socket
+import time
+import typing
+
+import capnp
+
+from .base_client import FrameDecoder, READ_CHUNK_SIZE
+from .common_types import Instrument, OrderStatus, Trade, TradeTick
+from .exchange_client import SIDE_BID, SIDE_ASK, ORDER_TYPE_LIMIT, ORDER_TYPE_IOC
+from .feed_file import _to_ns, to_frame, price_book_frame, trade_tick_frame
+from .idl import common_capnp, exec_capnp, info_capnp
+from .matching_engine import MatchingEngine, MatchingEngineListener
+
+logger = logging.getLogger('simulated_exchange')
+
+MARKET_MAKER = 'sim_market_maker'
+TAKER = 'sim_taker'
+
+# feed calls are cancelled when their promise is dropped, keep them around well past the time they take to arrive
+FEED_PROMISE_RETENTION = 5.0
+# subscribers that do not keep up with the info feed are disconnected once this much data is queued for them
+MAX_INFO_WRITE_BUFFER = 64 * 1024 * 1024
+
+
+class SyntheticOrderFlow:
+    """
+    Keeps the book of one instrument moving. The fair value follows a random walk, a market maker quotes nr_levels
+    levels of level_volume on each side around it, and takers send IOC orders at a rate of taker_rate per second.
+    """
+    def __init__(self,
+                 engine: MatchingEngine,
+                 instrument_id: str,
+                 tick_size: float,
+                 *,
+                 start_price: float = 100.0,
+                 volatility: float = 0.05,
+                 nr_levels: int = 5,
+                 level_volume: int = 20,
+                 half_spread_ticks: int = 2,
+                 taker_rate: float = 5.0,
+                 max_taker_volume: int = 10,
+                 rng: random.Random = None):
+        """
+        volatility is the standard deviation of the fair value after one second.
+        """
+        self._engine = engine
+        self.instrument_id = instrument_id
+        self._tick_size = tick_size
+        self.fair_value = start_price
+        self._volatility = volatility
+        self._nr_levels = nr_levels
+        self._level_volume = level_volume
+        self._half_spread_ticks = half_spread_ticks
+        self._taker_rate = taker_rate
+        self._max_taker_volume = max_taker_volume
+        self._rng = rng or random.Random()
+
+    def _price(self, tick: int) -> float:
+        return round(tick * self._tick_size, 10)
+
+    def step(self, dt: float, fair_value: float = None) -> None:
+        """
+        Advances the flow by dt seconds: moves the fair value, requotes, and sends the takers' orders. Pass fair_value
+        to set the fair value instead of moving it, e.g. to let cross-listed instruments follow the same one.
+        """
+        rng = self._rng
+        if fair_value is None:
+            fair_value = self.fair_value + rng.gauss(0.0, self._volatility * math.sqrt(dt))
+        self.fair_value = max(fair_value, self._tick_size)
+
+        fair_tick = round(self.fair_value / self._tick_size)
+        self._engine.delete_orders(MARKET_MAKER, self.instrument_id)
+        for level in range(self._nr_levels):
+            offset = self._half_spread_ticks + level
+            self._engine.insert_order(MARKET_MAKER, self.instrument_id, self._price(fair_tick - offset),
+                                      self._level_volume, SIDE_BID, ORDER_TYPE_LIMIT)
+            if fair_tick + offset > 0:
+                self._engine.insert_order(MARKET_MAKER, self.instrument_id, self._price(fair_tick + offset),
+                                          self._level_volume, SIDE_ASK, ORDER_TYPE_LIMIT)
+
+        # Poisson arrivals
+        nr_takers = 0
+        remaining = rng.expovariate(self._taker_rate) if self._taker_rate > 0 else dt
+        while remaining < dt:
+            nr_takers += 1
+            remaining += rng.expovariate(self._taker_rate)
+        for _ in range(nr_takers):
+            side = rng.choice((SIDE_BID, SIDE_ASK))
+            # aggressive enough to reach into the ladder
+            offset = self._half_spread_ticks + rng.randrange(self._nr_levels)
+            price = self._price(fair_tick + offset if side == SIDE_BID else max(fair_tick - offset, 1))
+            self._engine.insert_order(TAKER, self.instrument_id, price, rng.randint(1, self._max_taker_volume), side,
+                                      ORDER_TYPE_IOC)
+
+
+class _ExecSession:
+    def __init__(self, exchange: "SimulatedExchange", username: str, feed):
+        self.exchange = exchange
+        self.username = username
+        self.feed = feed
+
+
+class SimulatedExchange(MatchingEngineListener):
+    def __init__(self,
+                 instruments: typing.Sequence[Instrument],
+                 *,
+                 host: str = '127.0.0.1',
+                 info_port: int = 7001,
+                 exec_port: int = 8001,
+                 flow_interval: float = 0.1,
+                 book_depth: int = 10,
+                 seed: int = None,
+                 **flow_parameters):
+        """
+        Parameters
+        ----------
+        instruments: typing.Sequence[Instrument]
+            The instruments to list.
+        host: str
+            The address to listen on.
+        info_port: int
+            The port of the info feed, 0 to pick a free one. See the info_port attribute once started.
+        exec_port: int
+            The port of the Exec interface, 0 to pick a free one. See the exec_port attribute once started.
+        flow_interval: float
+            Seconds between steps of the synthetic order flow. Set to 0 to disable it.
+        book_depth: int
+            The number of levels per side in the published price books.
+        seed: int
+            Seed for the synthetic order flow, for reproducible runs.
+        flow_parameters
+            Passed on to every SyntheticOrderFlow, e.g. taker_rate=50.0.
+        """
+        self._instruments = list(instruments)
+        self._host = host
+        self.info_port = info_port
+        self.exec_port = exec_port
+        self._flow_interval = flow_interval
+
+        self.engine = MatchingEngine(listener=self, book_depth=book_depth)
+        rng = random.Random(seed)
+        self._flows = []
+        for instrument in self._instruments:
+            self.engine.add_instrument(instrument.instrument_id, instrument.tick_size)
+            self._flows.append(SyntheticOrderFlow(self.engine, instrument.instrument_id, instrument.tick_size,
+                                                  rng=random.Random(rng.random()), **flow_parameters))
+
+        self._loop = None
+        self._info_server = None
+        self._exec_socket = None
+        self._tasks = []
+        self._info_writers = set()
+        self._dirty_books = set()
+        self._publish_scheduled = False
+        self._flush_scheduled = False
+        self._exec_connections = {}
+        self._sessions_by_username = collections.defaultdict(list)
+        self._feed_promises = collections.deque()
+        # username -> instrument_id -> [position, cash]
+        self._positions = collections.defaultdict(lambda: collections.defaultdict(lambda: [0, 0.0]))
+        self._last_traded_price = {}
+        self.nr_info_messages = 0
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+
+        self._info_server = await asyncio.start_server(self._on_info_connection, self._host, self.info_port)
+        self.info_port = self._info_server.sockets[0].getsockname()[1]
+
+        self._exec_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._exec_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._exec_socket.bind((self._host, self.exec_port))
+        self._exec_socket.listen()
+        self._exec_socket.setblocking(False)
+        self.exec_port = self._exec_socket.getsockname()[1]
+
+        self._tasks.append(self._loop.create_task(self._accept_exec_connections()))
+        if self._flow_interval > 0:
+            self._tasks.append(self._loop.create_task(self._run_flow()))
+        logger.info(f'simulated exchange listening on {self._host}, info port {self.info_port}, '
+                    f'exec port {self.exec_port}')
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            await self.stop()
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._info_server is not None:
+            self._info_server.close()
+            self._info_server = None
+        for writer in list(self._info_writers):
+            writer.close()
+        self._info_writers.clear()
+        for fd in list(self._exec_connections):
+            self._close_exec_connection(fd)
+        if self._exec_socket is not None:
+            self._exec_socket.close()
+            self._exec_socket = None
+
+    # synthetic order flow
+
+    async def _run_flow(self) -> None:
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(self._flow_interval)
+            now = time.monotonic()
+            for flow in self._flows:
+                flow.step(now - last)
+            last = now
+            self._drop_old_feed_promises()
+
+    # info feed
+
+    @staticmethod
+    def _frame(message) -> bytes:
+        return to_frame(message)
+
+    def _instrument_frames(self) -> typing.List[bytes]:
+        frames = []
+        for instrument in self._instruments:
+            created = info_capnp.InstrumentCreated.new_message()
+            created.instrumentId = instrument.instrument_id
+            created.tickSize = instrument.tick_size
+            created.extraInfo = Instrument.to_extra_info_json(instrument)
+            if instrument.price_change_limit is not None:
+                created.priceChangeLimit.absoluteChange = instrument.price_change_limit.absolute_change
+                created.priceChangeLimit.relativeChange = instrument.price_change_limit.relative_change
+            frames.append(self._frame(created))
+
+            if instrument.instrument_id in self._last_traded_price:
+                startup = info_capnp.InstrumentStartupData.new_message()
+                startup.instrumentId = instrument.instrument_id
+                startup.lastTradedPrice = self._last_traded_price[instrument.instrument_id]
+                frames.append(self._frame(startup))
+            frames.append(self._price_book_frame(instrument.instrument_id))
+        return frames
+
+    async def _on_info_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                decoder.feed(data)
+                for frame in decoder.frames():
+                    with common_capnp.RawMessage.from_bytes(frame) as msg:
+                        if msg.type != info_capnp.InfoSubscribeRequest.schema.node.id:
+                            logger.warning(f'ignoring unexpected info message of type {msg.type}')
+                            continue
+                        request = msg.msg.as_struct(info_capnp.InfoSubscribeRequest.schema)
+                        reply = common_capnp.GenericReply.new_message()
+                        reply.requestId = request.requestId
+                        if str(request.bookUpdateType) != 'price':
+                            reply.errorMessage = 'Only price book updates are supported'
+                            writer.write(self._frame(reply))
+                            continue
+                        writer.write(self._frame(reply))
+                        for instrument_frame in self._instrument_frames():
+                            writer.write(instrument_frame)
+                        self._info_writers.add(writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._info_writers.discard(writer)
+            writer.close()
+
+    def _broadcast(self, frame: bytes) -> None:
+        self.nr_info_messages += 1
+        for writer in list(self._info_writers):
+            if writer.transport.get_write_buffer_size() > MAX_INFO_WRITE_BUFFER:
+                logger.warning('disconnecting an info subscriber that does not keep up')
+                self._info_writers.discard(writer)
+                writer.close()
+                continue
+            writer.write(frame)
+
+    def _price_book_frame(self, instrument_id: str) -> bytes:
+        return price_book_frame(self.engine.get_price_book(instrument_id))
+
+    def _publish_books(self) -> None:
+        self._publish_scheduled = False
+        dirty = self._dirty_books
+        self._dirty_books = set()
+        if not self._info_writers:
+            return
+        for instrument_id in dirty:
+            self._broadcast(self._price_book_frame(instrument_id))
+
+    # MatchingEngineListener, the feeds go out to the exec and info clients
+
+    def on_book_update(self, instrument_id: str) -> None:
+        # all changes made in one iteration of the loop are published as one book
+        self._dirty_books.add(instrument_id)
+        if not self._publish_scheduled and self._loop is not None:
+            self._publish_scheduled = True
+            self._loop.call_soon(self._publish_books)
+
+    def on_trade_tick(self, trade_tick: TradeTick) -> None:
+        self._last_traded_price[trade_tick.instrument_id] = trade_tick.price
+        if not self._info_writers:
+            return
+        self._broadcast(trade_tick_frame(trade_tick))
+
+    def on_order_update(self, owner: str, order: OrderStatus) -> None:
+        for session in self._sessions_by_username.get(owner, ()):
+            self._feed_promises.append((time.monotonic(), session.feed.onOrderUpdate(order={
+                'instrumentId': order.instrument_id,
+                'orderId': order.order_id,
+                'price': order.price,
+                'volume': order.volume,
+                'side': order.side,
+            })))
+        self._schedule_flush()
+
+    def on_trade(self, owner: str, trade: Trade) -> None:
+        position = self._positions[owner][trade.instrument_id]
+        sign = 1 if trade.side == SIDE_BID else -1
+        position[0] += sign * trade.volume
+        position[1] -= sign * trade.volume * trade.price
+
+        for session in self._sessions_by_username.get(owner, ()):
+            self._feed_promises.append((time.monotonic(), session.feed.onTrade(trade={
+                'tradeId': trade.trade_id,
+                'timestamp': _to_ns(trade.timestamp),
+                'instrumentId': trade.instrument_id,
+                'orderId': trade.order_id,
+                'price': trade.price,
+                'volume': trade.volume,
+                'side': trade.side,
+            })))
+        self._schedule_flush()
+
+    def _drop_old_feed_promises(self) -> None:
+        cutoff = time.monotonic() - FEED_PROMISE_RETENTION
+        promises = self._feed_promises
+        while promises and promises[0][0] < cutoff:
+            promises.popleft()
+
+    # exec interface
+
+    def _schedule_flush(self) -> None:
+        # feed calls are only written to the sockets when the capnp event loop runs
+        if not self._flush_scheduled and self._loop is not None:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        capnp.poll_once()
+
+    async def _accept_exec_connections(self) -> None:
+        while True:
+            connection, _ = await self._loop.sock_accept(self._exec_socket)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            portal = _ExecPortal(self)
+            server = capnp.TwoPartyServer(connection, bootstrap=portal)
+            fd = connection.fileno()
+
+            def on_disconnect(*args, fd=fd):
+                # the capnp objects must not be released from within their own callback
+                self._loop.call_soon(self._close_exec_connection, fd)
+
+            self._exec_connections[fd] = (connection, server, portal, server.on_disconnect().then(on_disconnect))
+            self._loop.add_reader(fd, capnp.poll_once)
+
+    def _close_exec_connection(self, fd: int) -> None:
+        entry = self._exec_connections.pop(fd, None)
+        if entry is None:
+            return
+        connection, server, portal, _ = entry
+        self._loop.remove_reader(fd)
+        for session in portal.sessions:
+            sessions = self._sessions_by_username[session.username]
+            sessions.remove(session)
+            if not sessions:
+                # like the real exchange, orders do not outlive the connection
+                del self._sessions_by_username[session.username]
+                for instrument_id in self.engine.get_instrument_ids():
+                    self.engine.delete_orders(session.username, instrument_id)
+        connection.close()
+
+    def _login(self, portal: "_ExecPortal", username: str, feed, results) -> None:
+        session = _ExecSession(self, username, feed)
+        portal.sessions.append(session)
+        self._sessions_by_username[username].append(session)
+
+        results.exec = _Exec(session)
+        positions = self._positions[username]
+        entries = results.positions.init('positions', len(positions))
+        for entry, (instrument_id, (position, cash)) in zip(entries, positions.items()):
+            entry.instrumentId = instrument_id
+            entry.position = position
+            entry.cash = cash
+
+
+class _ExecPortal(exec_capnp.ExecPortal.Server):
+    def __init__(self, exchange: SimulatedExchange):
+        self._exchange = exchange
+        self.sessions = []
+
+    def login(self, username, password, callbackInterface, _context, **kwargs):
+        self._exchange._login(self, username, callbackInterface, _context.results)
+
+    def adminLogin(self, username, password, adminPassword, callbackInterface, _context, **kwargs):
+        self._exchange._login(self, username, callbackInterface, _context.results)
+
+
+class _Exec(exec_capnp.ExecPortal.Exec.Server):
+    def __init__(self, session: _ExecSession):
+        self._session = session
+        self._engine = session.exchange.engine
+
+    @staticmethod
+    def _set_results(results, response) -> None:
+        results.success = response.success
+        if response.error_reason is not None:
+            results.errorReason = response.error_reason
+
+    def insertOrder(self, instrumentId, price, volume, side, orderType, _context, **kwargs):
+        response = self._engine.insert_order(self._session.username, instrumentId, price, volume, str(side),
+                                             str(orderType))
+        if response.success:
+            _context.results.orderId = response.order_id
+        self._set_results(_context.results, response)
+
+    def amendOrder(self, instrumentId, orderId, volume, _context, **kwargs):
+        self._set_results(_context.results,
+                          self._engine.amend_order(self._session.username, instrumentId, orderId, volume))
+
+    def deleteOrder(self, instrumentId, orderId, _context, **kwargs):
+        self._set_results(_context.results,
+                          self._engine.delete_order(self._session.username, instrumentId, orderId))
+
+    def deleteOrders(self, instrumentId, _context, **kwargs):
+        self._set_results(_context.results, self._engine.delete_orders(self._session.username, instrumentId))
+
+    def updateInstrumentParameters(self, instrumentId, parameters, _context, **kwargs):
+        _context.results.success = False
+        _context.results.errorReason = 'Not supported by the simulated exchange'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--info-port', type=int, default=7001)
+    parser.add_argument('--exec-port', type=int, default=8001)
+    parser.add_argument('--instruments', default='PHILIPS_A,PHILIPS_B',
+                        help='comma separated instrument ids')
+    parser.add_argument('--tick-size', type=float, default=0.1)
+    parser.add_argument('--flow-interval', type=float, default=0.1,
+                        help='seconds between steps of the synthetic order flow, 0 to disable it')
+    parser.add_argument('--taker-rate', type=float, default=5.0, help='taker orders per second per instrument')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.getLogger('client').setLevel('WARNING')
+    logger.setLevel('INFO')
+    instruments = [Instrument(instrument_id, args.tick_size) for instrument_id in args.instruments.split(',')]
+    exchange = SimulatedExchange(instruments, host=args.host, info_port=args.info_port, exec_port=args.exec_port,
+                                 flow_interval=args.flow_interval, seed=args.seed, taker_rate=args.taker_rate)
+    try:
+        asyncio.run(exchange.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
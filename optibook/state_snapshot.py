@@ -0,0 +1,108 @@
+"""
+Consistent views of the client state for the strategy thread.
+
+The event loop thread of the clients changes the state, and the strategy thread reads it. Every change the loop makes
+for one message, e.g. a trade that updates the trade history, the position, the cash and the PnL, is bracketed by a
+StateSequence: the sequence number is odd while the change is in progress and goes up by two for every change.
+
+A reader copies what it needs and checks the number afterwards. If it changed, the copy may mix state from before and
+after a message and the reader simply copies again. The loop thread never waits for a reader, and the copies are a
+handful of references and dicts, so a retry is cheap and rare.
+"""
+import time
+import typing
+
+from .common_types import PriceBook, OrderStatus
+
+
+class StateSequence:
+    """
+    A sequence lock with a single writer, the event loop thread:
+
+        sequence.begin_write()
+        try:
+            ...
+        finally:
+            sequence.end_write()
+
+    and any number of readers:
+
+        while True:
+            start = sequence.begin_read()
+            ...copy...
+            if not sequence.changed_since(start):
+                break
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def begin_write(self) -> None:
+        self.value += 1
+
+    def end_write(self) -> None:
+        self.value += 1
+
+    def begin_read(self) -> int:
+        value = self.value
+        while value & 1:
+            # the writer is in the middle of a change, give it the interpreter to finish
+            time.sleep(0)
+            value = self.value
+        return value
+
+    def changed_since(self, value: int) -> bool:
+        return self.value != value
+
+
+class StateSnapshot:
+    """
+    The state of the client for a set of instruments, all as of the same moment. See Exchange.get_snapshot.
+
+    Attributes
+    ----------
+    sequence: int
+        The sequence number the snapshot was taken at, goes up with every message the client processes.
+
+    positions: typing.Dict[str, int]
+        The position per instrument, as get_positions.
+
+    cash: float
+        The total cash position, as get_cash.
+
+    pnl: float
+        As get_pnl, None if an open position cannot be valued.
+
+    outstanding_orders: typing.Dict[str, typing.Dict[int, OrderStatus]]
+        The outstanding orders per instrument, by order id.
+
+    price_books: typing.Dict[str, PriceBook]
+        The last price book per instrument, None if none has arrived.
+
+    last_traded_prices: typing.Dict[str, float]
+        The last traded price per instrument, None if it has not traded.
+
+    tradable: typing.Dict[str, bool]
+        Whether the instrument exists and is not paused.
+    """
+    __slots__ = ('sequence', 'positions', 'cash', 'pnl', 'outstanding_orders', 'price_books', 'last_traded_prices',
+                 'tradable')
+
+    def __init__(self, *, sequence=0, positions=None, cash=0.0, pnl=None, outstanding_orders=None, price_books=None,
+                 last_traded_prices=None, tradable=None):
+        self.sequence: int = sequence
+        self.positions: typing.Dict[str, int] = positions if positions is not None else {}
+        self.cash: float = cash
+        self.pnl: typing.Optional[float] = pnl
+        self.outstanding_orders: typing.Dict[str, typing.Dict[int, OrderStatus]] = \
+            outstanding_orders if outstanding_orders is not None else {}
+        self.price_books: typing.Dict[str, PriceBook] = price_books if price_books is not None else {}
+        self.last_traded_prices: typing.Dict[str, float] = \
+            last_traded_prices if last_traded_prices is not None else {}
+        self.tradable: typing.Dict[str, bool] = tradable if tradable is not None else {}
+
+    def __repr__(self):
+        return f'StateSnapshot(sequence={self.sequence}, positions={self.positions}, cash={self.cash}, ' \
+               f'pnl={self.pnl}, outstanding_orders={self.outstanding_orders}, price_books={self.price_books}, ' \
+               f'last_traded_prices={self.last_traded_prices}, tradable={self.tradable})'
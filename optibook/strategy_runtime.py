@@ -0,0 +1,184 @@
+"""
+Runs a strategy on the event loop of the clients, woken by the feeds instead of polling on a timer.
+
+A strategy subclasses Strategy and overrides the coroutines for the events it cares about:
+
+    class Quoter(Strategy):
+        async def on_book(self, instrument_id, book):
+            await self.runtime.update_quotes({instrument_id: ...})
+
+    exchange.connect()
+    exchange.run_strategy(Quoter(), ['PHILIPS_A', 'PHILIPS_B'])
+
+The handlers run one at a time, so a strategy never sees its own state change halfway through a handler, and they
+run on the client thread, so they read the clients directly instead of through the synchronous Exchange.
+
+Events are coalesced per instrument: while a handler runs, any number of book updates of an instrument lead to one
+call of on_book with the latest book, and any number of public trades to one call of on_tick with all of them. An
+instrument that updates all the time does not starve the others, every instrument waiting for a handler gets its
+turn in order of arrival.
+"""
+import asyncio
+import typing
+
+from .common_types import PriceBook, TradeTick, Trade, OrderStatus
+from .exchange_client import InfoClient, ExecClient
+from .idl import common_capnp, info_capnp
+from .quote_manager import QuoteManager, QuoteUpdateReport
+
+EVENT_BOOK = 'book'
+EVENT_TICK = 'tick'
+EVENT_OWN_TRADE = 'own_trade'
+EVENT_ORDER_UPDATE = 'order_update'
+
+
+class Strategy:
+    """
+    Base class of strategies run by a StrategyRuntime. Only the coroutines that are overridden are subscribed to.
+    """
+    runtime: 'StrategyRuntime' = None
+
+    async def on_start(self) -> None:
+        """
+        Called once before any other handler, with self.runtime set.
+        """
+
+    async def on_book(self, instrument_id: str, book: PriceBook) -> None:
+        """
+        Called with the latest price book of an instrument after it changed.
+        """
+
+    async def on_tick(self, instrument_id: str, ticks: typing.List[TradeTick]) -> None:
+        """
+        Called with the public trades of an instrument since the previous call, or since the client connected, oldest
+        first. At most max_nr_trade_history of them are kept between calls.
+        """
+
+    async def on_own_trade(self, instrument_id: str, trades: typing.List[Trade]) -> None:
+        """
+        Called with your trades in an instrument since the previous call, oldest first.
+        """
+
+    async def on_order_update(self, instrument_id: str, orders: typing.Dict[int, OrderStatus]) -> None:
+        """
+        Called with your outstanding orders in an instrument after any of them changed.
+        """
+
+
+class StrategyRuntime:
+    """
+    Feeds the events of an InfoClient and an ExecClient to a Strategy, on their event loop. The poll_new_trades and
+    poll_new_trade_ticks cursors of the clients are used to collect trades for the handlers, so the strategy should
+    not poll them itself.
+    """
+    def __init__(self,
+                 strategy: Strategy,
+                 info_client: InfoClient,
+                 exec_client: ExecClient,
+                 instrument_ids: typing.Iterable[str] = None):
+        """
+        Parameters
+        ----------
+        strategy: Strategy
+            The strategy to run.
+        info_client: InfoClient
+        exec_client: ExecClient
+            Connected clients, running on the loop run is called on.
+        instrument_ids: typing.Iterable[str]
+            The instruments to pass events on for, all if None.
+        """
+        self.strategy = strategy
+        self.info_client = info_client
+        self.exec_client = exec_client
+        self.instrument_ids = set(instrument_ids) if instrument_ids is not None else None
+        self._quote_manager = QuoteManager(exec_client)
+
+        # (event, instrument_id) waiting for a handler, in order of arrival; a dict is an ordered set
+        self._pending: typing.Dict[typing.Tuple[str, str], None] = {}
+        self._wake = asyncio.Event()
+        self._stopped = False
+        self.nr_events = 0
+        self.nr_handler_calls = 0
+
+    def _overrides(self, name: str) -> bool:
+        return getattr(type(self.strategy), name) is not getattr(Strategy, name)
+
+    def _on_event(self, event: str, instrument_id: str) -> None:
+        # called on the loop for every message, only remembers that there is something to do
+        self.nr_events += 1
+        if self.instrument_ids is not None and instrument_id not in self.instrument_ids:
+            return
+        key = (event, instrument_id)
+        if key not in self._pending:
+            self._pending[key] = None
+            self._wake.set()
+
+    async def _dispatch(self, event: str, instrument_id: str) -> None:
+        strategy = self.strategy
+        if event == EVENT_BOOK:
+            await strategy.on_book(instrument_id, self.info_client.get_last_price_book(instrument_id))
+        elif event == EVENT_TICK:
+            ticks = self.info_client.poll_new_trade_ticks(instrument_id)
+            if ticks:
+                await strategy.on_tick(instrument_id, ticks)
+        elif event == EVENT_OWN_TRADE:
+            trades = self.exec_client.poll_new_trades(instrument_id)
+            if trades:
+                await strategy.on_own_trade(instrument_id, trades)
+        else:
+            await strategy.on_order_update(instrument_id, self.exec_client.get_outstanding_orders(instrument_id))
+        self.nr_handler_calls += 1
+
+    async def update_quotes(self, targets: typing.Dict[str, typing.Sequence[typing.Tuple[float, int, str]]]
+                            ) -> QuoteUpdateReport:
+        """
+        Moves the outstanding orders to the target quotes with as few requests as possible, see Exchange.update_quotes.
+        """
+        return await self._quote_manager.update_quotes(targets)
+
+    def stop(self) -> None:
+        """
+        Makes run return after the handler that is running, if any.
+        """
+        self._stopped = True
+        self._wake.set()
+
+    async def run(self) -> None:
+        """
+        Calls the handlers of the strategy as events arrive, until stop is called. An exception raised by a handler
+        stops the runtime and is raised from here.
+        """
+        info_handlers = []
+        exec_handlers = []
+        on_event = self._on_event
+        if self._overrides('on_book'):
+            info_handlers.append(self.info_client.add_message_handler(
+                info_capnp.PriceBook, lambda book: on_event(EVENT_BOOK, book.instrumentId)))
+        if self._overrides('on_tick'):
+            info_handlers.append(self.info_client.add_message_handler(
+                common_capnp.TradeTick, lambda tick: on_event(EVENT_TICK, tick.instrumentId)))
+        if self._overrides('on_own_trade'):
+            exec_handlers.append(self.exec_client.add_message_handler(
+                'onTrade', lambda trade: on_event(EVENT_OWN_TRADE, trade.instrumentId)))
+        if self._overrides('on_order_update'):
+            exec_handlers.append(self.exec_client.add_message_handler(
+                'onOrderUpdate', lambda order: on_event(EVENT_ORDER_UPDATE, order.instrumentId)))
+
+        self._stopped = False
+        self.strategy.runtime = self
+        try:
+            await self.strategy.on_start()
+            pending = self._pending
+            while not self._stopped:
+                if not pending:
+                    self._wake.clear()
+                    await self._wake.wait()
+                    continue
+                key = next(iter(pending))
+                del pending[key]
+                await self._dispatch(*key)
+        finally:
+            for h_id in info_handlers:
+                self.info_client.remove_message_handler(h_id)
+            for h_id in exec_handlers:
+                self.exec_client.remove_message_handler(h_id)
@@ -1,10 +1,18 @@
+import concurrent.futures
 import logging
 import typing
 
 from . import exchange_client
+from .base_client import PUMP_MODE_EVENT, ConflationStats
 from .exchange_client import InfoClient, ExecClient
-from .synchronous_wrapper import SynchronousWrapper
-from .common_types import PriceBook, PriceVolume, Trade, TradeTick, OrderStatus, Instrument
+from .synchronous_wrapper import SynchronousWrapper, ReconnectPolicy, ReconnectStats
+from .latency import LatencyHistogram
+from .quote_manager import QuoteManager, QuoteUpdateReport
+from .feed_recorder import FeedRecorder
+from .state_snapshot import StateSequence, StateSnapshot
+from .strategy_runtime import Strategy, StrategyRuntime
+from .common_types import PriceBook, CompactPriceBook, PriceVolume, Trade, TradeTick, OrderStatus, Instrument, PositionPnl
+from .idl import common_capnp, info_capnp
 from .exchange_responses import InsertOrderResponse, AmendOrderResponse, DeleteOrderResponse
 
 logger = logging.getLogger('client')
@@ -19,7 +27,13 @@ class Exchange:
                  password: str = None,
                  admin_password: str = None,
                  full_message_logging: bool = False,
-                 max_nr_trade_history: int = 100):
+                 max_nr_trade_history: int = 100,
+                 pump_mode: str = PUMP_MODE_EVENT,
+                 lazy_price_books: bool = False,
+                 feed_recorder: FeedRecorder = None,
+                 cost_basis: str = exchange_client.COST_BASIS_AVERAGE,
+                 conflate_price_books: bool = False,
+                 reconnect_policy: ReconnectPolicy = None):
         """
         Initiate an exchange client instance. This is the class you should use to interact with the exchange, i.e.
         send orders or delete orders, get the newest trades, etc.
@@ -43,14 +57,57 @@ class Exchange:
             exchange.
         max_nr_trade_history: int
             Keep at most this number of trades per instrument in history. Older trades will be removed automatically
+        pump_mode: str
+            'event' or 'poll'. In 'event' mode execution replies and callbacks are handled as soon as they arrive on the
+            socket, in 'poll' mode they are picked up by polling the connection every 100ms.
+        lazy_price_books: bool
+            If set to True, price book updates are stored in serialized form and only turned into a PriceBook when
+            requested through get_last_price_book. Saves a lot of work when books update much more often than they are read.
+        feed_recorder: FeedRecorder
+            If set, every message received on the info feed is recorded to disk, see FeedRecorder. Closing the
+            recorder is up to the caller.
+        cost_basis: str
+            'average' or 'fifo', how get_realized_pnl and get_position_pnl match the lots that close a position
+            against the ones that opened it.
+        conflate_price_books: bool
+            If set to True, a price book that is followed by a newer one for the same instrument before it is handled
+            is dropped, so that a burst on the feed does not build up a backlog of stale books. Trade ticks and all
+            other messages are never dropped, and everything is handled in the order it arrived. See
+            get_conflation_stats.
+        reconnect_policy: ReconnectPolicy
+            If set, a lost connection is restored with exponential backoff instead of ending the client: the info
+            feed is subscribed to again and the exec client logs in again. Trade histories are kept, positions are
+            brought in line with the exchange and outstanding orders, which end with the connection, are dropped.
+            Trades and ticks while disconnected are not received. See get_reconnect_stats.
         """
 
         if full_message_logging:
             exchange_client.logger.setLevel('VERBOSE')
 
-        self._i = InfoClient(host=host, port=info_port, max_nr_trade_history=max_nr_trade_history)
-        self._e = ExecClient(host=host, port=exec_port, username=username, password=password, admin_password=admin_password, max_nr_trade_history=max_nr_trade_history)
-        self._wrapper = SynchronousWrapper([self._i, self._e])
+        # shared by both clients, so that a snapshot is consistent across the info and the exec state
+        state_sequence = StateSequence()
+        info_client = InfoClient(host=host, port=info_port, max_nr_trade_history=max_nr_trade_history, lazy_price_books=lazy_price_books, feed_recorder=feed_recorder, state_sequence=state_sequence, conflate_price_books=conflate_price_books)
+        exec_client = ExecClient(host=host, port=exec_port, username=username, password=password, admin_password=admin_password, max_nr_trade_history=max_nr_trade_history, pump_mode=pump_mode, cost_basis=cost_basis, state_sequence=state_sequence)
+        self._attach(info_client, exec_client,
+                     SynchronousWrapper([info_client, exec_client], reconnect_policy=reconnect_policy), state_sequence)
+
+    def _attach(self, info_client, exec_client: ExecClient, wrapper: SynchronousWrapper,
+                state_sequence: StateSequence) -> None:
+        # also used by ExchangePool, where the info client is shared between sessions
+        self._state_sequence = state_sequence
+        self._i = info_client
+        self._e = exec_client
+        self._wrapper = wrapper
+        # open positions are valued at the last traded price, as it arrives
+        self._mark_handlers = [
+            info_client.add_message_handler(common_capnp.TradeTick,
+                                            lambda tick: exec_client.mark(tick.instrumentId, tick.price)),
+            info_client.add_message_handler(info_capnp.InstrumentStartupData,
+                                            lambda startup: exec_client.mark(startup.instrumentId,
+                                                                             startup.lastTradedPrice)),
+        ]
+        self._merged_trade_tick_histories = set()
+        self._quote_manager = QuoteManager(exec_client)
 
     def is_connected(self) -> bool:
         """
@@ -184,6 +241,196 @@ Unable to authenticate with the server. Please double-check that your username a
             self._e.delete_orders(instrument_id)
         )
 
+    def insert_orders(self, orders: typing.Sequence[typing.Dict[str, typing.Any]]) -> typing.List[InsertOrderResponse]:
+        """
+        Insert several orders at once. All orders are sent before waiting for any reply, so this takes about as long
+        as a single insert_order.
+
+        Parameters
+        ----------
+        orders: typing.Sequence[typing.Dict[str, typing.Any]]
+            One dict per order, with the arguments of insert_order: instrument_id, price, volume, side and optionally
+            order_type. E.g. dict(instrument_id='PHILIPS_A', price=100.0, volume=5, side='bid').
+
+        Returns
+        -------
+        typing.List[InsertOrderResponse]
+            The InsertOrderResponse for each order, in the order of the requests.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        orders = [dict(order) for order in orders]
+        for order in orders:
+            order.setdefault('order_type', exchange_client.ORDER_TYPE_LIMIT)
+            assert order['side'] in exchange_client.ALL_SIDES, f"Invalid value ({order['side']}) for parameter 'side'. Use synchronous_client.BID or synchronous_client.ASK"
+            assert order['order_type'] in exchange_client.ALL_ORDER_TYPES, f"order_type must be one of {exchange_client.ALL_ORDER_TYPES}"
+
+        return self._wrapper.run_on_loop(self._e.insert_orders(orders))
+
+    def amend_orders(self, orders: typing.Sequence[typing.Dict[str, typing.Any]]) -> typing.List[AmendOrderResponse]:
+        """
+        Amend several outstanding limit orders at once, see insert_orders.
+
+        Parameters
+        ----------
+        orders: typing.Sequence[typing.Dict[str, typing.Any]]
+            One dict per order, with the arguments of amend_order: instrument_id, order_id and volume.
+
+        Returns
+        -------
+        typing.List[AmendOrderResponse]
+            The AmendOrderResponse for each order, in the order of the requests.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+
+        return self._wrapper.run_on_loop(self._e.amend_orders(orders))
+
+    def delete_orders_by_id(self, orders: typing.Sequence[typing.Dict[str, typing.Any]]) -> typing.List[DeleteOrderResponse]:
+        """
+        Delete several specific outstanding limit orders at once, see insert_orders.
+
+        Parameters
+        ----------
+        orders: typing.Sequence[typing.Dict[str, typing.Any]]
+            One dict per order, with the arguments of delete_order: instrument_id and order_id.
+
+        Returns
+        -------
+        typing.List[DeleteOrderResponse]
+            The DeleteOrderResponse for each order, in the order of the requests.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+
+        return self._wrapper.run_on_loop(self._e.delete_orders_by_id(orders))
+
+    def update_quotes(self, targets: typing.Dict[str, typing.Sequence[typing.Tuple[float, int, str]]]) -> QuoteUpdateReport:
+        """
+        Bring your outstanding limit orders to the given quotes with as few requests as possible: orders that already
+        match are kept (and keep their place in the queue), orders with too much volume are amended down, and only what
+        is left over is deleted or inserted. All requests are sent at once.
+
+        Parameters
+        ----------
+        targets: typing.Dict[str, typing.Sequence[typing.Tuple[float, int, str]]]
+            Per instrument_id, the wanted quotes as (price, volume, side) tuples. Instruments that are not in targets are
+            left alone, an empty list deletes all orders on the instrument.
+
+        Returns
+        -------
+        QuoteUpdateReport
+            The number of inserts, amends and deletes sent, and how many requests that saved compared to deleting all
+            orders and inserting every quote again. See the doc of that type for more info.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+
+        return self._wrapper.run_on_loop(self._quote_manager.update_quotes(targets))
+
+    @staticmethod
+    def _add_callback(fut: concurrent.futures.Future,
+                      callback: typing.Optional[typing.Callable[[concurrent.futures.Future], None]]) -> concurrent.futures.Future:
+        if callback is not None:
+            fut.add_done_callback(callback)
+        return fut
+
+    def insert_order_async(self,
+                           instrument_id: str,
+                           *,
+                           price: float,
+                           volume: int,
+                           side: str,
+                           order_type: str = exchange_client.ORDER_TYPE_LIMIT,
+                           callback: typing.Callable[[concurrent.futures.Future], None] = None) -> concurrent.futures.Future:
+        """
+        Like insert_order, but returns immediately instead of waiting for the reply of the server.
+
+        Parameters
+        ----------
+        instrument_id, price, volume, side, order_type
+            See insert_order.
+        callback: typing.Callable[[concurrent.futures.Future], None]
+            Optional function called with the future once the reply has arrived. It runs on the thread of the event
+            loop, so it should be quick and must not call blocking methods of this Exchange.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            A future for the InsertOrderResponse.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        assert(side in exchange_client.ALL_SIDES), f"Invalid value ({side}) for parameter 'side'. Use synchronous_client.BID or synchronous_client.ASK"
+        assert order_type in exchange_client.ALL_ORDER_TYPES, f"order_type must be one of {exchange_client.ALL_ORDER_TYPES}"
+
+        return self._add_callback(self._wrapper.submit_on_loop(
+            self._e.insert_order(instrument_id=instrument_id, price=price, volume=volume, side=side, order_type=order_type)
+        ), callback)
+
+    def amend_order_async(self, instrument_id: str, *, order_id: int, volume: int,
+                          callback: typing.Callable[[concurrent.futures.Future], None] = None) -> concurrent.futures.Future:
+        """
+        Like amend_order, but returns a future for the AmendOrderResponse immediately. See insert_order_async.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+
+        return self._add_callback(self._wrapper.submit_on_loop(
+            self._e.amend_order(instrument_id, order_id, volume)
+        ), callback)
+
+    def delete_order_async(self, instrument_id: str, *, order_id: int,
+                           callback: typing.Callable[[concurrent.futures.Future], None] = None) -> concurrent.futures.Future:
+        """
+        Like delete_order, but returns a future for the DeleteOrderResponse immediately. See insert_order_async.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+
+        return self._add_callback(self._wrapper.submit_on_loop(
+            self._e.delete_order(instrument_id, order_id)
+        ), callback)
+
+    def delete_orders_async(self, instrument_id: str,
+                            callback: typing.Callable[[concurrent.futures.Future], None] = None) -> concurrent.futures.Future:
+        """
+        Like delete_orders, but returns a future immediately. See insert_order_async.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+
+        return self._add_callback(self._wrapper.submit_on_loop(
+            self._e.delete_orders(instrument_id)
+        ), callback)
+
+    def get_latency_histograms(self) -> typing.Dict[str, LatencyHistogram]:
+        """
+        Returns the round-trip latency histogram per type of request, e.g. 'ExecClient.insert_order', measured from the
+        moment the request is handed to the event loop until its reply is processed.
+
+        Returns
+        -------
+        typing.Dict[str, LatencyHistogram]
+            The LatencyHistogram per request name.
+        """
+        return self._wrapper.get_latency_histograms()
+
+    def get_reconnect_stats(self) -> typing.Optional[ReconnectStats]:
+        """
+        Returns how often the connection was lost and how long it took until the client was trading again.
+
+        Returns
+        -------
+        ReconnectStats
+            The reconnect counters and downtimes, None if reconnect_policy is not set.
+        """
+        return self._wrapper.get_reconnect_stats()
+
+    def get_conflation_stats(self) -> typing.Optional[ConflationStats]:
+        """
+        Returns how many info messages were received, how many price books were dropped because a newer one for the
+        same instrument arrived before they were handled, and how many messages are waiting to be handled.
+
+        Returns
+        -------
+        ConflationStats
+            The counters of the info feed, None if conflate_price_books is not set.
+        """
+        return self._i.get_conflation_stats()
+
     def poll_new_trades(self, instrument_id: str) -> typing.List[Trade]:
         """
         Returns the private trades received for an instrument since the last time this function was called for that instrument.
@@ -259,6 +506,57 @@ Unable to authenticate with the server. Please double-check that your username a
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         return self._i.get_trade_tick_history(instrument_id)
 
+    def _ensure_merged_trade_tick_history(self, instrument_ids: typing.Sequence[str]) -> None:
+        key = tuple(instrument_ids)
+        if key in self._merged_trade_tick_histories:
+            return
+
+        # created on the event loop, so that no tick can arrive between filling and subscribing the history
+        async def add():
+            self._i.add_merged_trade_tick_history(key)
+
+        self._wrapper.run_on_loop(add(), record_latency=False)
+        self._merged_trade_tick_histories.add(key)
+
+    def get_merged_trade_tick_history(self, instrument_ids: typing.Sequence[str]) -> typing.List[TradeTick]:
+        """
+        Returns the public trade ticks of several instruments in the order in which they happened, e.g. for a
+        cross-listed pair. The merged history is kept up to date as ticks arrive from the first call onwards, so later
+        calls do not need to merge or sort anything. It holds as many ticks as the per-instrument histories together.
+
+        Parameters
+        ----------
+        instrument_ids: typing.Sequence[str]
+            The instrument_ids of the instruments to obtain the trade tick history for.
+
+        Returns
+        -------
+        typing.List[TradeTick]
+            Returns the public trade ticks of the instruments, oldest first.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        self._ensure_merged_trade_tick_history(instrument_ids)
+        return self._i.get_merged_trade_tick_history(instrument_ids)
+
+    def poll_new_merged_trade_ticks(self, instrument_ids: typing.Sequence[str]) -> typing.List[TradeTick]:
+        """
+        Returns the public trade ticks of several instruments received since the last time this function was called
+        for the same instruments, in the order in which they happened.
+
+        Parameters
+        ----------
+        instrument_ids: typing.Sequence[str]
+            The instrument_ids of the instruments to poll the trade ticks for.
+
+        Returns
+        -------
+        typing.List[TradeTick]
+            Returns the new public trade ticks of the instruments, oldest first.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        self._ensure_merged_trade_tick_history(instrument_ids)
+        return self._i.poll_new_merged_trade_ticks(instrument_ids)
+
     def get_outstanding_orders(self, instrument_id: str) -> typing.Dict[int, OrderStatus]:
         """
         Returns the client's currently outstanding limit orders on an instrument.
@@ -294,6 +592,25 @@ Unable to authenticate with the server. Please double-check that your username a
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         return self._i.get_last_price_book(instrument_id)
 
+    def get_last_compact_price_book(self, instrument_id: str) -> CompactPriceBook:
+        """
+        Returns the last received limit order book state for an instrument, backed by arrays instead of PriceVolume
+        objects. Cheaper than get_last_price_book when lazy_price_books is set, and comes with helpers for mid,
+        microprice, imbalance, volume through a price, etc.
+
+        Parameters
+        ----------
+        instrument_id: str
+            The instrument_id of the instrument to obtain the limit order book for.
+
+        Returns
+        -------
+        CompactPriceBook
+             Returns the last received limit order book state for an instrument.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        return self._i.get_last_compact_price_book(instrument_id)
+
     def get_positions(self) -> typing.Dict[str, int]:
         """
         Get your current positions.
@@ -356,7 +673,8 @@ Unable to authenticate with the server. Please double-check that your username a
 
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         if valuations is None:
-            valuations = dict()
+            # kept up to date trade by trade and tick by tick
+            return self._e.get_pnl()
 
         positions = self._e.get_positions_and_cash()
         pnl = 0
@@ -381,6 +699,65 @@ Unable to authenticate with the server. Please double-check that your username a
 
         return pnl
 
+    def get_realized_pnl(self) -> float:
+        """
+        The PnL of the lots that have been closed, per the cost basis given to the constructor. Together with the
+        unrealized PnL of the open positions, see get_position_pnl, it adds up to get_pnl.
+
+        Returns
+        -------
+        float
+            Your realized PnL.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        return self._e.get_realized_pnl()
+
+    def get_position_pnl(self, instrument_id: str) -> PositionPnl:
+        """
+        Get your position in an instrument with its average price, realized and unrealized PnL.
+
+        Parameters
+        ----------
+        instrument_id: str
+            The instrument_id of the instrument.
+
+        Returns
+        -------
+        PositionPnl
+            The position and PnL in the instrument, None if you never had a position in it.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        return self._e.get_position_pnl(instrument_id)
+
+    def add_position_callback(self, callback: typing.Callable[[PositionPnl], None]) -> int:
+        """
+        Registers a function that is called with the PositionPnl of an instrument every time it changes: on your
+        trades and single sided bookings, and on public trades while you have a position in the instrument. It is
+        called on the thread of the client, so it should be quick.
+
+        Parameters
+        ----------
+        callback: typing.Callable[[PositionPnl], None]
+            The function to call.
+
+        Returns
+        -------
+        int
+            An id that can be passed to remove_position_callback.
+        """
+        return self._e.add_position_callback(callback)
+
+    def remove_position_callback(self, c_id: int) -> None:
+        """
+        Unregisters a function registered with add_position_callback.
+
+        Parameters
+        ----------
+        c_id: int
+            The id returned by add_position_callback.
+        """
+        self._e.remove_position_callback(c_id)
+
     def get_instruments(self) -> typing.Dict[str, Instrument]:
         """
         Returns all existing instruments on the exchange
@@ -393,6 +770,64 @@ Unable to authenticate with the server. Please double-check that your username a
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         return self._i.get_instruments()
 
+    def get_snapshot(self, instrument_ids: typing.Iterable[str]) -> StateSnapshot:
+        """
+        Get positions, cash, PnL, outstanding orders and price books in one go, all as of the same moment: no message
+        is processed halfway through the snapshot. Separate calls to the getters can each see a different state, e.g.
+        a position that already includes a trade and outstanding orders that do not reflect it yet.
+
+        The snapshot is taken without blocking the client thread, see state_snapshot.
+
+        Parameters
+        ----------
+        instrument_ids: typing.Iterable[str]
+            The instruments to include orders, price books, last traded prices and trading status for. Positions are
+            included for all instruments.
+
+        Returns
+        -------
+        StateSnapshot
+            The state of the client.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        instrument_ids = list(instrument_ids)
+        state_sequence = self._state_sequence
+        while True:
+            sequence = state_sequence.begin_read()
+            instruments = self._i.get_instruments()
+            snapshot = StateSnapshot(
+                sequence=sequence,
+                positions=self._e.get_positions(),
+                cash=self._e.get_cash(),
+                pnl=self._e.get_pnl(),
+                outstanding_orders={i: self._e.get_outstanding_orders(i) for i in instrument_ids},
+                price_books={i: self.get_last_price_book(i) for i in instrument_ids},
+                last_traded_prices={i: self._i.get_last_traded_price(i) for i in instrument_ids},
+                tradable={i: i in instruments and not instruments[i].paused for i in instrument_ids})
+            if not state_sequence.changed_since(sequence):
+                return snapshot
+
+    def run_strategy(self, strategy: Strategy, instrument_ids: typing.Iterable[str] = None) -> None:
+        """
+        Runs an event driven strategy on the thread of the client, see strategy_runtime, and blocks until it stops
+        or raises. Interrupting with Ctrl+C stops it after the handler that is running.
+
+        Parameters
+        ----------
+        strategy: Strategy
+            The strategy to run.
+        instrument_ids: typing.Iterable[str]
+            The instruments to pass events on for, all if None.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        runtime = StrategyRuntime(strategy, self._i, self._e, instrument_ids)
+        fut = self._wrapper.submit_on_loop(runtime.run(), record_latency=False)
+        try:
+            fut.result()
+        except KeyboardInterrupt:
+            self._wrapper.get_loop().call_soon_threadsafe(runtime.stop)
+            fut.result()
+
     def __enter__(self):
         self.connect()
         return self
@@ -4,17 +4,79 @@ import time
 import logging
 import asyncio
 import datetime
+import typing
+
+from .latency import LatencyHistogram
 
 logger = logging.getLogger("client")
 
 
+class ReconnectPolicy:
+    """
+    How a SynchronousWrapper restores lost connections: attempts are made after initial_delay seconds, and the delay
+    is multiplied by multiplier after every failed attempt, up to max_delay. After max_attempts failed attempts in a
+    row it gives up and stops, as without a policy; None means it never gives up.
+    """
+    def __init__(self,
+                 initial_delay: float = 0.1,
+                 max_delay: float = 10.0,
+                 multiplier: float = 2.0,
+                 max_attempts: typing.Optional[int] = None,
+                 attempt_timeout: float = 5.0):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.max_attempts = max_attempts
+        self.attempt_timeout = attempt_timeout
+
+
+class ReconnectStats:
+    """
+    Attributes
+    ----------
+    nr_disconnects: int
+        How often a connection was lost.
+    nr_attempts: int
+        Reconnect attempts made, including the ones that succeeded.
+    last_downtime: float
+        Seconds from noticing the last lost connection until all clients were connected and logged in again, None
+        if no connection was restored yet.
+    downtime: LatencyHistogram
+        All downtimes.
+    """
+    def __init__(self):
+        self.nr_disconnects = 0
+        self.nr_attempts = 0
+        self.last_downtime: typing.Optional[float] = None
+        self.downtime = LatencyHistogram(min_latency=1e-3)
+
+    def __repr__(self):
+        return f'ReconnectStats(nr_disconnects={self.nr_disconnects}, nr_attempts={self.nr_attempts}, ' \
+               f'last_downtime={self.last_downtime})'
+
+
 class SynchronousWrapper:
-    def __init__(self, clients):
+    def __init__(self, clients, loop: asyncio.AbstractEventLoop = None, reconnect_policy: ReconnectPolicy = None):
+        """
+        Runs the clients on a loop in a thread of its own, or on the given loop, which is run by another
+        SynchronousWrapper. In the latter case connect and disconnect only concern the clients of this wrapper.
+
+        With a reconnect_policy, clients that lose their connection are reconnected until disconnect is called,
+        otherwise the loop stops once all of them are disconnected. Only a wrapper that runs its own loop reconnects;
+        clients of other wrappers on its loop are reconnected by it after they are added with supervise.
+        """
 
         self._clients = clients
+        # replaced instead of changed, the supervisor iterates over it while other threads add and remove clients
+        self._supervised = list(clients)
 
         self._thread = None
-        self._loop = asyncio.new_event_loop()
+        self._owns_loop = loop is None
+        self._loop = loop if loop is not None else asyncio.new_event_loop()
+        self._latency_histograms: typing.Dict[str, LatencyHistogram] = {}
+        self._reconnect_policy = reconnect_policy
+        self._reconnect_stats = ReconnectStats() if reconnect_policy is not None else None
+        self._stopping = False
 
     def get_loop(self):
         return self._loop
@@ -27,6 +89,15 @@ class SynchronousWrapper:
 
     def connect(self) -> None:
         assert not self.is_connected(), "Cannot connect while already connected"
+        self._stopping = False
+        if not self._owns_loop:
+            if not self._loop.is_running():
+                raise Exception("Unable to connect to the exchange, the loop is not running")
+            async def connect_all():
+                await asyncio.gather(*[cl.connect() for cl in self._clients])
+
+            asyncio.run_coroutine_threadsafe(connect_all(), self._loop).result(timeout=5)
+            return
 
         self._thread = threading.Thread(
             target=self._thread_entry_point, daemon=True)
@@ -41,6 +112,15 @@ class SynchronousWrapper:
             raise Exception("Unable to connect to the exchange")
 
     def disconnect(self) -> None:
+        if not self._owns_loop:
+            async def disconnect_all():
+                await asyncio.gather(*[cl.disconnect() for cl in self._clients])
+
+            if self._loop.is_running():
+                asyncio.run_coroutine_threadsafe(disconnect_all(), self._loop).result()
+            return
+        # a disconnect that is asked for is not restored
+        self._stopping = True
         if self._loop.is_running():
             futures = [concurrent.futures.Future() for c in self._clients]
 
@@ -68,19 +148,60 @@ class SynchronousWrapper:
                 slept_for += sleep_duration
         assert not self._loop.is_running()
 
-    def run_on_loop(self, awaitable):
-        start_time = datetime.datetime.now()
+    def get_latency_histograms(self) -> typing.Dict[str, LatencyHistogram]:
+        return dict(self._latency_histograms)
+
+    def get_reconnect_stats(self) -> typing.Optional[ReconnectStats]:
+        return self._reconnect_stats
+
+    def supervise(self, client) -> None:
+        """
+        Reconnects the client as well when it loses its connection, after the clients of this wrapper. For clients of
+        another wrapper on the loop of this one; has no effect without a reconnect_policy.
+        """
+        if client not in self._supervised:
+            self._supervised = self._supervised + [client]
+
+    def unsupervise(self, client) -> None:
+        """
+        Stops reconnecting a client added with supervise, e.g. before it is disconnected on purpose.
+        """
+        self._supervised = [cl for cl in self._supervised if cl is not client]
+
+    def submit_on_loop(self, awaitable, record_latency: bool = True) -> concurrent.futures.Future:
+        """
+        Schedules the awaitable on the loop and returns a future for its result without waiting for it. The time until
+        it completes is recorded in the latency histogram of the coroutine's name, unless record_latency is False,
+        e.g. for helpers that are not requests to the exchange.
+        """
+        histogram = None
+        if record_latency:
+            name = getattr(awaitable, "__qualname__", type(awaitable).__name__)
+            histogram = self._latency_histograms.get(name, None)
+            if histogram is None:
+                histogram = self._latency_histograms.setdefault(name, LatencyHistogram())
+
+        start_time = time.perf_counter()
         fut = concurrent.futures.Future()
 
+        def on_done(async_fut):
+            if histogram is not None:
+                histogram.record(time.perf_counter() - start_time)
+            if async_fut.exception():
+                fut.set_exception(async_fut.exception())
+            else:
+                fut.set_result(async_fut.result())
+
         def callback():
             task = self._loop.create_task(awaitable)
-            task.add_done_callback(
-                lambda async_fut: fut.set_exception(async_fut.exception())
-                if async_fut.exception()
-                else fut.set_result(async_fut.result())
-            )
+            task.add_done_callback(on_done)
 
         self._loop.call_soon_threadsafe(callback)
+        return fut
+
+    def run_on_loop(self, awaitable, record_latency: bool = True):
+        start_time = datetime.datetime.now()
+        fut = self.submit_on_loop(awaitable, record_latency)
 
         # Ensures no connections are left open
         if fut.exception():
@@ -102,32 +223,73 @@ class SynchronousWrapper:
         try:
             self._loop.run_until_complete(self._run())
         finally:
-            cs = [cl.disconnect() for cl in self._clients]
-            self._loop.run_until_complete(
-                asyncio.gather(
-                    *cs,
-                    *asyncio.all_tasks(self._loop),
-                    loop=self._loop,
+            async def close():
+                await asyncio.gather(
+                    *[cl.disconnect() for cl in self._clients],
+                    *asyncio.all_tasks(self._loop) - {asyncio.current_task()},
                     return_exceptions=True,
                 )
-            )
+
+            self._loop.run_until_complete(close())
 
     async def _run(self):
         try:
             await asyncio.gather(
-                *[cl.connect() for cl in self._clients], loop=self._loop
+                *[cl.connect() for cl in self._clients]
             )
 
+            if self._reconnect_policy is not None:
+                await self._supervise()
+                return
+
             async def wait_connected(cl):
                 while cl.is_connected():
                     await asyncio.sleep(0.1)
 
             await asyncio.gather(
-                *[wait_connected(cl) for cl in self._clients], loop=self._loop
+                *[wait_connected(cl) for cl in self._clients]
             )
         except Exception as exc:
             logger.warning(exc)
 
+    async def _supervise(self):
+        policy = self._reconnect_policy
+        stats = self._reconnect_stats
+        while not self._stopping:
+            if all(cl.is_connected() for cl in self._supervised):
+                await asyncio.sleep(0.1)
+                continue
+
+            lost_at = time.perf_counter()
+            stats.nr_disconnects += 1
+            logger.warning("connection to the exchange lost, reconnecting")
+            delay = policy.initial_delay
+            nr_failed = 0
+            while True:
+                await asyncio.sleep(delay)
+                if self._stopping:
+                    return
+                stats.nr_attempts += 1
+                try:
+                    # in order, the info client is subscribed again before the exec client logs in
+                    for cl in self._supervised:
+                        # a client may be unsupervised while an earlier one reconnects
+                        if cl in self._supervised and not cl.is_connected():
+                            await asyncio.wait_for(cl.reconnect(), policy.attempt_timeout)
+                    break
+                except Exception as exc:
+                    nr_failed += 1
+                    if policy.max_attempts is not None and nr_failed >= policy.max_attempts:
+                        logger.error(f"giving up reconnecting after {nr_failed} attempts: {exc!r}")
+                        return
+                    logger.warning(f"reconnect attempt {nr_failed} failed: {exc!r}")
+                    delay = min(delay * policy.multiplier, policy.max_delay)
+
+            downtime = time.perf_counter() - lost_at
+            stats.last_downtime = downtime
+            stats.downtime.record(downtime)
+            logger.warning(f"reconnected to the exchange after {downtime:.3f}s")
+
     def __enter__(self):
         self.connect()
         return self
@@ -0,0 +1,229 @@
+import heapq
+import typing
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+
+from .common_types import TradeTick
+
+SIDE_CODES = {'bid': 0, 'ask': 1}
+SIDES = ('bid', 'ask')
+
+
+class TradeTickColumns(typing.NamedTuple):
+    """
+    A contiguous range of trade ticks of one instrument, one memoryview per column. The views support the buffer
+    protocol, e.g. numpy.asarray(columns.price) does not copy.
+
+    The views point into the history itself: they are only valid until the history has wrapped around past them,
+    i.e. until capacity more ticks have arrived. Copy them if they need to be kept longer.
+
+    Attributes
+    ----------
+    timestamp_ns: memoryview of int64
+        Time of the trades, in nanoseconds since the epoch.
+
+    price: memoryview of float64
+
+    volume: memoryview of uint32
+
+    aggressor_side: memoryview of uint8
+        0 if the aggressor bought ('bid'), 1 if the aggressor sold ('ask').
+
+    trade_id: memoryview of uint64
+    """
+    timestamp_ns: memoryview
+    price: memoryview
+    volume: memoryview
+    aggressor_side: memoryview
+    trade_id: memoryview
+
+
+class MergedTradeTickColumns(typing.NamedTuple):
+    """
+    Like TradeTickColumns, for ticks of several instruments. instrument_index is the position of the instrument of each
+    tick in the instrument_ids of the MergedTradeTickHistory.
+    """
+    timestamp_ns: memoryview
+    price: memoryview
+    volume: memoryview
+    aggressor_side: memoryview
+    trade_id: memoryview
+    instrument_index: memoryview
+
+
+class TradeTickHistory:
+    """
+    Holds the last <capacity> public trades of one instrument in a ring buffer, column by column.
+
+    Appending and evicting are O(1). Every tick is written twice, at i and i + capacity, so that any range of at most
+    capacity consecutive ticks is contiguous in memory and can be handed out as a view without copying.
+
+    Ticks are identified by a sequence number, counting all ticks ever appended. Ticks with a sequence number below
+    first_sequence have been evicted.
+    """
+    def __init__(self, instrument_id: str, capacity: int):
+        assert capacity > 0, 'capacity must be positive'
+        self.instrument_id = instrument_id
+        self._capacity = capacity
+
+        size = 2 * capacity
+        self._timestamp_ns = array('q', [0]) * size
+        self._price = array('d', [0.0]) * size
+        self._volume = array('I', [0]) * size
+        self._aggressor_side = array('B', [0]) * size
+        self._trade_id = array('Q', [0]) * size
+        self._buyer = [''] * capacity
+        self._seller = [''] * capacity
+
+        self._views = [memoryview(c) for c in self._columns()]
+        self._sequence = 0
+
+    def _columns(self):
+        return [self._timestamp_ns, self._price, self._volume, self._aggressor_side, self._trade_id]
+
+    def _make_columns(self, views):
+        return TradeTickColumns(*views)
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def sequence(self) -> int:
+        """
+        The sequence number the next tick will get, i.e. the number of ticks appended so far.
+        """
+        return self._sequence
+
+    @property
+    def first_sequence(self) -> int:
+        """
+        The sequence number of the oldest tick still held.
+        """
+        return max(self._sequence - self._capacity, 0)
+
+    def __len__(self):
+        return min(self._sequence, self._capacity)
+
+    def append(self, timestamp_ns: int, price: float, volume: int, aggressor_side: str, trade_id: int, buyer: str,
+               seller: str) -> None:
+        i = self._sequence % self._capacity
+        j = i + self._capacity
+        self._timestamp_ns[i] = self._timestamp_ns[j] = timestamp_ns
+        self._price[i] = self._price[j] = price
+        self._volume[i] = self._volume[j] = volume
+        self._aggressor_side[i] = self._aggressor_side[j] = SIDE_CODES[aggressor_side]
+        self._trade_id[i] = self._trade_id[j] = trade_id
+        self._buyer[i] = buyer
+        self._seller[i] = seller
+        self._sequence += 1
+
+    def _clamp(self, start_sequence: int, stop_sequence: int) -> typing.Tuple[int, int]:
+        start_sequence = min(max(start_sequence, self.first_sequence), self._sequence)
+        stop_sequence = min(max(stop_sequence, start_sequence), self._sequence)
+        return start_sequence, stop_sequence
+
+    def columns_by_sequence(self, start_sequence: int, stop_sequence: int) -> TradeTickColumns:
+        start_sequence, stop_sequence = self._clamp(start_sequence, stop_sequence)
+        offset = start_sequence % self._capacity
+        end = offset + stop_sequence - start_sequence
+        return self._make_columns([view[offset:end] for view in self._views])
+
+    def columns(self, start: int = None, stop: int = None) -> TradeTickColumns:
+        """
+        Views on the held ticks, start and stop index the held ticks from oldest to newest like a list slice.
+        """
+        window = range(len(self))[start:stop]
+        first_sequence = self.first_sequence
+        return self.columns_by_sequence(first_sequence + window.start, first_sequence + max(window.stop, window.start))
+
+    def columns_between(self, start: typing.Union[datetime, int], end: typing.Union[datetime, int]) -> TradeTickColumns:
+        """
+        Views on the held ticks with start <= timestamp < end. Times are datetimes or nanoseconds since the epoch.
+        """
+        start_ns = _to_ns(start)
+        end_ns = _to_ns(end)
+        timestamps = self.columns().timestamp_ns
+        return self.columns(bisect_left(timestamps, start_ns), bisect_left(timestamps, end_ns))
+
+    def _instrument_id_at(self, i: int) -> str:
+        return self.instrument_id
+
+    def rows_by_sequence(self, start_sequence: int, stop_sequence: int) -> typing.Iterator[typing.Tuple]:
+        """
+        Yields (timestamp_ns, price, volume, aggressor_side, trade_id, buyer, seller, instrument_id) per tick.
+        """
+        start_sequence, stop_sequence = self._clamp(start_sequence, stop_sequence)
+        for sequence in range(start_sequence, stop_sequence):
+            i = sequence % self._capacity
+            yield (self._timestamp_ns[i], self._price[i], self._volume[i], SIDES[self._aggressor_side[i]],
+                   self._trade_id[i], self._buyer[i], self._seller[i], self._instrument_id_at(i))
+
+    def ticks_by_sequence(self, start_sequence: int, stop_sequence: int) -> typing.List[TradeTick]:
+        start_sequence, stop_sequence = self._clamp(start_sequence, stop_sequence)
+        ticks = []
+        for sequence in range(start_sequence, stop_sequence):
+            i = sequence % self._capacity
+            ticks.append(TradeTick(
+                timestamp=datetime.fromtimestamp(self._timestamp_ns[i] / 1000000000),
+                instrument_id=self._instrument_id_at(i),
+                price=self._price[i],
+                volume=self._volume[i],
+                aggressor_side=SIDES[self._aggressor_side[i]],
+                buyer=self._buyer[i],
+                seller=self._seller[i],
+                trade_id=self._trade_id[i],
+            ))
+        return ticks
+
+    def ticks(self) -> typing.List[TradeTick]:
+        return self.ticks_by_sequence(self.first_sequence, self._sequence)
+
+
+class MergedTradeTickHistory(TradeTickHistory):
+    """
+    A TradeTickHistory holding the public trades of several instruments, in time order.
+
+    Ticks are appended as they arrive on the info feed, which carries the trades of all instruments in the order in
+    which they happened. Only the initial backfill from existing per-instrument histories needs merging.
+    """
+    def __init__(self, instrument_ids: typing.Sequence[str], capacity: int):
+        self.instrument_ids = tuple(instrument_ids)
+        self._instrument_index = {instrument_id: i for i, instrument_id in enumerate(self.instrument_ids)}
+        self._instrument_indices = array('H', [0]) * (2 * capacity)
+        super().__init__(None, capacity)
+
+    @staticmethod
+    def merged_from(instrument_ids: typing.Sequence[str], histories: typing.Iterable[TradeTickHistory],
+                    capacity: int) -> "MergedTradeTickHistory":
+        """
+        Creates the merged history from the per-instrument histories, with a k-way merge on timestamp.
+        """
+        merged = MergedTradeTickHistory(instrument_ids, capacity)
+        rows = [history.rows_by_sequence(history.first_sequence, history.sequence) for history in histories]
+        for row in heapq.merge(*rows, key=lambda r: r[0]):
+            merged.append(*row)
+        return merged
+
+    def _columns(self):
+        return super()._columns() + [self._instrument_indices]
+
+    def _make_columns(self, views):
+        return MergedTradeTickColumns(*views)
+
+    def _instrument_id_at(self, i: int) -> str:
+        return self.instrument_ids[self._instrument_indices[i]]
+
+    def append(self, timestamp_ns: int, price: float, volume: int, aggressor_side: str, trade_id: int, buyer: str,
+               seller: str, instrument_id: str = None) -> None:
+        i = self._sequence % self._capacity
+        self._instrument_indices[i] = self._instrument_indices[i + self._capacity] = \
+            self._instrument_index[instrument_id]
+        super().append(timestamp_ns, price, volume, aggressor_side, trade_id, buyer, seller)
+
+
+def _to_ns(t: typing.Union[datetime, int]) -> int:
+    if isinstance(t, datetime):
+        return int(t.timestamp() * 1000000) * 1000
+    return t
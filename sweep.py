@@ -0,0 +1,74 @@
+"""
+Tunes the constants of bot.py: runs TradingAlgorithm with many values of LEVEL, OWN_WEIGHT, OTHER_INSIDE_WEIGHT,
+OTHER_OUTSIDE_WEIGHT and the volume curve against the same market data, on all cores, and prints one table of the
+results.
+
+Without --feed, a synthetic feed like the one of backtest.py is generated first.
+
+    python sweep.py [--feed PATH] [--hours 1] [--trials 32] [--position-limit 500]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from optibook.backtester import synthetic_feed
+from optibook.feed_file import write_events
+from optibook.parameter_sweep import sweep, random_search, format_table
+
+import bot
+from backtest import INSTRUMENTS, CYCLE_SECONDS, ready
+
+CONSTANTS = ["LEVEL", "OWN_WEIGHT", "OTHER_INSIDE_WEIGHT", "OTHER_OUTSIDE_WEIGHT"]
+
+SEARCH_SPACE = dict(
+    LEVEL=[0.1, 0.2, 0.3],
+    OWN_WEIGHT=(0.005, 0.1),
+    OTHER_INSIDE_WEIGHT=(0.0001, 0.01),
+    OTHER_OUTSIDE_WEIGHT=(0.0001, 0.003),
+    volume_curve=[(2, 8, 16, 32), (1, 4, 8, 16), (4, 8, 8, 8), (1, 2, 4, 8)],
+)
+
+
+def make_algorithm(exchange, parameters):
+    # every trial runs in a fresh process or after the previous trial, so the module constants can be set directly
+    for name in CONSTANTS:
+        if name in parameters:
+            setattr(bot, name, parameters[name])
+    while not ready(exchange) and exchange.advance(CYCLE_SECONDS):
+        pass
+    algorithm = bot.TradingAlgorithm(exchange)
+    if "volume_curve" in parameters:
+        algorithm.volume_curve = list(parameters["volume_curve"])
+    return algorithm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--feed", help="feed file or recording directory to replay, see optibook.feed_replay")
+    parser.add_argument("--hours", type=float, default=1.0, help="length of the synthetic feed")
+    parser.add_argument("--trials", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--position-limit", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        feed_path = args.feed
+        if feed_path is None:
+            feed_path = os.path.join(tmp_dir, "synthetic.feed")
+            write_events(feed_path, synthetic_feed(INSTRUMENTS, duration=args.hours * 3600, seed=args.seed,
+                                                   shared_fair_value=True, taker_rate=1.0))
+
+        start = time.perf_counter()
+        results = sweep(feed_path, INSTRUMENTS, make_algorithm,
+                        random_search(args.trials, seed=args.seed, **SEARCH_SPACE),
+                        cycle_seconds=CYCLE_SECONDS, position_limit=args.position_limit, max_workers=args.workers)
+        elapsed = time.perf_counter() - start
+
+    print(format_table(results))
+    print(f"{len(results)} trials in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()